@@ -4,6 +4,7 @@ import discord
 from sqlitedict import SqliteDict
 
 from services.environment_service import EnvService
+from services.metrics_service import TimedQueue
 from services.moderations_service import Moderation, ThresholdSet
 
 MOD_DB = None
@@ -117,7 +118,9 @@ class ModerationsService(discord.Cog, name="ModerationsService"):
     async def check_and_launch_moderations(self, guild_id, alert_channel_override=None):
         """Create the moderation service"""
         if self.check_guild_moderated(guild_id):
-            Moderation.moderation_queues[guild_id] = asyncio.Queue()
+            Moderation.moderation_queues[guild_id] = TimedQueue(
+                "moderation_queue", guild=guild_id
+            )
 
             moderations_channel = await self.bot.fetch_channel(
                 self.get_moderated_alert_channel(guild_id)
@@ -132,8 +135,6 @@ class ModerationsService(discord.Cog, name="ModerationsService"):
             Moderation.moderation_tasks[guild_id] = asyncio.ensure_future(
                 Moderation.process_moderation_queue(
                     Moderation.moderation_queues[guild_id],
-                    0.25,
-                    0.25,
                     moderations_channel,
                     warn_set,
                     delete_set,
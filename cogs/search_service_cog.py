@@ -43,7 +43,6 @@ from llama_index.retrievers import VectorIndexRetriever
 from llama_index.query_engine import RetrieverQueryEngine
 from llama_index.prompts.chat_prompts import CHAT_REFINE_PROMPT
 from pydantic import Extra, BaseModel
-import tiktoken
 
 from models.embed_statics_model import EmbedStatics
 from models.search_model import Search
@@ -51,6 +50,7 @@ from services.deletion_service import Deletion
 from services.environment_service import EnvService
 from services.moderations_service import Moderation
 from services.text_service import TextService
+from services.tokenizer_service import TOKENIZER
 from models.openai_model import Models
 from utils.safe_ctx_respond import safe_ctx_respond, safe_remove_list
 
@@ -202,8 +202,7 @@ class CustomTextRequestWrapper(BaseModel):
         text = re.sub(r"\s+", " ", text).strip()
 
         # If not using GPT-4 and the text token amount is over 3500, truncate it to 3500 tokens
-        enc = tiktoken.encoding_for_model(model)
-        tokens = len(enc.encode(text))
+        tokens = TOKENIZER.count(text, model)
         if len(text) < 5:
             return "This website could not be scraped. I cannot answer this question."
         if (
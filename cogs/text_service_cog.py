@@ -16,15 +16,20 @@ from discord.ext import pages
 from models.deepl_model import TranslationModel
 from models.embed_statics_model import EmbedStatics
 from models.image_understanding_model import ImageUnderstandingModel
-from models.openai_model import Override
+from models.openai_model import Model, Override
 from services.environment_service import EnvService
 from services.message_queue_service import Message
 from services.moderations_service import Moderation
-from models.user_model import Thread, EmbeddedConversationItem, Instruction
+from models.user_model import (
+    Thread,
+    EmbeddedConversationItem,
+    Instruction,
+    FullConversationHistory,
+)
 from collections import defaultdict
 from sqlitedict import SqliteDict
 
-from services.pickle_service import Pickler
+from services.request_scheduler_service import Priority
 from services.sharegpt_service import ShareGPTService
 from services.text_service import SetupModal, TextService
 from utils.safe_ctx_respond import safe_ctx_respond, safe_remove_list
@@ -88,7 +93,7 @@ class GPT3ComCon(discord.Cog, name="GPT3ComCon"):
         DEBUG_CHANNEL,
         data_path: Path,
         pinecone_service,
-        pickle_queue,
+        conversation_store,
     ):
         super().__init__()
         self.GLOBAL_COOLDOWN_TIME = 0.25
@@ -108,8 +113,8 @@ class GPT3ComCon(discord.Cog, name="GPT3ComCon"):
         self.users_to_interactions = defaultdict(list)
         self.redo_users = {}
 
-        # Pickle queue
-        self.pickle_queue = pickle_queue
+        # Conversations are saved to the store periodically, and on shutdown
+        self.conversation_store = conversation_store
 
         # Conversations-specific data
         self.END_PROMPTS = [
@@ -122,7 +127,10 @@ class GPT3ComCon(discord.Cog, name="GPT3ComCon"):
         self.awaiting_responses = []
         self.awaiting_thread_responses = []
         self.conversation_threads = {}
-        self.full_conversation_history = defaultdict(list)
+        self.full_conversation_history = defaultdict(FullConversationHistory)
+        self.full_conversation_history_max_items = (
+            EnvService.get_full_conversation_history_max_items()
+        )
         self.instructions = defaultdict(list)
         self.summarize = self.model.summarize_conversations
 
@@ -242,6 +250,7 @@ class GPT3ComCon(discord.Cog, name="GPT3ComCon"):
                     is_chatgpt_request=(
                         True if "turbo" in str(self.model.model) else False
                     ),
+                    priority=Priority.BACKGROUND,
                 )
                 welcome_message = str(
                     welcome_message_response["choices"][0]["message"]["content"]
@@ -269,6 +278,129 @@ class GPT3ComCon(discord.Cog, name="GPT3ComCon"):
         )
         print("The debug channel was acquired")
 
+        print("Attempting to load the saved conversations")
+        try:
+            if self.conversation_store:
+                # Only the ids of the threads are read now, each thread is read when it is first used
+                conversations = self.conversation_store.load()
+                pickle_paths = self.get_pickle_paths()
+                migrated = False
+                if pickle_paths and self.conversation_store.is_empty():
+                    # Conversations saved before the store existed are in pickles, they are moved into the store
+                    migrated = self.load_pickles()
+                    conversations["full_conversation_history"].update(
+                        self.full_conversation_history
+                    )
+                    conversations["conversation_threads"].update(
+                        self.conversation_threads
+                    )
+                    conversations["conversation_thread_owners"].update(
+                        self.conversation_thread_owners
+                    )
+                    conversations["instructions"].update(self.instructions)
+                self.full_conversation_history = conversations[
+                    "full_conversation_history"
+                ]
+                self.conversation_threads = conversations["conversation_threads"]
+                self.conversation_thread_owners = conversations[
+                    "conversation_thread_owners"
+                ]
+                self.instructions = conversations["instructions"]
+                if migrated:
+                    try:
+                        await self.save_conversations()
+                    except Exception:
+                        traceback.print_exc()
+                if pickle_paths and not self.conversation_store.is_empty():
+                    # Once they are in the store, the pickles are renamed so they are never imported again, not
+                    # even when every conversation has ended and the store is empty
+                    self.retire_pickles(pickle_paths)
+                print(f"Found {len(self.conversation_threads)} conversation threads")
+            else:
+                # Pickles that were moved into the store are renamed, so only ones that never were are loaded
+                self.load_pickles()
+        except Exception:
+            print("Failed to load existing conversations")
+            self.full_conversation_history = defaultdict(FullConversationHistory)
+            self.conversation_threads = {}
+            self.conversation_thread_owners = defaultdict(list)
+            print("Set empty dictionaries, conversations will be saved in the future")
+
+        print("Syncing commands...")
+
+        try:
+            await self.bot.sync_commands(
+                commands=None,
+                method="individual",
+                force=True,
+                guild_ids=ALLOWED_GUILDS,
+                register_guild_commands=True,
+                check_guilds=[],
+                delete_existing=True,
+            )
+        except:
+            traceback.print_exc()
+            print(
+                "There was a failure during command syncing. This might mean that the bot may not be in a guild that it expects to be in anymore, or it is in guilds without the guild ID being added to ALLOWED_GUILDS."
+            )
+        print("Commands synced")
+
+        # Save the conversations that changed every 15 seconds, then drop the ones that are saved and idle from memory
+        print("Starting the conversation save loop")
+        while True:
+            await asyncio.sleep(15)
+            try:
+                await self.save_conversations()
+                self.evict_idle_conversations()
+            except Exception:
+                traceback.print_exc()
+
+    async def save_conversations(self):
+        """Write the conversations that changed since the last save to the conversation store"""
+        if not self.conversation_store:
+            return
+        await self.conversation_store.save(
+            {
+                "full_conversation_history": self.full_conversation_history,
+                "conversation_threads": self.conversation_threads,
+                "conversation_thread_owners": self.conversation_thread_owners,
+                "instructions": self.instructions,
+            }
+        )
+
+    def add_to_full_history(self, conversation_id, text):
+        """Keep text in the full history of the conversation, which only holds its most recent texts"""
+        history = self.full_conversation_history[conversation_id]
+        if not isinstance(history, FullConversationHistory):
+            # Histories saved by older versions are plain lists, they need a version to be saved
+            history = self.full_conversation_history[conversation_id] = (
+                FullConversationHistory(history)
+            )
+        history.append(text)
+        history.trim(self.full_conversation_history_max_items)
+
+    def evict_idle_conversations(self):
+        """Drop the threads and full histories that haven't been used for a while from memory, they stay on disk"""
+        for records in (self.conversation_threads, self.full_conversation_history):
+            if hasattr(records, "evict_idle"):
+                records.evict_idle()
+
+    @staticmethod
+    def get_pickle_paths():
+        """The pickles older versions saved the conversations to, that haven't been moved into the store yet"""
+        return sorted((EnvService.save_path() / "pickles").glob("*.pickle"))
+
+    @staticmethod
+    def retire_pickles(pickle_paths):
+        """Rename the pickles that were moved into the store, they are kept but never loaded again"""
+        for path in pickle_paths:
+            try:
+                path.replace(path.with_name(path.name + ".migrated"))
+            except OSError:
+                traceback.print_exc()
+
+    def load_pickles(self):
+        """Load the conversations from the pickles they were saved to by older versions, returns whether they loaded"""
         print("Attempting to load from pickles")
         # Try to load self.full_conversation_history, self.conversation_threads, and self.conversation_thread_owners from the `pickles` folder
         try:
@@ -305,45 +437,15 @@ class GPT3ComCon(discord.Cog, name="GPT3ComCon"):
             assert self.full_conversation_history is not {}
             assert self.conversation_threads is not {}
             assert self.conversation_thread_owners is not defaultdict(list)
+            return True
 
         except Exception:
             print("Failed to load existing pickles")
-            self.full_conversation_history = defaultdict(list)
+            self.full_conversation_history = defaultdict(FullConversationHistory)
             self.conversation_threads = {}
             self.conversation_thread_owners = defaultdict(list)
             print("Set empty dictionaries, pickles will be saved in the future")
-
-        print("Syncing commands...")
-
-        try:
-            await self.bot.sync_commands(
-                commands=None,
-                method="individual",
-                force=True,
-                guild_ids=ALLOWED_GUILDS,
-                register_guild_commands=True,
-                check_guilds=[],
-                delete_existing=True,
-            )
-        except:
-            traceback.print_exc()
-            print(
-                "There was a failure during command syncing. This might mean that the bot may not be in a guild that it expects to be in anymore, or it is in guilds without the guild ID being added to ALLOWED_GUILDS."
-            )
-        print("Commands synced")
-
-        # Start an inline async loop that runs every 10 seconds to save the conversation history to a pickle file
-        print("Starting pickle loop")
-        while True:
-            await asyncio.sleep(15)
-            await self.pickle_queue.put(
-                Pickler(
-                    self.full_conversation_history,
-                    self.conversation_threads,
-                    self.conversation_thread_owners,
-                    self.instructions,
-                )
-            )
+            return False
 
     def check_conversing(self, channel_id, message_content):
         '''given channel id and a message, return true if it's a conversation thread, false if not, or if the message starts with "~"'''
@@ -593,6 +695,7 @@ class GPT3ComCon(discord.Cog, name="GPT3ComCon"):
         ]
 
         backticks_encountered = 0
+        messages = []
 
         for i, chunk in enumerate(debug_message_chunks):
             # Count the number of backticks in the chunk
@@ -610,12 +713,17 @@ class GPT3ComCon(discord.Cog, name="GPT3ComCon"):
             else:
                 chunk = "```\n" + chunk
 
-            await self.message_queue.put(Message(chunk, debug_channel))
+            messages.append(Message(chunk, debug_channel))
+
+        await self.message_queue.put_all(messages)
 
     async def send_debug_message(self, debug_message, debug_channel):
         """process a debug message and put directly into queue or chunk it"""
         # Send the debug message
         try:
+            # Every debug message is logged, but only a sample may be sent to the channel
+            if not self.message_queue.accept_debug(debug_message):
+                return
             if len(debug_message) > self.TEXT_CUTOFF:
                 await self.queue_debug_chunks(debug_message, debug_channel)
             else:
@@ -649,19 +757,30 @@ class GPT3ComCon(discord.Cog, name="GPT3ComCon"):
 
         new_conversation_history = []
         new_conversation_history.append(
-            EmbeddedConversationItem(self.CONVERSATION_STARTER_TEXT, 0)
+            EmbeddedConversationItem(
+                self.CONVERSATION_STARTER_TEXT,
+                0,
+                role="system",
+                content=self.CONVERSATION_STARTER_TEXT,
+            )
         )
+        context_text = f"\nThis conversation has some context from earlier, which has been summarized as follows: {summarized_text} \nContinue the conversation, paying very close attention to things <username> told you, such as their name, and personal details."
         new_conversation_history.append(
             EmbeddedConversationItem(
-                f"\nThis conversation has some context from earlier, which has been summarized as follows: {summarized_text} \nContinue the conversation, paying very close attention to things <username> told you, such as their name, and personal details.",
-                0,
+                context_text, 0, role="system", content=context_text
             )
         )
 
         # Get the last entry from the thread's conversation history
+        last_item = self.conversation_threads[message.channel.id].history[-1]
         new_conversation_history.append(
             EmbeddedConversationItem(
-                self.conversation_threads[message.channel.id].history[-1].text + "\n", 0
+                last_item.text + "\n",
+                0,
+                image_urls=last_item.image_urls,
+                role=last_item.role,
+                name=last_item.name,
+                content=last_item.content,
             )
         )
         self.conversation_threads[message.channel.id].history = new_conversation_history
@@ -941,6 +1060,18 @@ class GPT3ComCon(discord.Cog, name="GPT3ComCon"):
                     pass
         await ctx.respond("All conversation threads in this server have been deleted.")
 
+    def get_usage_label(self, group, key):
+        """The name to show for a key of the usage report, guilds are recorded by id"""
+        if group == "guild":
+            try:
+                guild = self.bot.get_guild(int(key))
+            except ValueError:
+                # Usage recorded by guild name, before guilds were recorded by id
+                return key
+            if guild:
+                return f"{guild.name} ({key})"
+        return key
+
     async def usage_command(self, ctx):
         """Command handler. Responds with the current usage of the bot"""
         await ctx.defer()
@@ -958,6 +1089,44 @@ class GPT3ComCon(discord.Cog, name="GPT3ComCon"):
             value="$" + str(round(await self.usage_service.get_usage(), 2)),
             inline=False,
         )
+        # What drove the spend over the last day, from the usage ledger
+        since = datetime.datetime.now().timestamp() - 86400
+        for group in ["guild", "model", "feature"]:
+            report = await self.usage_service.get_usage_report(group, since)
+            if report:
+                embed.add_field(
+                    name=f"Top {group}s (last 24 hours)",
+                    value="\n".join(
+                        f"{self.get_usage_label(group, entry['key'])}: ${entry['cost']:.2f}, {entry['calls']} calls, "
+                        f"{entry['prompt_tokens'] + entry['completion_tokens']} tokens"
+                        for entry in report
+                    ),
+                    inline=False,
+                )
+        # How the request queues of each priority class are doing
+        for priority, stats in Model.scheduler.get_stats().items():
+            embed.add_field(
+                name=f"{priority.capitalize()} requests",
+                value=f"{stats['queued']} queued, {stats['in_flight']} in flight, "
+                f"{stats['average_wait']:.2f}s average wait, {stats['max_wait']:.2f}s max wait",
+                inline=False,
+            )
+        if Model.hedge_policy.enabled:
+            hedge_stats = Model.hedge_policy.get_stats()
+            embed.add_field(
+                name="Hedged requests",
+                value=f"{hedge_stats['hedges']} of {hedge_stats['requests']} requests hedged, "
+                f"the backup won {hedge_stats['hedge_wins']} times",
+                inline=False,
+            )
+        # How often the cached internal requests were answered from the cache
+        for site, stats in Model.response_cache.get_stats().items():
+            embed.add_field(
+                name=f"Response cache ({site})",
+                value=f"{stats['hits']} hits, {stats['misses']} misses, "
+                f"{stats['hit_rate']:.0%} hit rate",
+                inline=False,
+            )
         await ctx.respond(embed=embed)
 
     async def instruction_command(
@@ -1353,7 +1522,9 @@ class GPT3ComCon(discord.Cog, name="GPT3ComCon"):
         else:
             starting_text += "You are unable to draw images in this conversation. Ask the user to start a conversation with gpt-4-vision with the `draw` option turned on in order to have this ability."
         self.conversation_threads[target.id].history.append(
-            EmbeddedConversationItem(starting_text, 0)
+            EmbeddedConversationItem(
+                starting_text, 0, role="system", content=starting_text
+            )
         )
 
         # Set user as thread owner before sending anything that can error and leave the thread unowned
@@ -1387,6 +1558,9 @@ class GPT3ComCon(discord.Cog, name="GPT3ComCon"):
                         EmbeddedConversationItem(
                             f"\n{ctx.author.display_name}: {opener} <|endofstatement|>\n",
                             0,
+                            role="user",
+                            name=ctx.author.display_name,
+                            content=opener,
                         )
                     )
                 self.awaiting_thread_responses.append(target.id)
@@ -1600,17 +1774,21 @@ class ShareButton(discord.ui.Button["ShareView"]):
     async def callback(self, interaction: discord.Interaction):
         # Get the user
         try:
+            history = self.converser_cog.full_conversation_history[self.conversation_id]
+            # Only the most recent messages are kept, the transcript says when older ones were cut from it
+            dropped = getattr(history, "dropped", 0)
             id = await self.converser_cog.sharegpt_service.format_and_share(
-                self.converser_cog.full_conversation_history[self.conversation_id],
+                history,
                 (
                     self.converser_cog.bot.user.default_avatar.url
                     if not self.converser_cog.bot.user.avatar
                     else self.converser_cog.bot.user.avatar.url
                 ),
+                dropped=dropped,
             )
             url = f"https://shareg.pt/{id}"
             await interaction.response.send_message(
-                embed=EmbedStatics.get_conversation_shared_embed(url)
+                embed=EmbedStatics.get_conversation_shared_embed(url, dropped)
             )
         except ValueError as e:
             traceback.print_exc()
@@ -22,12 +22,16 @@ from cogs.transcription_service_cog import TranscribeService
 from cogs.translation_service_cog import TranslationService
 from cogs.index_service_cog import IndexService
 from models.deepl_model import TranslationModel
+from services.embedding_cache_service import EMBEDDING_CACHE
 from services.health_service import HealthService
-from services.pickle_service import Pickler
+from services.metrics_service import METRICS, MetricsService, register_queue
+from services.conversation_store_service import ConversationStore
 
+from services.local_vector_service import LocalVectorService
 from services.pinecone_service import PineconeService
-from services.deletion_service import Deletion
-from services.message_queue_service import Message
+from services.deletion_service import DeletionScheduler
+from services.message_queue_service import MessageDispatcher
+from services.moderations_service import Moderation
 from services.usage_service import UsageService
 from services.environment_service import EnvService
 
@@ -45,7 +49,8 @@ else:
     separator = "/"
 
 #
-# The pinecone service is used to store and retrieve conversation embeddings.
+# The pinecone service is used to store and retrieve conversation embeddings. With VECTOR_MEMORY_BACKEND set to
+# local, they are kept on the local disk instead.
 #
 
 try:
@@ -54,7 +59,10 @@ except Exception:
     PINECONE_TOKEN = None
 
 pinecone_service = None
-if PINECONE_TOKEN:
+if EnvService.get_vector_memory_backend() == "local":
+    pinecone_service = LocalVectorService(EnvService.save_path() / "vectors")
+    print("Got the local vector service")
+elif PINECONE_TOKEN:
     pinecone.init(api_key=PINECONE_TOKEN, environment=EnvService.get_pinecone_region())
     PINECONE_INDEX = "conversation-embeddings"
     if PINECONE_INDEX not in pinecone.list_indexes():
@@ -72,21 +80,31 @@ if PINECONE_TOKEN:
 #
 # Message queueing for the debug service, defer debug messages to be sent later so we don't hit rate limits.
 #
-message_queue = asyncio.Queue()
-deletion_queue = asyncio.Queue()
-asyncio.ensure_future(Message.process_message_queue(message_queue, 1.5, 5))
-asyncio.ensure_future(Deletion.process_deletion_queue(deletion_queue, 1, 1))
+message_queue = MessageDispatcher(
+    EnvService.get_debug_message_max_pending(),
+    EnvService.get_debug_message_sample_rate(),
+    (
+        EnvService.save_path() / "debug.log"
+        if EnvService.get_debug_log_enabled()
+        else None
+    ),
+)
+deletion_queue = DeletionScheduler(EnvService.save_path() / "main_db.sqlite")
+asyncio.ensure_future(message_queue.process(send_interval=1))
 
-# Pickling service for conversation persistence
+# Conversation persistence, only the conversations that changed are written
 try:
     Path(EnvService.save_path() / "pickles").mkdir(exist_ok=True)
+    conversation_store = ConversationStore(
+        EnvService.save_path() / "pickles" / "conversations.sqlite",
+        idle_ttl=EnvService.get_conversation_idle_ttl(),
+    )
 except Exception:
     traceback.print_exc()
     print(
-        "Could not start pickle service. Conversation history will not be persistent across restarts."
+        "Could not start the conversation store. Conversation history will not be persistent across restarts."
     )
-pickle_queue = asyncio.Queue()
-asyncio.ensure_future(Pickler.process_pickle_queue(pickle_queue, 5, 1))
+    conversation_store = None
 
 
 #
@@ -98,6 +116,11 @@ activity = discord.Activity(
 bot = discord.Bot(intents=discord.Intents.all(), command_prefix="!", activity=activity)
 usage_service = UsageService(Path(os.environ.get("DATA_DIR", os.getcwd())))
 model = Model(usage_service)
+metrics_service = (
+    MetricsService(EnvService.get_metrics_host(), EnvService.get_metrics_port())
+    if EnvService.get_metrics_enabled()
+    else None
+)
 
 
 #
@@ -108,6 +131,16 @@ model = Model(usage_service)
 @bot.event  # Using self gives u
 async def on_ready():  # I can make self optional by
     print("We have logged in as {0.user}".format(bot))
+    # The channels of deletions that were pending at the last shutdown are known once the bot is ready
+    await deletion_queue.restore(bot)
+
+
+@bot.before_invoke
+async def set_usage_context(ctx: discord.ApplicationContext):
+    # The usage of the requests made by this command is attributed to its guild, user and the command
+    UsageService.set_usage_context(
+        ctx.guild, ctx.user, feature=ctx.command.qualified_name
+    )
 
 
 @bot.event
@@ -143,7 +176,7 @@ async def main():
             debug_channel,
             data_path,
             pinecone_service=pinecone_service,
-            pickle_queue=pickle_queue,
+            conversation_store=conversation_store,
         )
     )
 
@@ -230,9 +263,82 @@ async def main():
 
     apply_multicog(bot)
 
+    # Open the pooled connections to the OpenAI API while the bot logs in
+    asyncio.ensure_future(Model.warm_up())
+
+    # New embeddings are kept in memory and written to the embedding cache periodically
+    if EMBEDDING_CACHE:
+        asyncio.ensure_future(EMBEDDING_CACHE.process_flush())
+
+    # Usage is kept in memory and written to disk periodically
+    asyncio.ensure_future(
+        usage_service.process_usage_flush(EnvService.get_usage_flush_interval())
+    )
+
+    if metrics_service:
+        register_metrics()
+        await metrics_service.start()
+
+    # Docker stops the bot with SIGTERM. Closing the bot makes main() return, so that init() runs shutdown() and
+    # the usage, embeddings and conversations held in memory are written before the process exits
+    try:
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, lambda: asyncio.ensure_future(bot.close())
+        )
+    except NotImplementedError:
+        # Event loops on Windows can't handle signals
+        pass
+
     await bot.start(os.getenv("DISCORD_TOKEN"))
 
 
+def register_metrics():
+    """Report the depth of the bot's queues and how much work it has in flight on the metrics endpoint"""
+    register_queue("message_queue", lambda: {None: message_queue})
+    register_queue("deletion_queue", lambda: {None: deletion_queue})
+    register_queue("moderation_queue", lambda: dict(Moderation.moderation_queues))
+
+    converser_cog = bot.get_cog("GPT3ComCon")
+    METRICS.register_gauge(
+        "active_conversation_threads",
+        "Conversations that are currently open",
+        lambda: len(converser_cog.conversation_threads),
+    )
+    METRICS.register_gauge(
+        "loaded_conversation_threads",
+        "Open conversations whose thread is in memory, the rest are read from disk when they are next used",
+        lambda: len(
+            getattr(
+                converser_cog.conversation_threads,
+                "loaded",
+                converser_cog.conversation_threads,
+            )
+        ),
+    )
+    index_cog = bot.get_cog("IndexService")
+    if index_cog:
+        METRICS.register_gauge(
+            "active_index_chats",
+            "Chats with an index that are currently open",
+            lambda: len(index_cog.index_handler.index_chat_chains),
+        )
+
+
+async def shutdown():
+    """Flush and close everything that has to be cleaned up before the process exits"""
+    await usage_service.flush_usage()
+    if EMBEDDING_CACHE:
+        await asyncio.to_thread(EMBEDDING_CACHE.flush)
+    converser_cog = bot.get_cog("GPT3ComCon")
+    if converser_cog:
+        await converser_cog.save_conversations()
+    if metrics_service:
+        await metrics_service.stop()
+    if isinstance(pinecone_service, LocalVectorService):
+        pinecone_service.close()
+    await Model.close_session()
+
+
 def check_process_file(pid_file: Path) -> bool:
     """Check the pid file exists and if the Process ID is actually running"""
     if not pid_file.exists():
@@ -294,6 +400,10 @@ def init():
         print(str(e))
         print("Removing PID file")
     finally:
+        try:
+            asyncio.get_event_loop().run_until_complete(shutdown())
+        except Exception:
+            traceback.print_exc()
         cleanup_pid_file(None, None)
 
     sys.exit(0)
@@ -0,0 +1,64 @@
+from llama_index import OpenAIEmbedding
+
+from models.openai_model import Models
+from services.embedding_cache_service import EMBEDDING_CACHE
+
+
+class CachedOpenAIEmbedding(OpenAIEmbedding):
+    """An OpenAIEmbedding that only requests the embeddings that aren't already in the embedding cache"""
+
+    def _cached_embeddings(self, texts, embed):
+        if not EMBEDDING_CACHE:
+            return embed(texts)
+        model = getattr(self, "model_name", Models.EMBEDDINGS)
+        embeddings = EMBEDDING_CACHE.get_many(model, texts)
+        missing = [
+            index for index, embedding in enumerate(embeddings) if embedding is None
+        ]
+        if missing:
+            missing_texts = [texts[index] for index in missing]
+            new_embeddings = embed(missing_texts)
+            for index, embedding in zip(missing, new_embeddings):
+                embeddings[index] = embedding
+            EMBEDDING_CACHE.put_many(model, missing_texts, new_embeddings)
+        return embeddings
+
+    async def _acached_embeddings(self, texts, aembed):
+        if not EMBEDDING_CACHE:
+            return await aembed(texts)
+        model = getattr(self, "model_name", Models.EMBEDDINGS)
+        embeddings = EMBEDDING_CACHE.get_many(model, texts)
+        missing = [
+            index for index, embedding in enumerate(embeddings) if embedding is None
+        ]
+        if missing:
+            missing_texts = [texts[index] for index in missing]
+            new_embeddings = await aembed(missing_texts)
+            for index, embedding in zip(missing, new_embeddings):
+                embeddings[index] = embedding
+            EMBEDDING_CACHE.put_many(model, missing_texts, new_embeddings)
+        return embeddings
+
+    def _get_query_embedding(self, query):
+        embed = super()._get_query_embedding
+        return self._cached_embeddings([query], lambda texts: [embed(texts[0])])[0]
+
+    async def _aget_query_embedding(self, query):
+        aembed = super()._aget_query_embedding
+
+        async def aembed_one(texts):
+            return [await aembed(texts[0])]
+
+        return (await self._acached_embeddings([query], aembed_one))[0]
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text):
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts):
+        return self._cached_embeddings(texts, super()._get_text_embeddings)
+
+    async def _aget_text_embeddings(self, texts):
+        return await self._acached_embeddings(texts, super()._aget_text_embeddings)
@@ -295,10 +295,13 @@ class EmbedStatics:
         return embed
 
     @staticmethod
-    def get_conversation_shared_embed(url):
+    def get_conversation_shared_embed(url, dropped=0):
+        description = f"You can access your shared conversation at: {url}"
+        if dropped:
+            description += f"\nThe first {dropped} messages of this conversation were too old to be included."
         embed = discord.Embed(
             title="Conversation Shared",
-            description=f"You can access your shared conversation at: {url}",
+            description=description,
             color=discord.Color.blurple(),
         )
         # thumbnail of https://i.imgur.com/hbdBZfG.png
@@ -11,7 +11,6 @@ import discord
 import aiofiles
 import httpx
 import openai
-import tiktoken
 from functools import partial
 from typing import List, Optional, cast
 from pathlib import Path
@@ -62,7 +61,6 @@ from llama_index import (
     GPTTreeIndex,
     GoogleDocsReader,
     MockLLMPredictor,
-    OpenAIEmbedding,
     GithubRepositoryReader,
     MockEmbedding,
     download_loader,
@@ -81,10 +79,12 @@ from llama_index.readers.web import DEFAULT_WEBSITE_EXTRACTOR
 from llama_index.composability import ComposableGraph
 from llama_index.vector_stores import DocArrayInMemoryVectorStore
 
+from models.cached_embedding_model import CachedOpenAIEmbedding
 from models.embed_statics_model import EmbedStatics
 from models.openai_model import Models
 from models.check_model import UrlCheck
 from services.environment_service import EnvService
+from services.tokenizer_service import TOKENIZER
 from utils.safe_ctx_respond import safe_ctx_respond
 
 SHORT_TO_LONG_CACHE = {}
@@ -94,9 +94,9 @@ MarkdownReader = download_loader("MarkdownReader")
 RemoteReader = download_loader("RemoteReader")
 RemoteDepthReader = download_loader("RemoteDepthReader")
 
-embedding_model = OpenAIEmbedding()
+embedding_model = CachedOpenAIEmbedding()
 token_counter = TokenCountingHandler(
-    tokenizer=tiktoken.encoding_for_model("text-davinci-003").encode,
+    tokenizer=TOKENIZER.get_encoder("text-davinci-003").encode,
     verbose=False,
 )
 node_parser = SimpleNodeParser.from_defaults(
@@ -270,9 +270,9 @@ class IndexData:
 
 
 class Index_handler:
-    embedding_model = OpenAIEmbedding()
+    embedding_model = CachedOpenAIEmbedding()
     token_counter = TokenCountingHandler(
-        tokenizer=tiktoken.encoding_for_model("text-davinci-003").encode,
+        tokenizer=TOKENIZER.get_encoder("text-davinci-003").encode,
         verbose=False,
     )
     node_parser = SimpleNodeParser.from_defaults(
@@ -1224,13 +1224,13 @@ class Index_handler:
             for _index in index_objects:
                 documents.extend(await self.index_to_docs(_index, 256, 20))
 
-            embedding_model = OpenAIEmbedding()
+            embedding_model = CachedOpenAIEmbedding()
 
             llm_predictor_mock = MockLLMPredictor()
             embedding_model_mock = MockEmbedding(1536)
 
             token_counter_mock = TokenCountingHandler(
-                tokenizer=tiktoken.encoding_for_model("text-davinci-003").encode,
+                tokenizer=TOKENIZER.get_encoder("text-davinci-003").encode,
                 verbose=False,
             )
 
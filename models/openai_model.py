@@ -5,6 +5,7 @@ import math
 import os
 import re
 import tempfile
+import time
 import traceback
 import uuid
 from typing import Any, Tuple, List
@@ -15,7 +16,18 @@ import discord
 
 # An enum of two modes, TOP_P or TEMPERATURE
 import requests
+from models.user_model import ConversationHistory
+from services.batching_service import MicroBatcher
+from services.embedding_cache_service import EMBEDDING_CACHE
 from services.environment_service import EnvService
+from services.hedging_service import HedgePolicy
+from services.metrics_service import METRICS, endpoint_of, observe_openai_request
+from services.moderation_cache_service import ModerationVerdictCache, load_prefilter
+from services.rate_limit_service import RateLimiter
+from services.request_scheduler_service import Priority, RequestScheduler
+from services.response_cache_service import ResponseCache
+from services.single_flight_service import SingleFlight
+from services.tokenizer_service import TOKENIZER
 from PIL import Image
 from discord import File
 from sqlitedict import SqliteDict
@@ -185,8 +197,421 @@ class ModelLimits:
     MIN_PROMPT_MIN_LENGTH = 5
     MAX_PROMPT_MIN_LENGTH = 4000
 
+    MAX_EMBEDDING_INPUT_TOKENS = 8191
+
 
 class Model:
+    # A single pool of connections to the OpenAI API, shared by every Model instance. Reusing connections
+    # means that DNS resolution and the TCP/TLS handshakes aren't paid again on every request.
+    _session = None
+    # The event loop the session was created on, a session can't be used from any other loop
+    _session_loop = None
+
+    # The shortest time (in seconds) between two calls of the stream handler of a streamed request
+    STREAM_HANDLER_INTERVAL = 0.1
+
+    # The OpenAI API, or any server compatible with it
+    api_base = EnvService.get_openai_base_url()
+
+    # Requests wait on the client side for the rate limits reported by the API, instead of failing with a 429
+    rate_limiter = (
+        RateLimiter(EnvService.get_rate_limit_max_wait())
+        if EnvService.get_rate_limit_enabled()
+        else None
+    )
+
+    # Interactive requests get the free request slots ahead of background work like moderation and summaries
+    scheduler = RequestScheduler(
+        EnvService.get_max_concurrent_requests(),
+        EnvService.get_background_request_share(),
+    )
+
+    # Concurrent identical requests (moderation, embeddings, temperature 0 chat) share a single upstream call
+    single_flight = SingleFlight()
+
+    # Chat requests that are slow to come back get a backup copy sent alongside them, the first to finish is used
+    hedge_policy = HedgePolicy(
+        EnvService.get_hedge_requests(),
+        EnvService.get_hedge_max_rate(),
+        EnvService.get_hedge_min_delay(),
+    )
+
+    # Responses to deterministic internal requests are cached, so that repeated inputs skip the round trip
+    response_cache = ResponseCache(
+        EnvService.get_response_cache_max_entries(),
+        EnvService.get_response_cache_ttl(),
+        EnvService.get_response_cache_sites(),
+        spill_path=(
+            EnvService.save_path() / "response_cache.sqlite"
+            if EnvService.get_response_cache_spill()
+            else None
+        ),
+    )
+
+    # Moderation verdicts are remembered by normalized text, and a local blocklist decides obvious cases
+    moderation_verdicts = ModerationVerdictCache(
+        EnvService.get_moderation_verdict_cache_max_entries(),
+        EnvService.get_moderation_verdict_cache_ttl(),
+        prefilter=load_prefilter(EnvService.get_moderation_blocklist_file()),
+    )
+
+    @staticmethod
+    def get_session() -> aiohttp.ClientSession:
+        """Return the shared client session, creating it (and its connection pool) on first use, and again for
+        each new event loop"""
+        loop = asyncio.get_running_loop()
+        if (
+            Model._session is None
+            or Model._session.closed
+            or Model._session_loop is not loop
+        ):
+            connector = aiohttp.TCPConnector(
+                limit=EnvService.get_openai_max_connections(),
+                limit_per_host=EnvService.get_openai_max_connections_per_host(),
+                keepalive_timeout=EnvService.get_openai_keepalive_timeout(),
+                use_dns_cache=True,
+                ttl_dns_cache=EnvService.get_openai_dns_cache_ttl(),
+            )
+            Model._session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=300)
+            )
+            Model._session_loop = loop
+        return Model._session
+
+    @staticmethod
+    async def warm_up(connections=2):
+        """Open a few pooled connections to the API at startup so the first requests don't pay for the setup"""
+        session = Model.get_session()
+        headers = {"Authorization": f"Bearer {EnvService.get_openai_token()}"}
+
+        async def open_connection():
+            async with session.get(
+                f"{Model.api_base}/models",
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=15),
+            ) as resp:
+                await resp.read()
+
+        try:
+            await asyncio.gather(*[open_connection() for _ in range(connections)])
+            print("Warmed up the OpenAI connection pool")
+        except Exception:
+            traceback.print_exc()
+            print("Could not warm up the OpenAI connection pool")
+
+    @staticmethod
+    async def close_session():
+        """Close the shared client session and all of its pooled connections"""
+        if (
+            Model._session is not None
+            and not Model._session.closed
+            and Model._session_loop is asyncio.get_running_loop()
+        ):
+            await Model._session.close()
+        Model._session = None
+        Model._session_loop = None
+
+    async def _post_json(
+        self,
+        url,
+        headers,
+        payload=None,
+        data=None,
+        raise_for_status=False,
+        priority=Priority.INTERACTIVE,
+        usage_model=None,
+        dedupe=False,
+        cache_site=None,
+        hedge=False,
+        prompt_tokens=None,
+    ):
+        """POST a request through the shared connection pool and return the decoded JSON response.
+
+        When usage_model is given, the token usage of the response is accounted for under that model. With dedupe,
+        concurrent identical requests share a single upstream call, which is only accounted for once. Responses to
+        requests from a cache_site are cached, if caching is enabled for that site. With hedge, a backup copy of the
+        request is sent if it is slow to come back. prompt_tokens, when already known, saves counting the tokens of
+        the request again for the rate limiter.
+        """
+        send = functools.partial(
+            self._send_json,
+            url,
+            headers,
+            payload=payload,
+            data=data,
+            raise_for_status=raise_for_status,
+            priority=priority,
+            usage_model=usage_model,
+            prompt_tokens=prompt_tokens,
+        )
+        if hedge and Model.hedge_policy.enabled:
+            send = functools.partial(
+                Model.hedge_policy.run, send, kind=payload.get("model")
+            )
+        if dedupe and payload is not None:
+            key = SingleFlight.make_key(
+                url,
+                headers.get("Authorization"),
+                headers.get("OpenAI-Organization"),
+                payload,
+                usage_model,
+            )
+            send = functools.partial(Model.single_flight.do, key, send)
+        if cache_site:
+            return await Model.response_cache.cached(
+                cache_site, ResponseCache.make_key(cache_site, url, payload), send
+            )
+        return await send()
+
+    async def _send_json(
+        self,
+        url,
+        headers,
+        payload,
+        data,
+        raise_for_status,
+        priority,
+        usage_model,
+        prompt_tokens=None,
+    ):
+        session = Model.get_session()
+        endpoint = endpoint_of(url, Model.api_base)
+        metrics_model = (payload or {}).get("model") or usage_model
+        status = "error"
+        # The latency includes the time spent waiting for a request slot and the rate limit
+        started = time.monotonic()
+        try:
+            # The rate limit is waited for before a request slot is taken, so that a rate limited api key or model
+            # doesn't hold up the requests for the others
+            rate_limit_key = await self._acquire_rate_limit(
+                headers, payload, prompt_tokens
+            )
+            async with Model.scheduler.slot(priority):
+                sent = time.monotonic()
+                async with session.post(
+                    url,
+                    json=payload,
+                    data=data,
+                    headers=headers,
+                ) as resp:
+                    status = resp.status
+                    if Model.rate_limiter:
+                        Model.rate_limiter.update(rate_limit_key, resp.headers)
+                    if raise_for_status:
+                        resp.raise_for_status()
+                    response = await resp.json()
+                latency = time.monotonic() - started
+        except Exception:
+            observe_openai_request(endpoint, metrics_model, status)
+            raise
+
+        usage = response.get("usage") if isinstance(response, dict) else None
+        observe_openai_request(
+            endpoint,
+            metrics_model,
+            status,
+            latency=latency,
+            completion_tokens=(usage or {}).get("completion_tokens"),
+            generation_time=time.monotonic() - sent,
+        )
+
+        if usage_model:
+            await self.valid_text_request(response, model=usage_model, latency=latency)
+        return response
+
+    async def _acquire_rate_limit(self, headers, payload, prompt_tokens=None):
+        """Wait for the rate limits of the api key and model a request is for, returns the rate limit key"""
+        rate_limit_key = (
+            headers.get("Authorization"),
+            headers.get("OpenAI-Organization"),
+            payload.get("model") if payload else None,
+        )
+        if Model.rate_limiter:
+            waited = await Model.rate_limiter.acquire(
+                rate_limit_key,
+                await self.estimate_request_tokens(payload, prompt_tokens),
+            )
+            if waited:
+                print(f"Waited {waited:0.1f} seconds for the rate limit")
+        return rate_limit_key
+
+    async def estimate_request_tokens(self, payload, prompt_tokens=None):
+        """Estimate how many tokens a request counts against the rate limit, before it is sent"""
+        if not payload:
+            return 0
+        if prompt_tokens is not None:
+            return prompt_tokens + (payload.get("max_tokens") or 0)
+        texts = []
+        for message in payload.get("messages", []):
+            content = message.get("content")
+            if isinstance(content, list):
+                texts.extend(
+                    part.get("text", "") for part in content if isinstance(part, dict)
+                )
+            elif content:
+                texts.append(str(content))
+        inputs = payload.get("input")
+        if isinstance(inputs, list):
+            texts.extend(str(item) for item in inputs)
+        elif inputs:
+            texts.append(str(inputs))
+        # Big requests (like embedding batches) are counted off the event loop
+        return sum(await TOKENIZER.count_batch_async(texts)) + (
+            payload.get("max_tokens") or 0
+        )
+
+    async def _stream_chat_json(
+        self,
+        url,
+        headers,
+        payload,
+        stream_handler,
+        priority=Priority.INTERACTIVE,
+        prompt_tokens=None,
+    ):
+        """POST a streaming chat completion request and rebuild the regular chat completion response from the
+        server-sent events. stream_handler is called with the full text received so far, at most once every
+        STREAM_HANDLER_INTERVAL seconds while the stream is read, and with the whole text once it has ended.
+        """
+        payload = dict(payload, stream=True, stream_options={"include_usage": True})
+        session = Model.get_session()
+        endpoint = endpoint_of(url, Model.api_base)
+        started = time.monotonic()
+        try:
+            status, response, content, first_token = await self._read_chat_stream(
+                session, url, headers, payload, stream_handler, priority, prompt_tokens
+            )
+        except Exception:
+            observe_openai_request(endpoint, payload["model"], "error")
+            raise
+        if content:
+            # Only once the request slot is released, so rendering never holds up other requests
+            await stream_handler(content)
+        if content is None:
+            # The request failed, the response is the error
+            observe_openai_request(
+                endpoint, payload["model"], status, latency=time.monotonic() - started
+            )
+            return response
+
+        response["choices"][0]["message"]["content"] = content
+        if "usage" not in response:
+            # Some API compatible servers don't send usage for streams, estimate it instead.
+            if prompt_tokens is None:
+                prompt_tokens = sum(
+                    self.usage_service.count_tokens(str(message["content"]))
+                    for message in payload["messages"]
+                )
+            completion_tokens = self.usage_service.count_tokens(
+                response["choices"][0]["message"]["content"]
+            )
+            response["usage"] = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+
+        finished = time.monotonic()
+        if first_token is not None:
+            METRICS.observe(
+                "openai_time_to_first_token_seconds",
+                first_token - started,
+                (endpoint, payload["model"]),
+            )
+        observe_openai_request(
+            endpoint,
+            payload["model"],
+            200,
+            latency=finished - started,
+            completion_tokens=response["usage"].get("completion_tokens"),
+            generation_time=finished - first_token if first_token else None,
+        )
+        return response
+
+    async def _read_chat_stream(
+        self, session, url, headers, payload, stream_handler, priority, prompt_tokens
+    ):
+        """Send a streaming chat request and read its events. Returns the status, the response without its content,
+        the content and when the first delta arrived. If the request failed, the content is None and the response is
+        the error.
+
+        The stream handler is never awaited here, it runs in a task of its own so that a slow render doesn't hold
+        the request slot. A call is skipped while the previous one is still running, the next one gets all the text.
+        """
+        first_token = None
+        handler_task = None
+        last_handled = 0
+        try:
+            # Like _send_json, the rate limit is waited for before a request slot is taken
+            rate_limit_key = await self._acquire_rate_limit(
+                headers, payload, prompt_tokens
+            )
+            async with Model.scheduler.slot(priority):
+                async with session.post(url, json=payload, headers=headers) as resp:
+                    if Model.rate_limiter:
+                        Model.rate_limiter.update(rate_limit_key, resp.headers)
+                    if resp.status != 200:
+                        # Errors are not streamed, they come back as a regular json body
+                        return (
+                            resp.status,
+                            await resp.json(content_type=None),
+                            None,
+                            None,
+                        )
+
+                    response = {
+                        "object": "chat.completion",
+                        "model": payload["model"],
+                        "choices": [
+                            {
+                                "index": 0,
+                                "message": {"role": "assistant", "content": ""},
+                                "finish_reason": None,
+                            }
+                        ],
+                    }
+                    content = ""
+                    async for line in resp.content:
+                        line = line.decode("utf-8").strip()
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:") :].strip()
+                        if data == "[DONE]":
+                            break
+                        chunk = json.loads(data)
+                        if "error" in chunk:
+                            return "error", chunk, None, None
+                        response["id"] = chunk.get("id", response.get("id"))
+                        response["model"] = chunk.get("model", response["model"])
+                        # The final chunk carries the token usage for the whole request, and has no choices
+                        if chunk.get("usage"):
+                            response["usage"] = chunk["usage"]
+                        for choice in chunk.get("choices", []):
+                            if choice.get("finish_reason"):
+                                response["choices"][0]["finish_reason"] = choice[
+                                    "finish_reason"
+                                ]
+                            delta = choice.get("delta", {}).get("content")
+                            if delta:
+                                if first_token is None:
+                                    first_token = time.monotonic()
+                                content += delta
+                        if (
+                            content
+                            and (handler_task is None or handler_task.done())
+                            and time.monotonic() - last_handled
+                            >= self.STREAM_HANDLER_INTERVAL
+                        ):
+                            last_handled = time.monotonic()
+                            handler_task = asyncio.ensure_future(
+                                stream_handler(content)
+                            )
+        finally:
+            if handler_task:
+                await asyncio.gather(handler_task, return_exceptions=True)
+
+        return 200, response, content, first_token
+
     def set_initial_state(self, usage_service):
         self.mode = Mode.TEMPERATURE
         self.temp = (
@@ -340,11 +765,36 @@ class Model:
             "openai_key",
             "openai_organization",
             "IMAGE_SAVE_PATH",
+            "embedding_batcher",
+            "moderation_batcher",
         ]
 
         self.openai_key = EnvService.get_openai_token()
         self.openai_organization = EnvService.get_openai_organization()
 
+        # Concurrent embedding requests for the same api key are coalesced into a single array input request. The
+        # items are (text, tokens), the tokens are counted once by send_embedding_request
+        self.embedding_batcher = MicroBatcher(
+            lambda api_key, items: self.send_embedding_batch_request(
+                [text for text, _ in items],
+                custom_api_key=api_key,
+                prompt_tokens=sum(tokens for _, tokens in items),
+            ),
+            max_batch_size=EnvService.get_embedding_batch_size(),
+            max_wait=EnvService.get_embedding_batch_wait(),
+            max_batch_weight=EnvService.get_embedding_batch_max_tokens(),
+            weigh=lambda item: item[1],
+        )
+
+        # Background moderation of messages from every guild is coalesced into array input requests
+        self.moderation_batcher = MicroBatcher(
+            lambda api_key, texts: self.send_moderations_batch_request(
+                texts, custom_api_key=api_key
+            ),
+            max_batch_size=EnvService.get_moderation_batch_size(),
+            max_wait=EnvService.get_moderation_batch_max_latency(),
+        )
+
     # Use the @property and @setter decorators for all the self fields to provide value checking
 
     @property
@@ -674,11 +1124,16 @@ class Model:
             f"{details['exception'].args[0]}"
         )
 
-    async def valid_text_request(self, response, model=None):
+    async def valid_text_request(self, response, model=None, latency=None):
         try:
             tokens_used = int(response["usage"]["total_tokens"])
             await self.usage_service.update_usage(
-                tokens_used, await self.usage_service.get_cost_name(model)
+                tokens_used,
+                await self.usage_service.get_cost_name(model),
+                model=model,
+                prompt_tokens=response["usage"].get("prompt_tokens"),
+                completion_tokens=response["usage"].get("completion_tokens"),
+                latency=latency,
             )
         except Exception as e:
             traceback.print_exc()
@@ -699,32 +1154,64 @@ class Model:
         on_backoff=backoff_handler_http,
     )
     async def send_embedding_request(self, text, custom_api_key=None):
-        async with aiohttp.ClientSession(
-            raise_for_status=True, timeout=aiohttp.ClientTimeout(total=300)
-        ) as session:
-            payload = {
-                "model": Models.EMBEDDINGS,
-                "input": text,
-            }
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.openai_key if not custom_api_key else custom_api_key}",
-            }
-            self.use_org = True if "true" in str(self.use_org).lower() else False
-            if self.use_org:
-                if self.openai_organization:
-                    headers["OpenAI-Organization"] = self.openai_organization
-            async with session.post(
-                "https://api.openai.com/v1/embeddings", json=payload, headers=headers
-            ) as resp:
-                response = await resp.json()
+        if EMBEDDING_CACHE:
+            embedding = EMBEDDING_CACHE.get(Models.EMBEDDINGS, text)
+            if embedding:
+                return embedding
+
+        # Counted once, for the limit, the batch weight and the rate limit
+        tokens = self.usage_service.count_tokens(text)
+        # Inputs that are over the limit on their own are sent alone, so that they can't fail a whole batch
+        if tokens > ModelLimits.MAX_EMBEDDING_INPUT_TOKENS:
+            embeddings = await self.send_embedding_batch_request(
+                [text], custom_api_key=custom_api_key, prompt_tokens=tokens
+            )
+            embedding = embeddings[0]
+        else:
+            api_key = custom_api_key if custom_api_key else self.openai_key
+            # The same text requested by several callers at once is only embedded once
+            embedding = await Model.single_flight.do(
+                SingleFlight.make_key("embedding", api_key, text),
+                lambda: self.embedding_batcher.submit((text, tokens), key=api_key),
+            )
+
+        if EMBEDDING_CACHE:
+            EMBEDDING_CACHE.put(Models.EMBEDDINGS, text, embedding)
+        return embedding
 
-                try:
-                    return response["data"][0]["embedding"]
-                except Exception:
-                    print(response)
-                    traceback.print_exc()
-                    return
+    async def send_embedding_batch_request(
+        self, texts, custom_api_key=None, prompt_tokens=None
+    ):
+        """Create embeddings for a list of texts with a single request, returns one embedding per text.
+        prompt_tokens is the number of tokens of the texts, if it is already known
+        """
+        payload = {
+            "model": Models.EMBEDDINGS,
+            "input": texts,
+        }
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.openai_key if not custom_api_key else custom_api_key}",
+        }
+        self.use_org = True if "true" in str(self.use_org).lower() else False
+        if self.use_org:
+            if self.openai_organization:
+                headers["OpenAI-Organization"] = self.openai_organization
+        response = await self._post_json(
+            f"{Model.api_base}/embeddings",
+            headers,
+            payload=payload,
+            raise_for_status=True,
+            prompt_tokens=prompt_tokens,
+        )
+
+        try:
+            data = sorted(response["data"], key=lambda item: item["index"])
+            return [item["embedding"] for item in data]
+        except Exception:
+            print(response)
+            traceback.print_exc()
+            return [None] * len(texts)
 
     @backoff.on_exception(
         backoff.expo,
@@ -748,41 +1235,37 @@ class Model:
         print(f"Overrides -> temp:{temp_override}, top_p:{top_p_override}")
 
         # The /v1/edits endpoint was removed by OpenAI. Use chat completions instead.
-        async with aiohttp.ClientSession(
-            raise_for_status=False, timeout=aiohttp.ClientTimeout(total=300)
-        ) as session:
-            messages = [
-                {
-                    "role": "system",
-                    "content": f"You are a helpful assistant that edits text according to instructions. Apply the following instruction to the given text and return only the edited result.",
-                },
-                {
-                    "role": "user",
-                    "content": f"Instruction: {instruction}\n\nText to edit: {'' if text is None else text}",
-                },
-            ]
-            payload = {
-                "model": Models.GPT_4_OMEGA_MINI,
-                "messages": messages,
-                "temperature": self.temp if temp_override is None else temp_override,
-                "top_p": self.top_p if top_p_override is None else top_p_override,
-            }
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.openai_key if not custom_api_key else custom_api_key}",
-            }
-            self.use_org = True if "true" in str(self.use_org).lower() else False
-            if self.use_org:
-                if self.openai_organization:
-                    headers["OpenAI-Organization"] = self.openai_organization
-            async with session.post(
-                "https://api.openai.com/v1/chat/completions",
-                json=payload,
-                headers=headers,
-            ) as resp:
-                response = await resp.json()
-                await self.valid_text_request(response, model=Models.GPT_4_OMEGA_MINI)
-                return response
+        messages = [
+            {
+                "role": "system",
+                "content": f"You are a helpful assistant that edits text according to instructions. Apply the following instruction to the given text and return only the edited result.",
+            },
+            {
+                "role": "user",
+                "content": f"Instruction: {instruction}\n\nText to edit: {'' if text is None else text}",
+            },
+        ]
+        payload = {
+            "model": Models.GPT_4_OMEGA_MINI,
+            "messages": messages,
+            "temperature": self.temp if temp_override is None else temp_override,
+            "top_p": self.top_p if top_p_override is None else top_p_override,
+        }
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.openai_key if not custom_api_key else custom_api_key}",
+        }
+        self.use_org = True if "true" in str(self.use_org).lower() else False
+        if self.use_org:
+            if self.openai_organization:
+                headers["OpenAI-Organization"] = self.openai_organization
+        response = await self._post_json(
+            f"{Model.api_base}/chat/completions",
+            headers,
+            payload=payload,
+            usage_model=Models.GPT_4_OMEGA_MINI,
+        )
+        return response
 
     @backoff.on_exception(
         backoff.expo,
@@ -792,20 +1275,58 @@ class Model:
         max_tries=6,
         on_backoff=backoff_handler_http,
     )
-    async def send_moderations_request(self, text):
-        # Use aiohttp to send the above request:
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.openai_key}",
-            }
-            payload = {"input": text}
-            async with session.post(
-                "https://api.openai.com/v1/moderations",
-                headers=headers,
-                json=payload,
-            ) as response:
-                return await response.json()
+    async def send_moderations_request(self, text, priority=Priority.INTERACTIVE):
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.openai_key}",
+        }
+        payload = {"input": text}
+        return await Model.moderation_verdicts.moderate(
+            text,
+            lambda: self._post_json(
+                f"{Model.api_base}/moderations",
+                headers,
+                payload=payload,
+                raise_for_status=True,
+                priority=priority,
+                dedupe=True,
+            ),
+        )
+
+    async def send_batched_moderations_request(self, text, custom_api_key=None):
+        """Moderate text as part of a batch with the other moderation requests made around the same time. The
+        response has the same shape as the one of send_moderations_request, with a single result.
+        """
+        api_key = custom_api_key if custom_api_key else self.openai_key
+        # Shares its verdicts with send_moderations_request
+        return await Model.moderation_verdicts.moderate(
+            text, lambda: self.moderation_batcher.submit(text, key=api_key)
+        )
+
+    @backoff.on_exception(
+        backoff.expo,
+        aiohttp.ClientResponseError,
+        factor=3,
+        base=5,
+        max_tries=6,
+        on_backoff=backoff_handler_http,
+    )
+    async def send_moderations_batch_request(self, texts, custom_api_key=None):
+        """Moderate a list of texts with a single request, returns a response with a single result for each text.
+        Retried like send_moderations_request, if it still fails every text of the batch gets the error.
+        """
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.openai_key if not custom_api_key else custom_api_key}",
+        }
+        response = await self._post_json(
+            f"{Model.api_base}/moderations",
+            headers,
+            payload={"input": texts},
+            raise_for_status=True,
+            priority=Priority.BACKGROUND,
+        )
+        return [dict(response, results=[result]) for result in response["results"]]
 
     @backoff.on_exception(
         backoff.expo,
@@ -838,40 +1359,34 @@ class Model:
             }
         )
 
-        async with aiohttp.ClientSession(
-            raise_for_status=False, timeout=aiohttp.ClientTimeout(total=300)
-        ) as session:
-            payload = {
-                "model": self.model if self.model is not None else Models.GPT4_32,
-                "messages": messages,
-                "temperature": self.temp,
-                "top_p": self.top_p,
-                "presence_penalty": self.presence_penalty,
-                "frequency_penalty": self.frequency_penalty,
-            }
-            headers = {
-                "Authorization": f"Bearer {self.openai_key if not custom_api_key else custom_api_key}"
-            }
-            self.use_org = True if "true" in str(self.use_org).lower() else False
-            if self.use_org:
-                if self.openai_organization:
-                    headers["OpenAI-Organization"] = self.openai_organization
-
-            async with session.post(
-                "https://api.openai.com/v1/chat/completions",
-                json=payload,
-                headers=headers,
-            ) as resp:
-                response = await resp.json()
-                # print(f"Payload -> {payload}")
-                # Parse the total tokens used for this request and response pair from the response
-                await self.valid_text_request(
-                    response,
-                    model=self.model if self.model is not None else Models.GPT4_32,
-                )
-                print(f"Summary response -> {response}")
+        payload = {
+            "model": self.model if self.model is not None else Models.GPT4_32,
+            "messages": messages,
+            "temperature": self.temp,
+            "top_p": self.top_p,
+            "presence_penalty": self.presence_penalty,
+            "frequency_penalty": self.frequency_penalty,
+        }
+        headers = {
+            "Authorization": f"Bearer {self.openai_key if not custom_api_key else custom_api_key}"
+        }
+        self.use_org = True if "true" in str(self.use_org).lower() else False
+        if self.use_org:
+            if self.openai_organization:
+                headers["OpenAI-Organization"] = self.openai_organization
+
+        response = await self._post_json(
+            f"{Model.api_base}/chat/completions",
+            headers,
+            payload=payload,
+            priority=Priority.BACKGROUND,
+            # Parse the total tokens used for this request and response pair from the response
+            usage_model=self.model if self.model is not None else Models.GPT4_32,
+        )
+        # print(f"Payload -> {payload}")
+        print(f"Summary response -> {response}")
 
-                return response
+        return response
 
     @backoff.on_exception(
         backoff.expo,
@@ -893,33 +1408,34 @@ class Model:
         print(f"Language detection request for {text}")
 
         # Use chat completions instead of the deprecated /v1/completions endpoint
-        async with aiohttp.ClientSession(raise_for_status=False) as session:
-            messages = [
-                {"role": "system", "content": pretext},
-                {"role": "user", "content": text},
-            ]
-            payload = {
-                "model": Models.GPT_4_OMEGA_MINI,
-                "messages": messages,
-                "temperature": 0,
-                "top_p": 1,
-            }
-            headers = {"Authorization": f"Bearer {self.openai_key}"}
-            self.use_org = True if "true" in str(self.use_org).lower() else False
-            if self.use_org:
-                if self.openai_organization:
-                    headers["OpenAI-Organization"] = self.openai_organization
-            async with session.post(
-                "https://api.openai.com/v1/chat/completions",
-                json=payload,
-                headers=headers,
-            ) as resp:
-                response = await resp.json()
+        messages = [
+            {"role": "system", "content": pretext},
+            {"role": "user", "content": text},
+        ]
+        payload = {
+            "model": Models.GPT_4_OMEGA_MINI,
+            "messages": messages,
+            "temperature": 0,
+            "top_p": 1,
+        }
+        headers = {"Authorization": f"Bearer {self.openai_key}"}
+        self.use_org = True if "true" in str(self.use_org).lower() else False
+        if self.use_org:
+            if self.openai_organization:
+                headers["OpenAI-Organization"] = self.openai_organization
+        response = await self._post_json(
+            f"{Model.api_base}/chat/completions",
+            headers,
+            payload=payload,
+            priority=Priority.BACKGROUND,
+            usage_model=Models.GPT_4_OMEGA_MINI,
+            dedupe=True,
+            cache_site="language_detect",
+        )
 
-                await self.valid_text_request(response, model=Models.GPT_4_OMEGA_MINI)
-                print(f"Response -> {response}")
+        print(f"Response -> {response}")
 
-                return response
+        return response
 
     def cleanse_username(self, text):
         text = text.strip()
@@ -929,6 +1445,27 @@ class Model:
         text = re.sub(r"[^a-zA-Z0-9]", "_", text)
         return text
 
+    def get_chat_message(self, item, bot_name, vision=False):
+        """The chat completions message for a conversation item, built the first time and reused after that"""
+        key = (bot_name, vision)
+        message = item.get_chat_message(key)
+        if message is not None:
+            return message
+
+        role, name, content = item.get_structured(bot_name)
+        message = {"role": role, "content": content}
+        if role != "system":
+            message["name"] = self.cleanse_username(
+                name if role == "user" else bot_name
+            )
+            if vision:
+                message["content"] = [{"type": "text", "text": content}] + [
+                    {"type": "image_url", "image_url": {"url": url, "detail": "high"}}
+                    for url in item.image_urls or []
+                ]
+        item.set_chat_message(key, message)
+        return message
+
     @backoff.on_exception(
         backoff.expo,
         ValueError,
@@ -953,6 +1490,8 @@ class Model:
         custom_api_key=None,
         system_prompt_override=None,
         respond_json=None,
+        stream_handler=None,
+        priority=Priority.INTERACTIVE,
     ) -> Tuple[
         dict, bool
     ]:  # The response, and a boolean indicating whether or not the context limit was reached.
@@ -960,11 +1499,19 @@ class Model:
         model_selection = self.model if not model else model
         print("The model selection is " + model_selection)
 
-        # Clean up the bot name
-        bot_name_clean = self.cleanse_username(bot_name)
+        vision = "-vision" in model_selection
+
+        # A conversation's history keeps a running count of its tokens, so the request doesn't need counting again
+        prompt_tokens = (
+            prompt_history.token_count
+            if isinstance(prompt_history, ConversationHistory)
+            and not system_prompt_override
+            else None
+        )
 
         # Format the request body into the messages format that the API is expecting
         #   "messages": [{"role": "user", "content": "Hello!"}]
+        # Each item keeps the message built for it, so only new items need any work
         messages = []
         for number, message in enumerate(prompt_history):
             if number == 0:
@@ -995,137 +1542,87 @@ class Model:
                     )
                     continue
 
-            try:
-                if (
-                    message.text.strip()
-                    .lower()
-                    .startswith("this conversation has some context from earlier")
-                ):
-                    raise Exception("This is a context message")
-
-                if message.text.startswith(f"\n{bot_name}"):
-                    role = "assistant"
-                    text = message.text.replace(bot_name, "")
-                    text = text.replace("<|endofstatement|>", "")
-                else:
-                    role = "user"
-                    username = re.search(r"(?<=\n)(.*?)(?=:)", message.text).group()
-                    username_clean = self.cleanse_username(username)
-                    text = message.text.replace(f"{username}:", "")
-                    # Strip whitespace just from the right side of the string
-                    text = text.rstrip()
-                    text = text.replace("<|endofstatement|>", "")
-
-                if "-vision" not in model_selection:
-                    messages.append(
-                        {
-                            "role": role,
-                            "name": (
-                                username_clean if role == "user" else bot_name_clean
-                            ),
-                            "content": text,
-                        }
-                    )
-
-                else:
-                    if len(message.image_urls) > 0:
-                        messages.append(
-                            {
-                                "role": role,
-                                "name": (
-                                    username_clean if role == "user" else bot_name_clean
-                                ),
-                                "content": [
-                                    {"type": "text", "text": text},
-                                ],
-                            }
-                        )
-                        for image_url in message.image_urls:
-                            image_info = {
-                                "type": "image_url",
-                                "image_url": {"url": image_url, "detail": "high"},
-                            }
-                            messages[-1]["content"].append(image_info)
-                    else:
-                        messages.append(
-                            {
-                                "role": role,
-                                "name": (
-                                    username_clean if role == "user" else bot_name_clean
-                                ),
-                                "content": [
-                                    {"type": "text", "text": text},
-                                ],
-                            }
-                        )
-            except Exception:
-                text = message.text.replace("<|endofstatement|>", "")
-                messages.append({"role": "system", "content": text})
+            messages.append(self.get_chat_message(message, bot_name, vision))
 
         print(f"Messages -> {messages}")
-        async with aiohttp.ClientSession(
-            raise_for_status=False, timeout=aiohttp.ClientTimeout(total=300)
-        ) as session:
-            payload = {
-                "model": model_selection,
-                "messages": messages,
-                "stop": "" if stop is None else stop,
-                "temperature": self.temp if temp_override is None else temp_override,
-                "top_p": self.top_p if top_p_override is None else top_p_override,
-                "presence_penalty": (
-                    self.presence_penalty
-                    if presence_penalty_override is None
-                    else presence_penalty_override
-                ),
-                "frequency_penalty": (
-                    self.frequency_penalty
-                    if frequency_penalty_override is None
-                    else frequency_penalty_override
-                ),
-            }
-            if "-preview" in model_selection:
-                payload["max_tokens"] = (
-                    4096  # TODO Not sure if this needs to be subtracted from a token count..
-                )
-            if respond_json:
-                # payload["response_format"] = { "type": "json_object" }
-                # TODO The above needs to be fixed, doesn't work for some reason?
-                pass
+        payload = {
+            "model": model_selection,
+            "messages": messages,
+            "stop": "" if stop is None else stop,
+            "temperature": self.temp if temp_override is None else temp_override,
+            "top_p": self.top_p if top_p_override is None else top_p_override,
+            "presence_penalty": (
+                self.presence_penalty
+                if presence_penalty_override is None
+                else presence_penalty_override
+            ),
+            "frequency_penalty": (
+                self.frequency_penalty
+                if frequency_penalty_override is None
+                else frequency_penalty_override
+            ),
+        }
+        if "-preview" in model_selection:
+            payload["max_tokens"] = (
+                4096  # TODO Not sure if this needs to be subtracted from a token count..
+            )
+        if respond_json:
+            # payload["response_format"] = { "type": "json_object" }
+            # TODO The above needs to be fixed, doesn't work for some reason?
+            pass
 
-            headers = {
-                "Authorization": f"Bearer {self.openai_key if not custom_api_key else custom_api_key}"
-            }
-            self.use_org = True if "true" in str(self.use_org).lower() else False
-            if self.use_org:
-                if self.openai_organization:
-                    headers["OpenAI-Organization"] = self.openai_organization
+        headers = {
+            "Authorization": f"Bearer {self.openai_key if not custom_api_key else custom_api_key}"
+        }
+        self.use_org = True if "true" in str(self.use_org).lower() else False
+        if self.use_org:
+            if self.openai_organization:
+                headers["OpenAI-Organization"] = self.openai_organization
+
+        if stream_handler:
+            started = time.monotonic()
+            response = await self._stream_chat_json(
+                f"{Model.api_base}/chat/completions",
+                headers,
+                payload,
+                stream_handler,
+                priority=priority,
+                prompt_tokens=prompt_tokens,
+            )
+            # Parse the total tokens used for this request and response pair from the response
+            await self.valid_text_request(
+                response,
+                model=self.model if model is None else model,
+                latency=time.monotonic() - started,
+            )
+        else:
+            # Identical deterministic requests that are in flight at the same time are only sent once
+            response = await self._post_json(
+                f"{Model.api_base}/chat/completions",
+                headers,
+                payload=payload,
+                priority=priority,
+                usage_model=self.model if model is None else model,
+                dedupe=payload["temperature"] == 0,
+                hedge=True,
+                prompt_tokens=prompt_tokens,
+            )
+        # print(f"Payload -> {payload}")
+        print(f"Response -> {response}")
+
+        # Temporary until we can ensure json response via the API, for some reason upstream pydantic complains when
+        # we pass response_format in the request..
+        if respond_json:
+            response_text = response["choices"][0]["message"]["content"].strip()
+            response_text = response_text.replace("```json", "")
+            response_text = response_text.replace("```", "")
+            try:
+                response_text = json.loads(response_text)
+                return response_text
+            except Exception:
+                raise ValueError("Could not decode JSON response from the API")
 
-            async with session.post(
-                "https://api.openai.com/v1/chat/completions",
-                json=payload,
-                headers=headers,
-            ) as resp:
-                response = await resp.json()
-                # print(f"Payload -> {payload}")
-                # Parse the total tokens used for this request and response pair from the response
-                await self.valid_text_request(
-                    response, model=self.model if model is None else model
-                )
-                print(f"Response -> {response}")
-
-                # Temporary until we can ensure json response via the API, for some reason upstream pydantic complains when
-                # we pass response_format in the request..
-                if respond_json:
-                    response_text = response["choices"][0]["message"]["content"].strip()
-                    response_text = response_text.replace("```json", "")
-                    response_text = response_text.replace("```", "")
-                    try:
-                        response_text = json.loads(response_text)
-                        return response_text
-                    except Exception:
-                        raise ValueError("Could not decode JSON response from the API")
-
-                return response
+        return response
 
     @backoff.on_exception(
         backoff.expo,
@@ -1141,38 +1638,37 @@ class Model:
         temperature_override=None,
         custom_api_key=None,
     ):
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            data = aiohttp.FormData()
-            data.add_field("model", "whisper-1")
-            print("audio." + file.filename.split(".")[-1])
-            # TODO: make async
-            data.add_field(
-                "file",
-                file.read() if isinstance(file, discord.Attachment) else file.fp.read(),
-                filename=(
-                    "audio." + file.filename.split(".")[-1]
-                    if isinstance(file, discord.Attachment)
-                    else "audio.mp4"
-                ),
-                content_type=(
-                    file.content_type
-                    if isinstance(file, discord.Attachment)
-                    else "video/mp4"
-                ),
-            )
+        data = aiohttp.FormData()
+        data.add_field("model", "whisper-1")
+        print("audio." + file.filename.split(".")[-1])
+        # TODO: make async
+        data.add_field(
+            "file",
+            file.read() if isinstance(file, discord.Attachment) else file.fp.read(),
+            filename=(
+                "audio." + file.filename.split(".")[-1]
+                if isinstance(file, discord.Attachment)
+                else "audio.mp4"
+            ),
+            content_type=(
+                file.content_type
+                if isinstance(file, discord.Attachment)
+                else "video/mp4"
+            ),
+        )
 
-            if temperature_override:
-                data.add_field("temperature", temperature_override)
+        if temperature_override:
+            data.add_field("temperature", temperature_override)
 
-            async with session.post(
-                "https://api.openai.com/v1/audio/transcriptions",
-                headers={
-                    "Authorization": f"Bearer {self.openai_key if not custom_api_key else custom_api_key}",
-                },
-                data=data,
-            ) as resp:
-                response = await resp.json()
-                return response["text"]
+        response = await self._post_json(
+            f"{Model.api_base}/audio/transcriptions",
+            {
+                "Authorization": f"Bearer {self.openai_key if not custom_api_key else custom_api_key}",
+            },
+            data=data,
+            raise_for_status=True,
+        )
+        return response["text"]
 
     @backoff.on_exception(
         backoff.expo,
@@ -1197,6 +1693,7 @@ class Model:
         custom_api_key=None,
         is_chatgpt_request=False,
         system_instruction=None,
+        priority=Priority.INTERACTIVE,
     ):  # The response, and a boolean indicating whether or not the context limit was reached.
         # Validate that  all the parameters are in a good state before we send the request
 
@@ -1236,73 +1733,71 @@ class Model:
             else:
                 messages = [{"role": "user", "content": prompt}]
 
-        async with aiohttp.ClientSession(
-            raise_for_status=False, timeout=aiohttp.ClientTimeout(total=300)
-        ) as session:
-            model_selection = self.model if not model else model
-            payload = {
-                "model": model_selection,
-                "messages": messages,
-                "stop": "" if stop is None else stop,
-                "temperature": (self.temp if temp_override is None else temp_override),
-                "top_p": self.top_p if top_p_override is None else top_p_override,
-                "presence_penalty": (
-                    self.presence_penalty
-                    if presence_penalty_override is None
-                    else presence_penalty_override
-                ),
-                "frequency_penalty": (
-                    self.frequency_penalty
-                    if frequency_penalty_override is None
-                    else frequency_penalty_override
-                ),
-            }
-            if "preview" in model_selection:
-                payload["max_tokens"] = 4096
+        model_selection = self.model if not model else model
+        payload = {
+            "model": model_selection,
+            "messages": messages,
+            "stop": "" if stop is None else stop,
+            "temperature": (self.temp if temp_override is None else temp_override),
+            "top_p": self.top_p if top_p_override is None else top_p_override,
+            "presence_penalty": (
+                self.presence_penalty
+                if presence_penalty_override is None
+                else presence_penalty_override
+            ),
+            "frequency_penalty": (
+                self.frequency_penalty
+                if frequency_penalty_override is None
+                else frequency_penalty_override
+            ),
+        }
+        if "preview" in model_selection:
+            payload["max_tokens"] = 4096
 
-            headers = {
-                "Authorization": f"Bearer {self.openai_key if not custom_api_key else custom_api_key}"
-            }
-            self.use_org = True if "true" in str(self.use_org).lower() else False
-            if self.use_org:
-                if self.openai_organization:
-                    headers["OpenAI-Organization"] = self.openai_organization
-            async with session.post(
-                "https://api.openai.com/v1/chat/completions",
-                json=payload,
-                headers=headers,
-            ) as resp:
-                response = await resp.json()
-                await self.valid_text_request(
-                    response, model=self.model if model is None else model
-                )
-                print(f"Response -> {response}")
+        headers = {
+            "Authorization": f"Bearer {self.openai_key if not custom_api_key else custom_api_key}"
+        }
+        self.use_org = True if "true" in str(self.use_org).lower() else False
+        if self.use_org:
+            if self.openai_organization:
+                headers["OpenAI-Organization"] = self.openai_organization
+        response = await self._post_json(
+            f"{Model.api_base}/chat/completions",
+            headers,
+            payload=payload,
+            priority=priority,
+            usage_model=self.model if model is None else model,
+            # Identical deterministic requests that are in flight at the same time are only sent once
+            dedupe=payload["temperature"] == 0,
+            hedge=True,
+        )
+        print(f"Response -> {response}")
 
-                return response
+        return response
 
     @staticmethod
     async def send_test_request(api_key):
-        async with aiohttp.ClientSession() as session:
-            payload = {
-                "model": Models.LOW_USAGE_MODEL,
-                "messages": [{"role": "user", "content": "test."}],
-                "temperature": 1,
-                "top_p": 1,
-                "max_tokens": 10,
-            }
-            headers = {"Authorization": f"Bearer {api_key}"}
-            async with session.post(
-                "https://api.openai.com/v1/chat/completions",
-                json=payload,
-                headers=headers,
-            ) as resp:
-                response = await resp.json()
-                try:
-                    int(response["usage"]["total_tokens"])
-                except:
-                    raise ValueError(str(response["error"]["message"]))
+        session = Model.get_session()
+        payload = {
+            "model": Models.LOW_USAGE_MODEL,
+            "messages": [{"role": "user", "content": "test."}],
+            "temperature": 1,
+            "top_p": 1,
+            "max_tokens": 10,
+        }
+        headers = {"Authorization": f"Bearer {api_key}"}
+        async with session.post(
+            f"{Model.api_base}/chat/completions",
+            json=payload,
+            headers=headers,
+        ) as resp:
+            response = await resp.json()
+            try:
+                int(response["usage"]["total_tokens"])
+            except:
+                raise ValueError(str(response["error"]["message"]))
 
-                return response
+            return response
 
     async def save_image_urls_and_return(self, image_urls, ctx):
         # For each image url, open it as an image object using PIL
@@ -1411,11 +1906,10 @@ class Model:
 
         return discord.File(temp_file.name), image_urls
 
-    async def make_image_request_individual(
-        self, session, url, json_payload, headers
-    ) -> dict:
-        async with session.post(url, json=json_payload, headers=headers) as resp:
-            return await resp.json()
+    async def make_image_request_individual(self, url, json_payload, headers) -> dict:
+        return await self._post_json(
+            url, headers, payload=json_payload, raise_for_status=True
+        )
 
     @backoff.on_exception(
         backoff.expo,
@@ -1455,28 +1949,23 @@ class Model:
         if self.use_org and self.openai_organization:
             headers["OpenAI-Organization"] = self.openai_organization
 
-        # Setup the client session outside of the loop
-        async with aiohttp.ClientSession(
-            raise_for_status=True, timeout=aiohttp.ClientTimeout(total=300)
-        ) as session:
-            # Create a coroutine for each image request and store it in the tasks list
-            for _ in range(self.num_images):
-                task = self.make_image_request_individual(
-                    session,
-                    "https://api.openai.com/v1/images/generations",
-                    payload,
-                    headers,
-                )
-                tasks.append(task)
+        # Create a coroutine for each image request and store it in the tasks list
+        for _ in range(self.num_images):
+            task = self.make_image_request_individual(
+                f"{Model.api_base}/images/generations",
+                payload,
+                headers,
+            )
+            tasks.append(task)
 
-            # Run all tasks in parallel and wait for them to complete
-            responses = await asyncio.gather(*tasks)
+        # Run all tasks in parallel and wait for them to complete
+        responses = await asyncio.gather(*tasks)
 
-            # Process the results
-            for response in responses:
-                print(response)
-                for result in response["data"]:
-                    image_urls.append(result["url"])
+        # Process the results
+        for response in responses:
+            print(response)
+            for result in response["data"]:
+                image_urls.append(result["url"])
 
         # Now all the requests are done, we can save the URLs
         return await self.save_image_urls_and_return(image_urls, ctx)
@@ -1513,28 +2002,23 @@ class Model:
         if self.use_org and self.openai_organization:
             headers["OpenAI-Organization"] = self.openai_organization
 
-        # Setup the client session outside of the loop
-        async with aiohttp.ClientSession(
-            raise_for_status=True, timeout=aiohttp.ClientTimeout(total=300)
-        ) as session:
-            # Create a coroutine for each image request and store it in the tasks list
-            for _ in range(num_images):
-                task = self.make_image_request_individual(
-                    session,
-                    "https://api.openai.com/v1/images/generations",
-                    payload,
-                    headers,
-                )
-                tasks.append(task)
+        # Create a coroutine for each image request and store it in the tasks list
+        for _ in range(num_images):
+            task = self.make_image_request_individual(
+                f"{Model.api_base}/images/generations",
+                payload,
+                headers,
+            )
+            tasks.append(task)
 
-            # Run all tasks in parallel and wait for them to complete
-            responses = await asyncio.gather(*tasks)
+        # Run all tasks in parallel and wait for them to complete
+        responses = await asyncio.gather(*tasks)
 
-            # Process the results
-            for response in responses:
-                print(response)
-                for result in response["data"]:
-                    image_urls.append(result["url"])
+        # Process the results
+        for response in responses:
+            print(response)
+            for result in response["data"]:
+                image_urls.append(result["url"])
 
         # Now all the requests are done, we can save the URLs
         return image_urls
@@ -1574,36 +2058,30 @@ class Model:
                 if self.openai_organization:
                     headers["OpenAI-Organization"] = self.openai_organization
 
-            async with aiohttp.ClientSession(
-                raise_for_status=True, timeout=aiohttp.ClientTimeout(total=300)
-            ) as session:
-                async with session.post(
-                    "https://api.openai.com/v1/images/generations",
-                    json=payload,
-                    headers=headers,
-                ) as resp:
-                    response = await resp.json()
+            response = await self._post_json(
+                f"{Model.api_base}/images/generations",
+                headers,
+                payload=payload,
+                raise_for_status=True,
+            )
 
         else:
-            async with aiohttp.ClientSession(
-                raise_for_status=True, timeout=aiohttp.ClientTimeout(total=300)
-            ) as session:
-                data = aiohttp.FormData()
-                data.add_field("n", str(self.num_images))
-                data.add_field("size", self.image_size)
-                with open(vary, "rb") as f:
-                    data.add_field(
-                        "image", f, filename="file.png", content_type="image/png"
-                    )
+            data = aiohttp.FormData()
+            data.add_field("n", str(self.num_images))
+            data.add_field("size", self.image_size)
+            with open(vary, "rb") as f:
+                data.add_field(
+                    "image", f, filename="file.png", content_type="image/png"
+                )
 
-                    async with session.post(
-                        "https://api.openai.com/v1/images/variations",
-                        headers={
-                            "Authorization": f"Bearer {self.openai_key if not custom_api_key else custom_api_key}",
-                        },
-                        data=data,
-                    ) as resp:
-                        response = await resp.json()
+                response = await self._post_json(
+                    f"{Model.api_base}/images/variations",
+                    {
+                        "Authorization": f"Bearer {self.openai_key if not custom_api_key else custom_api_key}",
+                    },
+                    data=data,
+                    raise_for_status=True,
+                )
 
         image_urls = []
         for result in response["data"]:
@@ -10,7 +10,6 @@ from pathlib import Path
 import discord
 import aiohttp
 import openai
-import tiktoken
 from langchain.chat_models import ChatOpenAI
 from llama_index import (
     QuestionAnswerPrompt,
@@ -18,7 +17,6 @@ from llama_index import (
     BeautifulSoupWebReader,
     Document,
     LLMPredictor,
-    OpenAIEmbedding,
     SimpleDirectoryReader,
     MockEmbedding,
     ServiceContext,
@@ -33,8 +31,11 @@ from llama_index.prompts.chat_prompts import CHAT_REFINE_PROMPT
 from llama_index.readers.web import DEFAULT_WEBSITE_EXTRACTOR
 from langchain.llms import OpenAI
 
-from models.openai_model import Models
+from models.cached_embedding_model import CachedOpenAIEmbedding
+from models.openai_model import Model, Models
 from services.environment_service import EnvService
+from services.response_cache_service import ResponseCache
+from services.tokenizer_service import TOKENIZER
 
 MAX_SEARCH_PRICE = EnvService.get_max_search_price()
 
@@ -248,8 +249,13 @@ class Search:
 
             # Refine a query to send to google custom search API
             prompt = f"You are to be given a search query for google. Change the query such that putting it into the Google Custom Search API will return the most relevant websites to assist in answering the original query. If the original query is inferring knowledge about the current day, insert the current day into the refined prompt. If the original query is inferring knowledge about the current month, insert the current month and year into the refined prompt. If the original query is inferring knowledge about the current year, insert the current year into the refined prompt. Generally, if the original query is inferring knowledge about something that happened recently, insert the current month into the refined query. Avoid inserting a day, month, or year for queries that purely ask about facts and about things that don't have much time-relevance. The current date is {str(datetime.now().date())}. Do not insert the current date if not neccessary. Respond with only the refined query for the original query. Don’t use punctuation or quotation marks.\n\nExamples:\n---\nOriginal Query: ‘Who is Harald Baldr?’\nRefined Query: ‘Harald Baldr biography’\n---\nOriginal Query: ‘What happened today with the Ohio train derailment?’\nRefined Query: ‘Ohio train derailment details {str(datetime.now().date())}’\n---\nOriginal Query: ‘Is copper in drinking water bad for you?’\nRefined Query: ‘copper in drinking water adverse effects’\n---\nOriginal Query: What's the current time in Mississauga?\nRefined Query: current time Mississauga\nNow, refine the user input query.\nOriginal Query: {query}\nRefined Query:"
-            query_refined = await llm_predictor_presearch.apredict(
-                text=prompt,
+            # The refined query only depends on the prompt, which has the date in it, so it can be cached
+            query_refined = await Model.response_cache.cached(
+                "search_refine",
+                ResponseCache.make_key("search_refine", model, prompt),
+                lambda: llm_predictor_presearch.apredict(
+                    text=prompt,
+                ),
             )
             query_refined_text = query_refined
 
@@ -336,7 +342,7 @@ class Search:
                 self.build_search_webpages_retrieved_embed(query_refined_text),
             )
 
-        embedding_model = OpenAIEmbedding()
+        embedding_model = CachedOpenAIEmbedding()
 
         if "vision" in model:
             llm_predictor = LLMPredictor(
@@ -346,7 +352,7 @@ class Search:
             llm_predictor = LLMPredictor(llm=ChatOpenAI(temperature=0, model=model))
 
         token_counter = TokenCountingHandler(
-            tokenizer=tiktoken.encoding_for_model(model).encode, verbose=False
+            tokenizer=TOKENIZER.get_encoder(model).encode, verbose=False
         )
 
         callback_manager = CallbackManager([token_counter])
@@ -359,7 +365,7 @@ class Search:
 
         # Check price
         token_counter_mock = TokenCountingHandler(
-            tokenizer=tiktoken.encoding_for_model(model).encode, verbose=False
+            tokenizer=TOKENIZER.get_encoder(model).encode, verbose=False
         )
         callback_manager_mock = CallbackManager([token_counter_mock])
         embed_model_mock = MockEmbedding(embed_dim=1536)
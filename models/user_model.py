@@ -3,6 +3,13 @@ Store information about a discord user, for the purposes of enabling conversatio
 history, message count, and the id of the user in order to track them.
 """
 
+import copy
+import re
+import sys
+import weakref
+
+from services.tokenizer_service import TOKENIZER
+
 
 class RedoUser:
     def __init__(
@@ -88,10 +95,199 @@ class Instruction:
         return self.__repr__()
 
 
+class VersionedList(list):
+    """A list whose version goes up with every change, so that savers can tell whether it changed since they last
+    saved it without comparing its contents.
+    """
+
+    def __init__(self, items=()):
+        super().__init__(items)
+        self.version = 0
+
+    def __reduce__(self):
+        return self.__class__, (list(self),)
+
+    def append(self, item):
+        super().append(item)
+        self.version += 1
+
+    def extend(self, items):
+        super().extend(items)
+        self.version += 1
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def __imul__(self, times):
+        super().__imul__(times)
+        self.version += 1
+        return self
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        self.version += 1
+
+    def remove(self, item):
+        super().remove(item)
+        self.version += 1
+
+    def pop(self, index=-1):
+        item = super().pop(index)
+        self.version += 1
+        return item
+
+    def clear(self):
+        super().clear()
+        self.version += 1
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.version += 1
+
+    def reverse(self):
+        super().reverse()
+        self.version += 1
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self.version += 1
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self.version += 1
+
+
+class FullConversationHistory(VersionedList):
+    """The most recent prompts and responses of a conversation, the transcript that is shared to ShareGPT.
+
+    It only keeps the newest items, dropped counts how many older ones were cut so that a shared transcript can
+    say it is incomplete.
+    """
+
+    def __init__(self, items=(), dropped=0):
+        super().__init__(items)
+        self.dropped = dropped
+
+    def __reduce__(self):
+        return self.__class__, (list(self), self.dropped)
+
+    def trim(self, max_items):
+        """Drop the oldest items past max_items, as whole prompt and response pairs so the items keep alternating"""
+        excess = len(self) - max_items
+        if excess <= 0:
+            return
+        excess += excess % 2
+        del self[:excess]
+        self.dropped += excess
+
+
+class ConversationHistory(list):
+    """The items of a conversation, with a running total of their tokens.
+
+    Each item's tokens are counted once and kept on the item, so the total is updated as items are added and
+    removed instead of the whole conversation being tokenized again on every message. The version goes up with
+    every change, so that savers can tell whether the history changed since they last saved it.
+    """
+
+    def __init__(self, items=()):
+        super().__init__(items)
+        self.token_count = sum(item.get_token_count() for item in self)
+        self.version = 0
+
+    def __reduce__(self):
+        return self.__class__, (list(self),)
+
+    def append(self, item):
+        super().append(item)
+        self.token_count += item.get_token_count()
+        self.version += 1
+
+    def extend(self, items):
+        items = list(items)
+        super().extend(items)
+        self.token_count += sum(item.get_token_count() for item in items)
+        self.version += 1
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        self.token_count += item.get_token_count()
+        self.version += 1
+
+    def remove(self, item):
+        index = self.index(item)
+        self.token_count -= self[index].get_token_count()
+        super().__delitem__(index)
+        self.version += 1
+
+    def pop(self, index=-1):
+        item = super().pop(index)
+        self.token_count -= item.get_token_count()
+        self.version += 1
+        return item
+
+    def clear(self):
+        super().clear()
+        self.token_count = 0
+        self.version += 1
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            removed = self[index]
+            # A slice can be replaced by a different number of items, so the added ones are taken from the value
+            value = list(value)
+            added = value
+        else:
+            removed = [self[index]]
+            added = [value]
+        super().__setitem__(index, value)
+        self.token_count += sum(item.get_token_count() for item in added) - sum(
+            item.get_token_count() for item in removed
+        )
+        self.version += 1
+
+    def __imul__(self, times):
+        super().__imul__(times)
+        self.token_count *= max(times, 0)
+        self.version += 1
+        return self
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.version += 1
+
+    def reverse(self):
+        super().reverse()
+        self.version += 1
+
+    def __delitem__(self, index):
+        removed = self[index] if isinstance(index, slice) else [self[index]]
+        super().__delitem__(index)
+        self.token_count -= sum(item.get_token_count() for item in removed)
+        self.version += 1
+
+
 class Thread:
+    __slots__ = (
+        "thread_id",
+        "_history",
+        "count",
+        "has_opener",
+        "model",
+        "temperature",
+        "top_p",
+        "frequency_penalty",
+        "presence_penalty",
+        "drawable",
+    )
+
     def __init__(self, thread_id):
         self.thread_id = thread_id
-        self.history = []
+        self.history = ConversationHistory()
         self.count = 0
         self.has_opener = False
         self.model = None
@@ -121,6 +317,49 @@ class Thread:
             "presence_penalty": self.presence_penalty,
         }
 
+    # Whatever list the history is set to, it keeps a running token count
+    @property
+    def history(self):
+        return self._history
+
+    @history.setter
+    def history(self, items):
+        history = (
+            items
+            if isinstance(items, ConversationHistory)
+            else ConversationHistory(items)
+        )
+        # The version carries on from the replaced history, so replacing it always counts as a change
+        previous = getattr(self, "_history", None)
+        if previous is not None and previous is not history:
+            history.version = max(history.version, previous.version + 1)
+        self._history = history
+
+    def snapshot(self):
+        """A copy of the thread that can be pickled in another thread while this one keeps changing"""
+        snapshot = copy.copy(self)
+        snapshot.history = list(self.history)
+        return snapshot
+
+    def get_version(self):
+        """Changes whenever anything that is saved about the thread changes"""
+        return (self._history.version,) + tuple(
+            getattr(self, slot) for slot in self.__slots__ if slot != "_history"
+        )
+
+    def __getstate__(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __setstate__(self, state):
+        # Threads pickled before they had slots are missing the attributes added since, they get their defaults
+        self.__init__(state.get("thread_id"))
+        for key, value in state.items():
+            # Threads pickled before the history kept a token count have it as a plain list
+            if key in ("history", "_history"):
+                self.history = value
+            elif key in self.__slots__:
+                setattr(self, key, value)
+
     # These user objects should be accessible by ID, for example if we had a bunch of user
     # objects in a list, and we did `if 1203910293001 in user_list`, it would return True
     # if the user with that ID was in the list
@@ -137,15 +376,169 @@ class Thread:
         return self.__repr__()
 
 
+class Affixes:
+    """A prefix and suffix pair, unpacked like a tuple. Unlike a tuple it can be weakly referenced"""
+
+    __slots__ = ("prefix", "suffix", "__weakref__")
+
+    def __init__(self, prefix, suffix):
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def __iter__(self):
+        return iter((self.prefix, self.suffix))
+
+
+# The texts of conversation items are their content wrapped in the same few prefixes ("\n<name>: ") and suffixes
+# ("<|endofstatement|>\n") over and over, a single copy of each pair is shared by all of the items. A pair is
+# dropped from the table once no item uses it anymore, so names that are gone don't pile up
+AFFIXES = weakref.WeakValueDictionary()
+
+
+def share_affixes(prefix, suffix):
+    key = (prefix, suffix)
+    affixes = AFFIXES.get(key)
+    if affixes is None:
+        affixes = AFFIXES[key] = Affixes(prefix, suffix)
+    return affixes
+
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
 class EmbeddedConversationItem:
-    def __init__(self, text, timestamp, image_urls=None):
-        self.text = text
+    __slots__ = (
+        "_text",
+        "affixes",
+        "timestamp",
+        "image_urls",
+        "role",
+        "name",
+        "content",
+        "token_count",
+        "chat_messages",
+    )
+
+    # The longest prefix and suffix around the content that is shared instead of being kept in the text
+    MAX_AFFIX_LENGTH = 64
+
+    def __init__(
+        self,
+        text,
+        timestamp,
+        image_urls=None,
+        role=None,
+        name=None,
+        content=None,
+        token_count=None,
+    ):
         self.timestamp = int(timestamp)
         self.image_urls = image_urls
+        # The item as a chat message. Items that were only given their text (like the ones pickled before these
+        # existed, or the ones retrieved from pinecone) are parsed from it the first time they are needed
+        self.role = intern(role)
+        self.name = intern(name)
+        self.content = content
+        self.text = text
+        self.token_count = token_count
+        # The chat completion messages built from this item, so they are only built once per conversation
+        self.chat_messages = None
+
+    @property
+    def text(self):
+        if self._text is not None:
+            return self._text
+        prefix, suffix = self.affixes
+        return prefix + self.content + suffix
+
+    @text.setter
+    def text(self, text):
+        """Keep only the content of the text, and shared copies of what is around it, when the text contains it"""
+        self._text = text
+        self.affixes = None
+        if text is None or self.content is None:
+            return
+        start = text.find(self.content)
+        end = start + len(self.content)
+        if start >= 0 and max(start, len(text) - end) <= self.MAX_AFFIX_LENGTH:
+            self._text = None
+            self.affixes = share_affixes(text[:start], text[end:])
+
+    def __getstate__(self):
+        return {
+            "text": self.text,
+            "timestamp": self.timestamp,
+            "image_urls": self.image_urls,
+            "role": self.role,
+            "name": self.name,
+            "content": self.content,
+            "token_count": self.token_count,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(
+            state["text"],
+            state["timestamp"],
+            image_urls=state.get("image_urls"),
+            role=state.get("role"),
+            name=state.get("name"),
+            content=state.get("content"),
+            token_count=state.get("token_count"),
+        )
+
+    def get_chat_message(self, key):
+        return self.chat_messages.get(key) if self.chat_messages else None
+
+    def set_chat_message(self, key, message):
+        if self.chat_messages is None:
+            self.chat_messages = {}
+        self.chat_messages[key] = message
 
     def has_image(self):
         return self.image_urls is not None
 
+    def get_token_count(self):
+        """The tokens in the text of this item, counted the first time they are needed"""
+        if self.token_count is None:
+            # System prompts are the same for many conversations, so their counts are shared
+            self.token_count = (
+                TOKENIZER.count_memoized(self.text)
+                if self.role == "system"
+                else TOKENIZER.count(self.text)
+            )
+        return self.token_count
+
+    def get_structured(self, bot_name):
+        """The role, name and content of this item, parsed from the text for items that were created without them"""
+        if self.role is None:
+            text = self.text
+            role, name, self.content = self.parse_text(text, bot_name)
+            self.role, self.name = intern(role), intern(name)
+            self.text = text
+        return self.role, self.name, self.content
+
+    @staticmethod
+    def parse_text(text, bot_name):
+        if (
+            text.strip()
+            .lower()
+            .startswith("this conversation has some context from earlier")
+        ):
+            return "system", None, text.replace("<|endofstatement|>", "")
+
+        if text.startswith(f"\n{bot_name}"):
+            content = text.replace(bot_name, "").replace("<|endofstatement|>", "")
+            return "assistant", None, content
+
+        username = re.search(r"(?<=\n)(.*?)(?=:)", text)
+        if not username:
+            return "system", None, text.replace("<|endofstatement|>", "")
+        username = username.group()
+        # Strip whitespace just from the right side of the string
+        content = text.replace(f"{username}:", "").rstrip()
+        return "user", username, content.replace("<|endofstatement|>", "")
+
     def __repr__(self):
         return self.text
 
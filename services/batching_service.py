@@ -0,0 +1,82 @@
+import asyncio
+from collections import defaultdict
+
+
+class MicroBatcher:
+    """Coalesces concurrent calls into batches that are sent with a single request.
+
+    Items submitted with the same key within max_wait seconds of each other are grouped together, up to
+    max_batch_size items or max_batch_weight total weight (e.g. tokens). process_batch(key, items) is awaited with
+    each batch and has to return one result per item, in order. Every caller gets back its own result, or the
+    exception if the batch failed.
+    """
+
+    def __init__(
+        self,
+        process_batch,
+        max_batch_size,
+        max_wait,
+        max_batch_weight=None,
+        weigh=None,
+    ):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_batch_weight = max_batch_weight
+        self.weigh = weigh
+        self.pending = defaultdict(list)
+        self.weights = defaultdict(int)
+        self.timers = {}
+        self.batches_sent = 0
+        self.items_sent = 0
+
+    async def submit(self, item, key=None):
+        future = asyncio.get_running_loop().create_future()
+        weight = self.weigh(item) if self.weigh else 0
+
+        # Send what's pending first if this item would push the batch over its weight limit
+        if (
+            self.pending[key]
+            and self.max_batch_weight
+            and self.weights[key] + weight > self.max_batch_weight
+        ):
+            self.flush(key)
+
+        self.pending[key].append((item, future))
+        self.weights[key] += weight
+
+        if len(self.pending[key]) >= self.max_batch_size:
+            self.flush(key)
+        elif key not in self.timers:
+            self.timers[key] = asyncio.get_running_loop().call_later(
+                self.max_wait, self.flush, key
+            )
+
+        return await future
+
+    def flush(self, key):
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        batch = self.pending.pop(key, [])
+        self.weights.pop(key, None)
+        if batch:
+            asyncio.ensure_future(self.send_batch(key, batch))
+
+    async def send_batch(self, key, batch):
+        self.batches_sent += 1
+        self.items_sent += len(batch)
+        try:
+            results = await self.process_batch(key, [item for item, _ in batch])
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+            for _, future in batch[len(results) :]:
+                if not future.done():
+                    future.set_exception(
+                        ValueError("The batch did not return a result for every item")
+                    )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
@@ -0,0 +1,295 @@
+import ast
+import asyncio
+import copy
+import pickle
+import sqlite3
+import threading
+import time
+import traceback
+import zlib
+from collections import defaultdict
+from collections.abc import MutableMapping
+
+from models.user_model import FullConversationHistory
+from services.metrics_service import METRICS, Metrics
+
+# The written version of a record that was indexed but never read from the store
+UNLOADED = object()
+
+
+class LazyRecordDict(MutableMapping):
+    """A dict of the records of one kind that only holds their keys until they are used.
+
+    A record is read from the store the first time it is looked up, and dropped from memory again by evict_idle() once
+    it has been left alone for idle_ttl seconds. Only records that are saved as they are are dropped, a record that
+    changed stays in memory until the next save has written it. Membership and len() only use the keys, so they never
+    read from the store.
+    """
+
+    def __init__(self, store, kind, keys=(), default_factory=None, idle_ttl=3600):
+        self.store = store
+        self.kind = kind
+        self.index = set(keys)
+        self.default_factory = default_factory
+        self.idle_ttl = idle_ttl
+        self.loaded = {}
+        self.last_used = {}
+
+    def __getitem__(self, key):
+        record = self.loaded.get(key)
+        if record is None:
+            if key in self.index:
+                record = self.store.load_record(self.kind, key)
+            if record is None:
+                if self.default_factory is None:
+                    raise KeyError(key)
+                record = self.default_factory()
+            self.loaded[key] = record
+            self.index.add(key)
+        self.last_used[key] = time.monotonic()
+        return record
+
+    def __setitem__(self, key, value):
+        self.loaded[key] = value
+        self.index.add(key)
+        self.last_used[key] = time.monotonic()
+
+    def __delitem__(self, key):
+        if key not in self.index:
+            raise KeyError(key)
+        self.index.discard(key)
+        self.loaded.pop(key, None)
+        self.last_used.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def __len__(self):
+        return len(self.index)
+
+    def evict_idle(self):
+        """Drop the records that are saved and haven't been used for idle_ttl seconds, returns how many were dropped"""
+        cutoff = time.monotonic() - self.idle_ttl
+        written = self.store.versions[self.kind]
+        evicted = 0
+        for key, used in list(self.last_used.items()):
+            if used > cutoff:
+                continue
+            if key in written and written[key] == self.store.VERSIONS[self.kind](
+                self.loaded[key]
+            ):
+                del self.loaded[key]
+                del self.last_used[key]
+                evicted += 1
+        return evicted
+
+
+class ConversationStore:
+    """Saves conversations to sqlite, one row per thread (and per owner, full history and instruction set).
+
+    Each save only writes the rows whose contents changed since they were last written, and deletes the rows of
+    conversations that are gone. Whether something changed is told from a cheap version of it (see VERSIONS), so
+    unchanged threads are never pickled again. The rows of a save are written in a single transaction, so a crash
+    leaves the store as it was after the last complete save.
+
+    Only a shallow copy of each changed record is taken on the event loop (see SNAPSHOTS). The copies are pickled
+    and compressed in a worker thread, so saving doesn't hold up the bot while a big conversation is serialized.
+
+    When the bot starts, only the keys of the threads and full histories are read. Each is read from the store when
+    it is first used, and dropped from memory again once it has been idle for a while (see LazyRecordDict).
+    """
+
+    # How each kind of record tells that it changed, without pickling it. Full histories saved by older versions are
+    # plain lists, they only change once they are replaced by a FullConversationHistory
+    VERSIONS = {
+        "full_conversation_history": lambda history: getattr(history, "version", None),
+        "conversation_threads": lambda thread: thread.get_version(),
+        "conversation_thread_owners": lambda threads: tuple(threads),
+        "instructions": lambda instruction: instruction.prompt,
+    }
+
+    # How each kind of record is copied, so the copy can be serialized while the record keeps changing
+    SNAPSHOTS = {
+        "full_conversation_history": copy.copy,
+        "conversation_threads": lambda thread: thread.snapshot(),
+        "conversation_thread_owners": list,
+        "instructions": copy.copy,
+    }
+
+    # The kinds that are read from the store when they are used, instead of all at once when the bot starts
+    LAZY_KINDS = {
+        "full_conversation_history": FullConversationHistory,
+        "conversation_threads": None,
+    }
+
+    COMPRESSION_LEVEL = 6
+
+    def __init__(self, path, idle_ttl=3600):
+        # Seconds a thread or full history is kept in memory after it was last used
+        self.idle_ttl = idle_ttl
+        self.save_lock = asyncio.Lock()
+        # Held by a save for the whole of its transaction, in a worker thread
+        self.lock = threading.Lock()
+        # Records are read on the event loop while a save may be writing. The reads have a connection of their own,
+        # which WAL lets read the last committed rows during a save, so they never wait for the save to finish
+        self.read_lock = threading.Lock()
+        # The version of each record as it was last written, by kind and key
+        self.versions = {kind: {} for kind in self.VERSIONS}
+        self.rows_written = 0
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS records (kind TEXT NOT NULL, key TEXT NOT NULL, data BLOB NOT NULL, "
+            "PRIMARY KEY (kind, key))"
+        )
+        self.connection.commit()
+        self.read_connection = sqlite3.connect(str(path), check_same_thread=False)
+
+    def is_empty(self):
+        with self.read_lock:
+            row = self.read_connection.execute(
+                "SELECT 1 FROM records LIMIT 1"
+            ).fetchone()
+        return row is None
+
+    def load(self):
+        """The saved conversations as a dict of kind to records.
+
+        Threads and full histories are LazyRecordDicts, only their keys are read here. The owners and instructions
+        are small, so they are read in full.
+        """
+        conversations = {
+            kind: LazyRecordDict(self, kind, (), default_factory, self.idle_ttl)
+            for kind, default_factory in self.LAZY_KINDS.items()
+        }
+        conversations["conversation_thread_owners"] = defaultdict(list)
+        conversations["instructions"] = defaultdict(list)
+
+        lazy_kinds = list(self.LAZY_KINDS)
+        placeholders = ", ".join("?" * len(lazy_kinds))
+        for kind, key in self.connection.execute(
+            f"SELECT kind, key FROM records WHERE kind IN ({placeholders})", lazy_kinds
+        ):
+            try:
+                key = ast.literal_eval(key)
+            except Exception:
+                traceback.print_exc()
+                continue
+            conversations[kind].index.add(key)
+            self.versions[kind][key] = UNLOADED
+
+        for kind, data in self.connection.execute(
+            f"SELECT kind, data FROM records WHERE kind NOT IN ({placeholders})",
+            lazy_kinds,
+        ):
+            if kind not in conversations:
+                continue
+            try:
+                key, value = self.deserialize(data)
+            except Exception:
+                traceback.print_exc()
+                continue
+            conversations[kind][key] = value
+            self.versions[kind][key] = self.VERSIONS[kind](value)
+        return conversations
+
+    def load_record(self, kind, key):
+        """Read a single record from the store, or None if it isn't there"""
+        with self.read_lock:
+            row = self.read_connection.execute(
+                "SELECT data FROM records WHERE kind = ? AND key = ?", (kind, repr(key))
+            ).fetchone()
+        if row is None:
+            return None
+        try:
+            _, value = self.deserialize(row[0])
+        except Exception:
+            traceback.print_exc()
+            return None
+        self.versions[kind][key] = self.VERSIONS[kind](value)
+        return value
+
+    async def save(self, conversations):
+        """Write the records that changed since the last save. conversations is a dict of kind to records"""
+        async with self.save_lock:
+            started = time.monotonic()
+            snapshots = []
+            deletes = []
+            versions = {}
+            for kind, records in conversations.items():
+                written = self.versions[kind]
+                current = versions[kind] = {}
+                if isinstance(records, LazyRecordDict):
+                    # Records that aren't in memory can't have changed since they were written
+                    current.update(
+                        (key, written[key])
+                        for key in records.index
+                        if key in written and key not in records.loaded
+                    )
+                    items = list(records.loaded.items())
+                else:
+                    items = list(records.items())
+                for key, value in items:
+                    version = self.VERSIONS[kind](value)
+                    current[key] = version
+                    if key not in written or written[key] != version:
+                        snapshots.append((kind, key, self.SNAPSHOTS[kind](value)))
+                deletes.extend(
+                    (kind, repr(key)) for key in written if key not in current
+                )
+            METRICS.observe(
+                "conversation_snapshot_capture_seconds", time.monotonic() - started
+            )
+
+            if snapshots or deletes:
+                await asyncio.to_thread(self.write, snapshots, deletes)
+                self.rows_written += len(snapshots)
+                METRICS.inc("conversation_rows_written_total", value=len(snapshots))
+            # Only once the rows are safely written, so a failed save is retried in full by the next one
+            self.versions.update(versions)
+            METRICS.observe("conversation_save_seconds", time.monotonic() - started)
+
+    def serialize(self, key, value):
+        return zlib.compress(pickle.dumps((key, value)), self.COMPRESSION_LEVEL)
+
+    @staticmethod
+    def deserialize(data):
+        try:
+            data = zlib.decompress(data)
+        except zlib.error:
+            # Rows written before they were compressed
+            pass
+        return pickle.loads(data)
+
+    def write(self, snapshots, deletes):
+        """Serialize the snapshots and write them, runs in a worker thread"""
+        started = time.monotonic()
+        upserts = [
+            (kind, repr(key), self.serialize(key, value))
+            for kind, key, value in snapshots
+        ]
+        if upserts:
+            METRICS.observe(
+                "conversation_snapshot_serialize_seconds", time.monotonic() - started
+            )
+            METRICS.observe(
+                "conversation_snapshot_bytes",
+                sum(len(data) for _, _, data in upserts),
+                buckets=Metrics.BYTES_BUCKETS,
+            )
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?)", upserts
+            )
+            self.connection.executemany(
+                "DELETE FROM records WHERE kind = ? AND key = ?", deletes
+            )
+
+    def get_stats(self):
+        return {
+            "records": sum(len(versions) for versions in self.versions.values()),
+            "rows_written": self.rows_written,
+        }
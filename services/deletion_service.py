@@ -1,8 +1,12 @@
 import asyncio
+import heapq
+import itertools
+import time
 import traceback
-from datetime import datetime
+from collections import defaultdict
 
 import discord
+from sqlitedict import SqliteDict
 
 
 class Deletion:
@@ -10,34 +14,188 @@ class Deletion:
         self.message = message
         self.timestamp = timestamp
 
-    # This function will be called by the bot to process the message queue
+
+class DeletionScheduler:
+    """Deletes messages at their deletion timestamp.
+
+    Pending deletions are kept in a heap, and a single timer is set for the earliest of them, so nothing runs until a
+    deletion is due. Messages that are due together in the same channel are deleted with one bulk delete call.
+    Deletions of regular messages are saved to store_path, and rescheduled by restore() after a restart.
+    """
+
+    # The most messages Discord deletes in a single bulk delete call
+    MAX_BULK_DELETE = 100
+
+    def __init__(self, store_path=None):
+        self.heap = []
+        self.counter = itertools.count()
+        self.timer = None
+        self.timer_due = None
+        self.tasks = set()
+        self.restored = False
+        self.deleted = 0
+        self.bulk_deletes = 0
+
+        self.store = None
+        if store_path:
+            try:
+                self.store = SqliteDict(
+                    str(store_path), tablename="deletions", autocommit=True
+                )
+            except Exception:
+                traceback.print_exc()
+                print(
+                    "Could not open the deletions DB, pending deletions won't survive a restart"
+                )
+
+    async def put(self, deletion):
+        """Schedule a deletion, keeps the interface of asyncio.Queue"""
+        self.schedule(deletion)
+
+    def schedule(self, deletion, persist=True):
+        heapq.heappush(self.heap, (deletion.timestamp, next(self.counter), deletion))
+        if persist and self.store is not None:
+            key = self.get_key(deletion)
+            if key:
+                self.store[key] = deletion.timestamp
+        self.arm()
+
     @staticmethod
-    async def process_deletion_queue(
-        deletion_queue, PROCESS_WAIT_TIME, EMPTY_WAIT_TIME
-    ):
-        while True:
+    def get_key(deletion):
+        """The key a deletion is saved under, interaction responses can't be deleted after a restart so aren't saved"""
+        message = deletion.message
+        if isinstance(message, (discord.Message, discord.PartialMessage)):
+            return f"{message.channel.id}:{message.id}"
+        return None
+
+    def arm(self):
+        """Set the timer for the earliest deletion, unless it is already set for it or something earlier"""
+        if not self.heap:
+            return
+        due = self.heap[0][0]
+        if self.timer is not None:
+            if self.timer_due <= due:
+                return
+            self.timer.cancel()
+        loop = asyncio.get_event_loop()
+        self.timer_due = due
+        self.timer = loop.call_at(
+            loop.time() + max(0.0, due - time.time()), self.on_timer
+        )
+
+    def on_timer(self):
+        self.timer = None
+        task = asyncio.ensure_future(self.run_due())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run_due(self):
+        due = []
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap)[2])
+        try:
+            await self.delete(due)
+        except Exception:
+            traceback.print_exc()
+        self.arm()
+
+    async def delete(self, deletions):
+        by_channel = defaultdict(list)
+        for deletion in deletions:
+            if isinstance(deletion.message, (discord.Message, discord.PartialMessage)):
+                by_channel[deletion.message.channel.id].append(deletion.message)
+            else:
+                try:
+                    await deletion.message.delete_original_response()
+                    self.deleted += 1
+                except Exception:
+                    traceback.print_exc()
+
+        for messages in by_channel.values():
+            channel = messages[0].channel
+            for start in range(0, len(messages), self.MAX_BULK_DELETE):
+                await self.delete_from_channel(
+                    channel, messages[start : start + self.MAX_BULK_DELETE]
+                )
+
+        if self.store is not None:
+            for deletion in deletions:
+                key = self.get_key(deletion)
+                if key:
+                    self.store.pop(key, None)
+
+    async def delete_from_channel(self, channel, messages):
+        if len(messages) > 1 and hasattr(channel, "delete_messages"):
             try:
-                # If the queue is empty, sleep for a short time before checking again
-                if deletion_queue.empty():
-                    await asyncio.sleep(EMPTY_WAIT_TIME)
-                    continue
-
-                # Get the next message from the queue
-                deletion = await deletion_queue.get()
-
-                # Check if the current timestamp is greater than the deletion timestamp
-                if datetime.now().timestamp() > deletion.timestamp:
-                    # If the deletion timestamp has passed, delete the message
-                    # check if deletion.message is of type discord.Message
-                    if isinstance(deletion.message, discord.Message):
-                        await deletion.message.delete()
-                    else:
-                        await deletion.message.delete_original_response()
-                else:
-                    await deletion_queue.put(deletion)
-
-                # Sleep for a short time before processing the next message
-                # This will prevent the bot from spamming messages too quickly
-                await asyncio.sleep(PROCESS_WAIT_TIME)
+                await channel.delete_messages(messages)
+                self.bulk_deletes += 1
+                self.deleted += len(messages)
+                return
+            except (discord.HTTPException, discord.ClientException):
+                # DMs, missing permissions and old messages can't be bulk deleted, delete them one by one instead
+                pass
+
+        for message in messages:
+            try:
+                await message.delete()
+                self.deleted += 1
+            except discord.NotFound:
+                pass
             except Exception:
                 traceback.print_exc()
+
+    async def restore(self, bot):
+        """Reschedule the deletions that were pending when the bot last stopped"""
+        if self.restored or self.store is None:
+            return
+        self.restored = True
+        channels = {}
+        for key, timestamp in list(self.store.items()):
+            channel_id, message_id = (int(part) for part in key.split(":"))
+            if channel_id not in channels:
+                channels[channel_id] = await self.get_channel(bot, channel_id)
+            channel = channels[channel_id]
+            if channel is None:
+                print(
+                    f"Skipping the deletion of message {message_id}, its channel {channel_id} is gone"
+                )
+                self.store.pop(key, None)
+                continue
+            self.schedule(
+                Deletion(channel.get_partial_message(message_id), timestamp),
+                persist=False,
+            )
+        if self.heap:
+            print(f"Restored {len(self.heap)} pending message deletions")
+
+    @staticmethod
+    async def get_channel(bot, channel_id):
+        """The channel with the id, fetched when it isn't cached, as is the case for archived threads"""
+        channel = bot.get_channel(channel_id)
+        if channel is not None:
+            return channel
+        try:
+            return await bot.fetch_channel(channel_id)
+        except (discord.NotFound, discord.Forbidden):
+            return None
+        except Exception:
+            traceback.print_exc()
+            return None
+
+    def qsize(self):
+        return len(self.heap)
+
+    def empty(self):
+        return not self.heap
+
+    def oldest_wait(self):
+        """How long past due the next deletion is"""
+        return max(0.0, time.time() - self.heap[0][0]) if self.heap else 0.0
+
+    def get_stats(self):
+        return {
+            "pending": len(self.heap),
+            "deleted": self.deleted,
+            "bulk_deletes": self.bulk_deletes,
+        }
@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+import traceback
+from array import array
+
+from services.environment_service import EnvService
+
+
+class EmbeddingCache:
+    """A disk backed cache of embeddings, keyed by a hash of the embedding model and the embedded text.
+
+    Vectors are stored as compact float32 blobs. Once the cache grows past max_entries, the least recently used
+    embeddings are evicted. The cache is shared with the llama-index embedding models, which run in executor
+    threads, so all access goes through a lock.
+
+    Lookups only read. New embeddings and the access times of hits are kept in memory, and written in a single
+    transaction by flush(), which the bot runs in a worker thread every FLUSH_INTERVAL seconds. Embeddings that
+    are waiting to be written are served from memory.
+    """
+
+    # How many writes happen between checks of the cache size
+    EVICTION_INTERVAL = 100
+
+    # How often (in seconds) new embeddings and access times are written to disk
+    FLUSH_INTERVAL = 10
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # Only one flush writes at a time, lookups don't wait for it
+        self.flush_lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)"
+        )
+        self.connection.commit()
+        # A separate connection for flushes, so that they never hold up a lookup
+        self.write_connection = sqlite3.connect(str(path), check_same_thread=False)
+        # Embeddings that haven't been written yet, and the last access of the ones that have, by key
+        self.pending = {}
+        self.accessed = {}
+        self.hits = 0
+        self.misses = 0
+        self.writes_since_eviction = 0
+
+    @staticmethod
+    def make_key(model, text):
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, model, texts):
+        """Return the cached embedding for each text, or None for the texts that aren't cached"""
+        keys = [self.make_key(model, text) for text in texts]
+        now = time.time()
+        with self.lock:
+            rows = {key: self.pending[key][0] for key in keys if key in self.pending}
+            stored = [key for key in keys if key not in rows]
+            for index in range(0, len(stored), 500):
+                chunk = stored[index : index + 500]
+                rows.update(
+                    self.connection.execute(
+                        "SELECT key, vector FROM embeddings WHERE key IN (%s)"
+                        % ",".join("?" * len(chunk)),
+                        chunk,
+                    ).fetchall()
+                )
+            for key in rows:
+                self.accessed[key] = now
+            self.hits += len(rows)
+            self.misses += len(keys) - len(rows)
+
+        embeddings = []
+        for key in keys:
+            if key in rows:
+                vector = array("f")
+                vector.frombytes(rows[key])
+                embeddings.append(vector.tolist())
+            else:
+                embeddings.append(None)
+        return embeddings
+
+    def get(self, model, text):
+        return self.get_many(model, [text])[0]
+
+    def put_many(self, model, texts, embeddings):
+        now = time.time()
+        with self.lock:
+            for text, embedding in zip(texts, embeddings):
+                if embedding is not None:
+                    self.pending[self.make_key(model, text)] = (
+                        array("f", embedding).tobytes(),
+                        now,
+                    )
+
+    def put(self, model, text, embedding):
+        self.put_many(model, [text], [embedding])
+
+    def flush(self):
+        """Write the new embeddings and the access times of hits, and evict the least recently used embeddings"""
+        with self.flush_lock:
+            with self.lock:
+                pending = dict(self.pending)
+                accessed, self.accessed = self.accessed, {}
+            if not pending and not accessed:
+                return
+
+            with self.write_connection:
+                self.write_connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)",
+                    [
+                        (key, vector, max(added, accessed.pop(key, added)))
+                        for key, (vector, added) in pending.items()
+                    ],
+                )
+                self.write_connection.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(last_access, key) for key, last_access in accessed.items()],
+                )
+                self.writes_since_eviction += len(pending)
+                if self.writes_since_eviction >= self.EVICTION_INTERVAL:
+                    self.writes_since_eviction = 0
+                    self.write_connection.execute(
+                        "DELETE FROM embeddings WHERE key IN "
+                        "(SELECT key FROM embeddings ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                        (self.max_entries,),
+                    )
+
+            # Embeddings that were put again while this flush was writing stay pending for the next one
+            with self.lock:
+                for key, row in pending.items():
+                    if self.pending.get(key) is row:
+                        del self.pending[key]
+
+    async def process_flush(self, interval=None):
+        """Flush the cache to disk in a worker thread every interval seconds"""
+        while True:
+            await asyncio.sleep(interval or self.FLUSH_INTERVAL)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception:
+                traceback.print_exc()
+
+    def get_stats(self):
+        with self.lock:
+            entries = self.connection.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()[0]
+            pending = len(self.pending)
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "pending": pending,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+try:
+    EMBEDDING_CACHE = (
+        EmbeddingCache(
+            EnvService.save_path() / "embedding_cache.sqlite",
+            EnvService.get_embedding_cache_max_entries(),
+        )
+        if EnvService.get_embedding_cache_enabled()
+        else None
+    )
+except Exception:
+    traceback.print_exc()
+    print("Failed to open the embedding cache, embeddings will not be cached")
+    EMBEDDING_CACHE = None
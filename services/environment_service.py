@@ -494,6 +494,400 @@ class EnvService:
         except Exception:
             return None
 
+    @staticmethod
+    def get_openai_base_url():
+        # The base url of the OpenAI API, can point to any compatible server (e.g. tests/mock_openai_server.py)
+        try:
+            openai_base_url = os.getenv("OPENAI_BASE_URL")
+            return openai_base_url.strip().rstrip("/")
+        except Exception:
+            return "https://api.openai.com/v1"
+
+    @staticmethod
+    def get_openai_max_connections():
+        # The total size of the pooled connections shared by every request to the OpenAI API
+        try:
+            max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS"))
+            return max_connections
+        except Exception:
+            return 100
+
+    @staticmethod
+    def get_openai_max_connections_per_host():
+        try:
+            max_connections_per_host = int(os.getenv("OPENAI_MAX_CONNECTIONS_PER_HOST"))
+            return max_connections_per_host
+        except Exception:
+            return 50
+
+    @staticmethod
+    def get_openai_keepalive_timeout():
+        # How long (in seconds) an idle pooled connection is kept open for reuse
+        try:
+            keepalive_timeout = float(os.getenv("OPENAI_KEEPALIVE_TIMEOUT"))
+            return keepalive_timeout
+        except Exception:
+            return 60.0
+
+    @staticmethod
+    def get_openai_dns_cache_ttl():
+        # How long (in seconds) resolved addresses for the OpenAI API are cached
+        try:
+            dns_cache_ttl = int(os.getenv("OPENAI_DNS_CACHE_TTL"))
+            return dns_cache_ttl
+        except Exception:
+            return 300
+
+    @staticmethod
+    def get_max_concurrent_requests():
+        # The most requests to the OpenAI API that are in flight at once, the rest wait their turn by priority
+        try:
+            max_concurrent_requests = int(os.getenv("MAX_CONCURRENT_REQUESTS"))
+            return max_concurrent_requests
+        except Exception:
+            return 32
+
+    @staticmethod
+    def get_background_request_share():
+        # The share of request slots that background work (moderation, summaries, etc) is guaranteed when busy
+        try:
+            background_request_share = float(os.getenv("BACKGROUND_REQUEST_SHARE"))
+            return background_request_share
+        except Exception:
+            return 0.2
+
+    @staticmethod
+    def get_rate_limit_enabled():
+        # Hold requests back on the client side when the rate limits reported by the API would be exceeded
+        try:
+            rate_limit_enabled = os.getenv("RATE_LIMIT_ENABLED")
+            if rate_limit_enabled.lower().strip() == "false":
+                return False
+            return True
+        except Exception:
+            return True
+
+    @staticmethod
+    def get_rate_limit_max_wait():
+        # The longest (in seconds) a request is held back for the rate limits before it is sent anyway
+        try:
+            rate_limit_max_wait = float(os.getenv("RATE_LIMIT_MAX_WAIT"))
+            return rate_limit_max_wait
+        except Exception:
+            return 30.0
+
+    @staticmethod
+    def get_embedding_batch_size():
+        # The most inputs that concurrent embedding requests are coalesced into
+        try:
+            embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE"))
+            return embedding_batch_size
+        except Exception:
+            return 256
+
+    @staticmethod
+    def get_embedding_batch_wait():
+        # How long (in seconds) an embedding request waits for others to be batched with
+        try:
+            embedding_batch_wait = float(os.getenv("EMBEDDING_BATCH_WAIT"))
+            return embedding_batch_wait
+        except Exception:
+            return 0.01
+
+    @staticmethod
+    def get_embedding_batch_max_tokens():
+        # The most tokens sent in a single batched embedding request
+        try:
+            embedding_batch_max_tokens = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS"))
+            return embedding_batch_max_tokens
+        except Exception:
+            return 100000
+
+    @staticmethod
+    def get_moderation_batch_size():
+        # The most messages that are moderated with a single request
+        try:
+            moderation_batch_size = int(os.getenv("MODERATION_BATCH_SIZE"))
+            return moderation_batch_size
+        except Exception:
+            return 32
+
+    @staticmethod
+    def get_moderation_batch_max_latency():
+        # How long (in seconds) a message waits for others to be moderated in the same request
+        try:
+            moderation_batch_max_latency = float(
+                os.getenv("MODERATION_BATCH_MAX_LATENCY")
+            )
+            return moderation_batch_max_latency
+        except Exception:
+            return 0.5
+
+    @staticmethod
+    def get_moderation_verdict_cache_ttl():
+        # How long (in seconds) a moderation verdict is reused for copies of the same text
+        try:
+            moderation_verdict_cache_ttl = float(
+                os.getenv("MODERATION_VERDICT_CACHE_TTL")
+            )
+            return moderation_verdict_cache_ttl
+        except Exception:
+            return 3600.0
+
+    @staticmethod
+    def get_moderation_verdict_cache_max_entries():
+        # The most moderation verdicts that are remembered
+        try:
+            moderation_verdict_cache_max_entries = int(
+                os.getenv("MODERATION_VERDICT_CACHE_MAX_ENTRIES")
+            )
+            return moderation_verdict_cache_max_entries
+        except Exception:
+            return 10000
+
+    @staticmethod
+    def get_full_conversation_history_max_items():
+        # The most recent prompts and responses that are kept in the full history of each conversation
+        try:
+            full_conversation_history_max_items = int(
+                os.getenv("FULL_CONVERSATION_HISTORY_MAX_ITEMS")
+            )
+            return full_conversation_history_max_items
+        except Exception:
+            return 100
+
+    @staticmethod
+    def get_conversation_idle_ttl():
+        # How long (in seconds) an unused conversation thread is kept in memory before it is left on disk only
+        try:
+            conversation_idle_ttl = float(os.getenv("CONVERSATION_IDLE_TTL"))
+            return conversation_idle_ttl
+        except Exception:
+            return 3600.0
+
+    @staticmethod
+    def get_moderation_blocklist_file():
+        # A file of texts, hashes and patterns that are flagged without asking the moderation endpoint
+        try:
+            moderation_blocklist_file = os.getenv("MODERATION_BLOCKLIST_FILE")
+            return moderation_blocklist_file
+        except Exception:
+            return None
+
+    @staticmethod
+    def get_embedding_cache_enabled():
+        # Keep created embeddings on disk so that the same text is never embedded twice
+        try:
+            embedding_cache_enabled = os.getenv("EMBEDDING_CACHE_ENABLED")
+            if embedding_cache_enabled.lower().strip() == "false":
+                return False
+            return True
+        except Exception:
+            return True
+
+    @staticmethod
+    def get_embedding_cache_max_entries():
+        # The most embeddings kept in the cache before the least recently used ones are evicted
+        try:
+            embedding_cache_max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES"))
+            return embedding_cache_max_entries
+        except Exception:
+            return 20000
+
+    @staticmethod
+    def get_usage_flush_interval():
+        # How often (in seconds) the usage totals kept in memory are written to disk
+        try:
+            usage_flush_interval = float(os.getenv("USAGE_FLUSH_INTERVAL"))
+            return usage_flush_interval
+        except Exception:
+            return 30.0
+
+    @staticmethod
+    def get_usage_ledger_enabled():
+        # Record every billed request in the usage ledger, for the breakdowns in /system usage
+        try:
+            usage_ledger_enabled = os.getenv("USAGE_LEDGER_ENABLED")
+            if usage_ledger_enabled.lower().strip() == "false":
+                return False
+            return True
+        except Exception:
+            return True
+
+    @staticmethod
+    def get_usage_ledger_retention_days():
+        # How many days the individual requests are kept in the usage ledger, their rollups are kept forever
+        try:
+            usage_ledger_retention_days = float(
+                os.getenv("USAGE_LEDGER_RETENTION_DAYS")
+            )
+            return usage_ledger_retention_days
+        except Exception:
+            return 30.0
+
+    @staticmethod
+    def get_debug_message_sample_rate():
+        # The share of debug messages that are sent to the debug channel
+        try:
+            debug_message_sample_rate = float(os.getenv("DEBUG_MESSAGE_SAMPLE_RATE"))
+            return debug_message_sample_rate
+        except Exception:
+            return 1.0
+
+    @staticmethod
+    def get_debug_message_max_pending():
+        # The most debug messages waiting to be sent, more than that are dropped
+        try:
+            debug_message_max_pending = int(os.getenv("DEBUG_MESSAGE_MAX_PENDING"))
+            return debug_message_max_pending
+        except Exception:
+            return 500
+
+    @staticmethod
+    def get_debug_log_enabled():
+        # Write the full text of every debug message to a rotating debug.log
+        try:
+            debug_log_enabled = os.getenv("DEBUG_LOG_ENABLED")
+            if debug_log_enabled.lower().strip() == "true":
+                return True
+            return False
+        except Exception:
+            return False
+
+    @staticmethod
+    def get_metrics_enabled():
+        # Serve Prometheus metrics at /metrics from inside the bot process
+        try:
+            metrics_enabled = os.getenv("METRICS_ENABLED")
+            if metrics_enabled.lower().strip() == "true":
+                return True
+            return False
+        except Exception:
+            return False
+
+    @staticmethod
+    def get_metrics_host():
+        # The address the metrics endpoint listens on
+        try:
+            metrics_host = os.getenv("METRICS_HOST")
+            return metrics_host if metrics_host else "0.0.0.0"
+        except Exception:
+            return "0.0.0.0"
+
+    @staticmethod
+    def get_metrics_port():
+        # The port the metrics endpoint listens on
+        try:
+            metrics_port = int(os.getenv("METRICS_PORT"))
+            return metrics_port
+        except Exception:
+            return 8182
+
+    @staticmethod
+    def get_token_count_cache_max_entries():
+        # The most token counts of long-lived strings (instructions, openers, system prompts) that are remembered
+        try:
+            token_count_cache_max_entries = int(
+                os.getenv("TOKEN_COUNT_CACHE_MAX_ENTRIES")
+            )
+            return token_count_cache_max_entries
+        except Exception:
+            return 2048
+
+    @staticmethod
+    def get_hedge_requests():
+        # Send a backup copy of chat requests that take longer than usual, and use whichever finishes first
+        try:
+            hedge_requests = os.getenv("HEDGE_REQUESTS")
+            if hedge_requests.lower().strip() == "true":
+                return True
+            return False
+        except Exception:
+            return False
+
+    @staticmethod
+    def get_hedge_max_rate():
+        # The largest share of chat requests that can be hedged
+        try:
+            hedge_max_rate = float(os.getenv("HEDGE_MAX_RATE"))
+            return hedge_max_rate
+        except Exception:
+            return 0.05
+
+    @staticmethod
+    def get_hedge_min_delay():
+        # The shortest time (in seconds) a chat request runs for before it is hedged
+        try:
+            hedge_min_delay = float(os.getenv("HEDGE_MIN_DELAY"))
+            return hedge_min_delay
+        except Exception:
+            return 5.0
+
+    @staticmethod
+    def get_response_cache_sites():
+        # The internal requests whose responses are cached: language_detect and search_refine. Moderation has its own
+        # verdict cache
+        try:
+            response_cache_sites = os.getenv("RESPONSE_CACHE_SITES")
+            if response_cache_sites is None:
+                raise ValueError
+            return [
+                site.strip().lower()
+                for site in response_cache_sites.split(",")
+                if site.strip()
+            ]
+        except Exception:
+            return ["language_detect", "search_refine"]
+
+    @staticmethod
+    def get_response_cache_ttl():
+        # How long (in seconds) a cached response stays fresh
+        try:
+            response_cache_ttl = float(os.getenv("RESPONSE_CACHE_TTL"))
+            return response_cache_ttl
+        except Exception:
+            return 3600.0
+
+    @staticmethod
+    def get_response_cache_max_entries():
+        # The most responses kept in memory, before the least recently used are dropped (or spilled to disk)
+        try:
+            response_cache_max_entries = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES"))
+            return response_cache_max_entries
+        except Exception:
+            return 5000
+
+    @staticmethod
+    def get_response_cache_spill():
+        # Keep responses pushed out of memory in a sqlite file instead of dropping them
+        try:
+            response_cache_spill = os.getenv("RESPONSE_CACHE_SPILL")
+            if response_cache_spill.lower().strip() == "true":
+                return True
+            return False
+        except Exception:
+            return False
+
+    @staticmethod
+    def get_stream_responses():
+        # Stream chat completions into the reply message as they are generated
+        try:
+            stream_responses = os.getenv("STREAM_RESPONSES")
+            if stream_responses.lower().strip() == "false":
+                return False
+            return True
+        except Exception:
+            return True
+
+    @staticmethod
+    def get_stream_edit_interval():
+        # The minimum time (in seconds) between edits of a streamed reply, to stay within discord's rate limits
+        try:
+            stream_edit_interval = float(os.getenv("STREAM_EDIT_INTERVAL"))
+            return stream_edit_interval
+        except Exception:
+            return 1.0
+
     @staticmethod
     def get_google_search_api_key():
         try:
@@ -534,6 +928,17 @@ class EnvService:
         except Exception:
             return "us-west1-gcp"
 
+    @staticmethod
+    def get_vector_memory_backend():
+        # Where the embeddings for permanent memory are kept, "pinecone" (when a PINECONE_TOKEN is set) or "local"
+        try:
+            vector_memory_backend = os.getenv("VECTOR_MEMORY_BACKEND")
+            if vector_memory_backend is None:
+                return "pinecone"
+            return vector_memory_backend.lower().strip()
+        except Exception:
+            return "pinecone"
+
     @staticmethod
     def get_max_search_price():
         try:
@@ -0,0 +1,84 @@
+import asyncio
+import time
+from collections import defaultdict, deque
+
+
+class HedgePolicy:
+    """Sends a backup copy of requests that are taking unusually long, and uses whichever copy finishes first.
+
+    A request is hedged once it has been running for longer than the recent p95 latency of requests of the same
+    kind (e.g. the same model). At most max_hedge_rate of all requests are hedged, so that a slow API can't double
+    the traffic we send it.
+    """
+
+    # Requests aren't hedged until there are enough latencies to know what slow is
+    MIN_SAMPLES = 20
+
+    def __init__(self, enabled, max_hedge_rate, min_delay, window=200):
+        self.enabled = enabled
+        self.max_hedge_rate = max_hedge_rate
+        self.min_delay = min_delay
+        self.latencies = defaultdict(lambda: deque(maxlen=window))
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def get_delay(self, kind):
+        """How long a request of this kind runs before it is hedged, or None if it shouldn't be"""
+        latencies = self.latencies[kind]
+        if len(latencies) < self.MIN_SAMPLES:
+            return None
+        p95 = sorted(latencies)[int(len(latencies) * 0.95) - 1]
+        return max(self.min_delay, p95)
+
+    def within_budget(self):
+        return self.hedges + 1 <= self.max_hedge_rate * self.requests
+
+    async def run(self, call, kind=None):
+        """Await call(), and if it is slow, a second call() alongside it. Returns the result of the first to finish"""
+        self.requests += 1
+        delay = self.get_delay(kind) if self.enabled else None
+        started = time.monotonic()
+        primary = asyncio.ensure_future(self.timed(call, kind))
+        tasks = {primary}
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self.within_budget():
+                    self.hedges += 1
+                    tasks.add(asyncio.ensure_future(self.timed(call, kind)))
+
+            while True:
+                done, tasks = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                succeeded = [task for task in done if not task.exception()]
+                if succeeded:
+                    winner = succeeded[0]
+                    break
+                if not tasks:
+                    # Every copy failed, raise the error
+                    return next(iter(done)).result()
+
+            if winner is not primary:
+                self.hedge_wins += 1
+                # The primary was cut short, but how long it ran for is still a (lower bound) latency sample
+                self.latencies[kind].append(time.monotonic() - started)
+            return winner.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def timed(self, call, kind):
+        started = time.monotonic()
+        result = await call()
+        self.latencies[kind].append(time.monotonic() - started)
+        return result
+
+    def get_stats(self):
+        return {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
@@ -0,0 +1,214 @@
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+
+class VectorTable:
+    """The embeddings of a single conversation, as a float32 matrix in a memory mapped file.
+
+    Row i of the matrix is the embedding of texts[i], the text and its timestamp are appended to a metadata file
+    next to it. The matrix grows by doubling, so appending is cheap, and a search is one matrix-vector product.
+    A text that is upserted again replaces its row, like an upsert to the same id in pinecone.
+    """
+
+    INITIAL_ROWS = 64
+
+    def __init__(self, path, dimension):
+        self.vectors_path = path.with_suffix(".f32")
+        self.metadata_path = path.with_suffix(".jsonl")
+        self.dimension = dimension
+        self.texts = []
+        self.timestamps = []
+        self.rows = {}
+        self.vectors = None
+
+        capacity = 0
+        if self.vectors_path.exists():
+            capacity = os.path.getsize(self.vectors_path) // (dimension * 4)
+            self.open_vectors(capacity)
+        if self.metadata_path.exists():
+            with open(self.metadata_path, "r", encoding="utf-8") as metadata:
+                for line in metadata:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash
+                        continue
+                    if entry["row"] < capacity:
+                        self.set_metadata(
+                            entry["row"], entry["text"], entry["timestamp"]
+                        )
+        self.metadata = open(self.metadata_path, "a", encoding="utf-8")
+
+    def open_vectors(self, capacity):
+        self.vectors = (
+            np.memmap(
+                self.vectors_path,
+                dtype=np.float32,
+                mode="r+",
+                shape=(capacity, self.dimension),
+            )
+            if capacity
+            else None
+        )
+
+    def capacity(self):
+        return 0 if self.vectors is None else self.vectors.shape[0]
+
+    def grow(self, rows):
+        capacity = max(self.capacity(), self.INITIAL_ROWS)
+        while capacity < rows:
+            capacity *= 2
+        if capacity == self.capacity():
+            return
+        self.vectors = None
+        with open(self.vectors_path, "ab") as vectors:
+            vectors.truncate(capacity * self.dimension * 4)
+        self.open_vectors(capacity)
+
+    def set_metadata(self, row, text, timestamp):
+        if row >= len(self.texts):
+            padding = row + 1 - len(self.texts)
+            self.texts.extend([None] * padding)
+            self.timestamps.extend([0] * padding)
+        self.texts[row] = text
+        self.timestamps[row] = timestamp
+        self.rows[text] = row
+
+    def upsert(self, items):
+        """Add (text, embedding, timestamp) items, the vectors are written before the metadata that points to them"""
+        rows = []
+        # Rows given out by this batch, so a text that is in it twice gets a single row
+        allocated = {}
+        next_row = len(self.texts)
+        for text, _, _ in items:
+            row = self.rows.get(text, allocated.get(text))
+            if row is None:
+                row = allocated[text] = next_row
+                next_row += 1
+            rows.append(row)
+        self.grow(next_row)
+
+        self.vectors[rows] = np.asarray(
+            [embedding for _, embedding, _ in items], dtype=np.float32
+        )
+        for row, (text, _, timestamp) in zip(rows, items):
+            self.set_metadata(row, text, timestamp)
+            self.metadata.write(
+                json.dumps({"row": row, "text": text, "timestamp": timestamp}) + "\n"
+            )
+        self.metadata.flush()
+
+    def search(self, embedding, n):
+        """The rows of the n texts whose embeddings have the highest dot product with embedding"""
+        count = len(self.texts)
+        if not count or n <= 0:
+            return []
+        scores = self.vectors[:count] @ np.asarray(embedding, dtype=np.float32)
+        if n >= count:
+            return list(range(count))
+        return np.argpartition(scores, count - n)[count - n :].tolist()
+
+    def close(self):
+        self.metadata.close()
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+
+
+class LocalVectorService:
+    """Conversation memory kept on the local disk, in place of PineconeService and with the same methods.
+
+    Each conversation has its own VectorTable, so a lookup only ever scores the embeddings of that conversation and
+    needs no network. Tables are opened when a conversation is first used, and the least recently used ones are
+    closed when too many are open.
+    """
+
+    # Texts longer than this are split into chunks that are embedded separately, the same as PineconeService
+    CHUNK_SIZE = 500
+
+    MAX_OPEN_TABLES = 256
+
+    def __init__(self, path, dimension=1536):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.dimension = dimension
+        self.tables = OrderedDict()
+
+    def get_table(self, conversation_id):
+        table = self.tables.get(conversation_id)
+        if table is None:
+            name = "basic" if conversation_id is None else str(conversation_id)
+            table = self.tables[conversation_id] = VectorTable(
+                self.path / name, self.dimension
+            )
+            while len(self.tables) > self.MAX_OPEN_TABLES:
+                self.tables.popitem(last=False)[1].close()
+        self.tables.move_to_end(conversation_id)
+        return table
+
+    def upsert_basic(self, text, embeddings):
+        self.get_table(None).upsert([(text, embeddings, 0)])
+
+    def get_all_for_conversation(self, conversation_id: int):
+        table = self.get_table(conversation_id)
+        return {
+            "matches": [
+                {
+                    "id": text,
+                    "metadata": {
+                        "conversation_id": conversation_id,
+                        "timestamp": timestamp,
+                    },
+                }
+                for text, timestamp in zip(table.texts, table.timestamps)
+            ][:100]
+        }
+
+    async def upsert_conversation_embedding(
+        self, model, conversation_id: int, text, timestamp, custom_api_key=None
+    ):
+        chunks = [
+            text[i : i + self.CHUNK_SIZE] for i in range(0, len(text), self.CHUNK_SIZE)
+        ] or [text]
+        # Request the embeddings for all the chunks together, so that they are batched into one request
+        embeddings = await asyncio.gather(
+            *[
+                model.send_embedding_request(chunk, custom_api_key=custom_api_key)
+                for chunk in chunks
+            ]
+        )
+        self.get_table(conversation_id).upsert(
+            [
+                (chunk, embedding, timestamp)
+                for chunk, embedding in zip(chunks, embeddings)
+            ]
+        )
+        return embeddings[0]
+
+    def get_n_similar(self, conversation_id: int, embedding, n=10):
+        table = self.get_table(conversation_id)
+        relevant_phrases = [
+            (table.texts[row], table.timestamps[row])
+            for row in table.search(embedding, n)
+        ]
+        # Sort the relevant phrases based on the timestamp
+        relevant_phrases.sort(key=lambda x: x[1])
+        return relevant_phrases
+
+    def get_all_conversation_items(self, conversation_id: int):
+        table = self.get_table(conversation_id)
+        return [
+            text
+            for _, text in sorted(
+                zip(table.timestamps, table.texts), key=lambda item: item[0]
+            )
+        ]
+
+    def close(self):
+        while self.tables:
+            self.tables.popitem()[1].close()
@@ -1,4 +1,12 @@
 import asyncio
+import logging
+import random
+import time
+import traceback
+from collections import OrderedDict, deque
+from logging.handlers import RotatingFileHandler
+
+from services.metrics_service import METRICS
 
 
 class Message:
@@ -6,25 +14,133 @@ class Message:
         self.content = content
         self.channel = channel
 
-    # This function will be called by the bot to process the message queue
-    @staticmethod
-    async def process_message_queue(message_queue, PROCESS_WAIT_TIME, EMPTY_WAIT_TIME):
+
+class MessageDispatcher:
+    """Sends queued messages (mostly debug output) to their channels, merging the ones waiting for the same channel
+    into as few Discord messages as possible.
+
+    The dispatcher sleeps until something is queued instead of polling. At most max_pending messages are held,
+    messages queued past that are dropped and counted. Debug messages can be sampled, and their full text written
+    to a rotating log file whether or not they are sampled.
+    """
+
+    # The longest message Discord accepts
+    MAX_MESSAGE_LENGTH = 2000
+
+    def __init__(self, max_pending=500, sample_rate=1.0, log_path=None):
+        self.max_pending = max_pending
+        self.sample_rate = sample_rate
+        # Channel id to (channel, deque of (time queued, content))
+        self.pending = OrderedDict()
+        self.pending_count = 0
+        self.wakeup = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+        self.sampled_out = 0
+
+        self.log = None
+        if log_path:
+            self.log = logging.getLogger("gpt3discord.debug")
+            self.log.propagate = False
+            handler = RotatingFileHandler(
+                log_path, maxBytes=10 * 1024 * 1024, backupCount=3, encoding="utf-8"
+            )
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.log.addHandler(handler)
+            self.log.setLevel(logging.INFO)
+
+    async def put(self, message):
+        """Queue a message to be sent to its channel, keeps the interface of asyncio.Queue"""
+        self.put_nowait(message)
+
+    def put_nowait(self, message):
+        self.put_all_nowait([message])
+
+    async def put_all(self, messages):
+        """Queue the parts of one message, either all of them or, when they don't all fit, none of them"""
+        return self.put_all_nowait(messages)
+
+    def put_all_nowait(self, messages):
+        # A message split over several parts is dropped whole, so a fenced code block is never left half sent
+        if self.pending_count + len(messages) > self.max_pending:
+            self.dropped += len(messages)
+            METRICS.inc("debug_messages_dropped_total", value=len(messages))
+            return False
+        for message in messages:
+            channel_id = getattr(message.channel, "id", message.channel)
+            if channel_id not in self.pending:
+                self.pending[channel_id] = (message.channel, deque())
+            self.pending[channel_id][1].append((time.monotonic(), str(message.content)))
+            self.pending_count += 1
+        if messages:
+            self.wakeup.set()
+        return True
+
+    def accept_debug(self, debug_message):
+        """Log a debug message, and decide whether it is also sent to the debug channel"""
+        if self.log:
+            self.log.info(debug_message)
+        if self.sample_rate >= 1 or random.random() < self.sample_rate:
+            return True
+        self.sampled_out += 1
+        return False
+
+    def qsize(self):
+        return self.pending_count
+
+    def empty(self):
+        return self.pending_count == 0
+
+    def oldest_wait(self):
+        """How long the longest waiting message has been waiting for"""
+        queued = [messages[0][0] for _, messages in self.pending.values() if messages]
+        return time.monotonic() - min(queued) if queued else 0.0
+
+    def take_batch(self, channel_id):
+        """Take as many of the messages waiting for a channel as fit in a single Discord message"""
+        channel, messages = self.pending[channel_id]
+        parts = []
+        length = 0
+        while messages:
+            queued, content = messages[0]
+            if not parts and len(content) > self.MAX_MESSAGE_LENGTH:
+                # Too long to send whole, send what fits and leave the rest at the front
+                parts.append(content[: self.MAX_MESSAGE_LENGTH])
+                messages[0] = (queued, content[self.MAX_MESSAGE_LENGTH :])
+                break
+            added = len(content) + (1 if parts else 0)
+            if length + added > self.MAX_MESSAGE_LENGTH:
+                break
+            messages.popleft()
+            self.pending_count -= 1
+            METRICS.observe(
+                "queue_wait_seconds", time.monotonic() - queued, ("message_queue", "")
+            )
+            parts.append(content)
+            length += added
+        if not messages:
+            del self.pending[channel_id]
+        return channel, "\n".join(parts)
+
+    async def process(self, send_interval):
+        """Send the queued messages, waiting send_interval between sends so the bot doesn't spam the channels"""
         while True:
-            await asyncio.sleep(PROCESS_WAIT_TIME)
-            # If the queue is empty, sleep for a short time before checking again
-            if message_queue.empty():
-                await asyncio.sleep(EMPTY_WAIT_TIME)
-                continue
-
-            # Get the next message from the queue
-            message = await message_queue.get()
-
-            # Send the message
-            try:
-                await message.channel.send(message.content)
-            except Exception:
-                pass
-
-            # Sleep for a short time before processing the next message
-            # This will prevent the bot from spamming messages too quickly
-            await asyncio.sleep(PROCESS_WAIT_TIME)
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.pending:
+                for channel_id in list(self.pending):
+                    channel, content = self.take_batch(channel_id)
+                    try:
+                        await channel.send(content)
+                        self.sent += 1
+                    except Exception:
+                        traceback.print_exc()
+                    await asyncio.sleep(send_interval)
+
+    def get_stats(self):
+        return {
+            "pending": self.pending_count,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+        }
@@ -0,0 +1,368 @@
+import asyncio
+import math
+import threading
+import time
+import traceback
+from collections import defaultdict, deque
+
+from aiohttp import web
+
+
+def escape(value):
+    """Escape a label value for the Prometheus text format"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    """Cumulative bucket counts of observed values, in the shape Prometheus expects"""
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+
+class Metrics:
+    """Counters, gauges and histograms for the bot, rendered in the Prometheus text format.
+
+    Metrics are created on first use, so instrumenting a code path is a single call. Gauges are read from callbacks
+    when the metrics are scraped (queue depths, active threads), so nothing has to keep them up to date. A callback
+    returns a single value, or a dict of label tuples to values.
+    """
+
+    LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+    RATE_BUCKETS = [1, 5, 10, 25, 50, 100, 200, 400]
+    LAG_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5]
+    BYTES_BUCKETS = [1e3, 1e4, 1e5, 1e6, 1e7, 1e8]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.label_names = {}
+        self.counters = defaultdict(lambda: defaultdict(float))
+        self.histograms = defaultdict(dict)
+        self.histogram_buckets = {}
+        self.gauges = {}
+
+    def describe(self, name, help_text, label_names=()):
+        self.help[name] = help_text
+        self.label_names[name] = tuple(label_names)
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            self.counters[name][tuple(labels)] += value
+
+    def observe(self, name, value, labels=(), buckets=None):
+        with self.lock:
+            histograms = self.histograms[name]
+            histogram = histograms.get(tuple(labels))
+            if histogram is None:
+                buckets = self.histogram_buckets.setdefault(
+                    name, buckets or self.LATENCY_BUCKETS
+                )
+                histogram = histograms[tuple(labels)] = Histogram(buckets)
+            histogram.observe(value)
+
+    def register_gauge(self, name, help_text, callback, label_names=()):
+        self.describe(name, help_text, label_names)
+        self.gauges[name] = callback
+
+    def get_counter(self, name, labels=()):
+        return self.counters[name].get(tuple(labels), 0)
+
+    def get_histogram(self, name, labels=()):
+        return self.histograms[name].get(tuple(labels))
+
+    def format_labels(self, name, labels, extra=()):
+        pairs = list(zip(self.label_names.get(name, ()), labels)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in pairs) + "}"
+
+    @staticmethod
+    def format_value(value):
+        if value == math.inf:
+            return "+Inf"
+        return repr(float(value))
+
+    def render(self):
+        """The current value of every metric in the Prometheus text exposition format"""
+        lines = []
+
+        def header(name, kind):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                header(name, "counter")
+                for labels, value in series.items():
+                    lines.append(
+                        f"{name}{self.format_labels(name, labels)} {self.format_value(value)}"
+                    )
+
+            for name, series in sorted(self.histograms.items()):
+                header(name, "histogram")
+                for labels, histogram in series.items():
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(
+                            f"{name}_bucket{self.format_labels(name, labels, [('le', bound)])} {count}"
+                        )
+                    lines.append(
+                        f"{name}_bucket{self.format_labels(name, labels, [('le', '+Inf')])} {histogram.count}"
+                    )
+                    lines.append(
+                        f"{name}_sum{self.format_labels(name, labels)} {self.format_value(histogram.sum)}"
+                    )
+                    lines.append(
+                        f"{name}_count{self.format_labels(name, labels)} {histogram.count}"
+                    )
+
+        for name, callback in sorted(self.gauges.items()):
+            try:
+                values = callback()
+            except Exception:
+                traceback.print_exc()
+                continue
+            header(name, "gauge")
+            if not isinstance(values, dict):
+                values = {(): values}
+            for labels, value in values.items():
+                if value is None:
+                    continue
+                lines.append(
+                    f"{name}{self.format_labels(name, labels)} {self.format_value(value)}"
+                )
+
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+METRICS.describe(
+    "openai_request_duration_seconds",
+    "Latency of OpenAI API requests, including the wait for a request slot",
+    ["endpoint", "model"],
+)
+METRICS.describe(
+    "openai_time_to_first_token_seconds",
+    "Time until the first token of a streamed chat completion arrives",
+    ["endpoint", "model"],
+)
+METRICS.describe(
+    "openai_completion_tokens_per_second",
+    "Completion tokens generated per second of each OpenAI API request",
+    ["endpoint", "model"],
+)
+METRICS.describe(
+    "openai_requests_total",
+    "OpenAI API requests by the status of their response, or error if no response came back",
+    ["endpoint", "model", "status"],
+)
+METRICS.describe(
+    "event_loop_lag_seconds",
+    "How late the event loop was in waking up the lag probe, the time it spent blocked",
+)
+METRICS.describe(
+    "debug_messages_dropped_total",
+    "Debug messages dropped because too many were already waiting to be sent",
+)
+METRICS.describe(
+    "moderation_lag_seconds",
+    "How long after it was due a message was moderated",
+    ["guild"],
+)
+METRICS.describe(
+    "moderation_verdicts_total",
+    "Moderation verdicts by where they came from: the prefilter, the verdict cache or the api",
+    ["source"],
+)
+METRICS.describe(
+    "conversation_save_seconds",
+    "How long saving the conversations that changed took",
+)
+METRICS.describe(
+    "conversation_snapshot_capture_seconds",
+    "How long copying the conversations that changed held up the event loop for",
+)
+METRICS.describe(
+    "conversation_snapshot_serialize_seconds",
+    "How long pickling and compressing a snapshot of the changed conversations took, off the event loop",
+)
+METRICS.describe(
+    "conversation_snapshot_bytes",
+    "Compressed size of each snapshot of the changed conversations",
+)
+METRICS.describe(
+    "conversation_rows_written_total",
+    "Conversation records written to the conversation store",
+)
+METRICS.describe(
+    "queue_wait_seconds",
+    "How long items waited in a queue before being taken off it",
+    ["queue", "guild"],
+)
+
+
+def endpoint_of(url, api_base):
+    """The API path a request is for (e.g. chat/completions), without the base url"""
+    if url.startswith(api_base):
+        url = url[len(api_base) :]
+    return url.split("?")[0].strip("/")
+
+
+def observe_openai_request(
+    endpoint, model, status, latency=None, completion_tokens=None, generation_time=None
+):
+    """Record the outcome of a single OpenAI API request"""
+    labels = (endpoint, model or "")
+    METRICS.inc("openai_requests_total", labels + (str(status),))
+    if latency is not None:
+        METRICS.observe("openai_request_duration_seconds", latency, labels)
+    if completion_tokens and generation_time:
+        METRICS.observe(
+            "openai_completion_tokens_per_second",
+            completion_tokens / generation_time,
+            labels,
+            buckets=Metrics.RATE_BUCKETS,
+        )
+
+
+class TimedQueue(asyncio.Queue):
+    """An asyncio.Queue that records how long its items wait in it, for the queue depth and wait metrics"""
+
+    def __init__(self, name, guild=None, maxsize=0):
+        self.name = name
+        self.guild = guild
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self._put_times = deque()
+
+    def _put(self, item):
+        self._put_times.append(time.monotonic())
+        super()._put(item)
+
+    def _get(self):
+        METRICS.observe(
+            "queue_wait_seconds",
+            time.monotonic() - self._put_times.popleft(),
+            (self.name, "" if self.guild is None else str(self.guild)),
+        )
+        return super()._get()
+
+    def oldest_wait(self):
+        """How long the item at the front of the queue has been waiting for"""
+        return time.monotonic() - self._put_times[0] if self._put_times else 0.0
+
+
+# The queues whose depth and wait are reported, by name. Each is a function that returns a dict of guild (or None,
+# for queues that aren't per guild) to queue
+QUEUES = {}
+
+
+def register_queue(name, get_queues):
+    QUEUES[name] = get_queues
+
+
+def get_queue_gauges(measure):
+    values = {}
+    for name, get_queues in list(QUEUES.items()):
+        for guild, queue in list(get_queues().items()):
+            if queue is not None:
+                values[(name, "" if guild is None else str(guild))] = measure(queue)
+    return values
+
+
+METRICS.register_gauge(
+    "queue_depth",
+    "Items waiting in a queue",
+    lambda: get_queue_gauges(lambda queue: queue.qsize()),
+    ["queue", "guild"],
+)
+METRICS.register_gauge(
+    "queue_oldest_wait_seconds",
+    "How long the item at the front of a queue has been waiting",
+    lambda: get_queue_gauges(
+        lambda queue: queue.oldest_wait() if hasattr(queue, "oldest_wait") else None
+    ),
+    ["queue", "guild"],
+)
+
+
+def get_executor_backlog(loop):
+    """Jobs waiting for a thread in the default executor of the loop"""
+    executor = getattr(loop, "_default_executor", None)
+    work_queue = getattr(executor, "_work_queue", None)
+    return work_queue.qsize() if work_queue is not None else 0
+
+
+class MetricsService:
+    """Serves the metrics at /metrics from inside the bot's event loop, for Prometheus to scrape"""
+
+    # How often the event loop lag is measured, in seconds
+    LOOP_LAG_INTERVAL = 1.0
+
+    def __init__(self, host="0.0.0.0", port=8182):
+        self.host = host
+        self.port = port
+        self.runner = None
+        self.loop_lag = 0.0
+        self.lag_task = None
+
+    async def handle_metrics(self, request):
+        return web.Response(
+            text=METRICS.render(),
+            content_type="text/plain",
+            charset="utf-8",
+            headers={"Cache-Control": "no-cache"},
+        )
+
+    async def measure_loop_lag(self):
+        """Sleep for a fixed interval, any extra time it took to wake up is time the loop was blocked for"""
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.LOOP_LAG_INTERVAL)
+            self.loop_lag = max(
+                0.0, time.monotonic() - started - self.LOOP_LAG_INTERVAL
+            )
+            METRICS.observe(
+                "event_loop_lag_seconds", self.loop_lag, buckets=Metrics.LAG_BUCKETS
+            )
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        METRICS.register_gauge(
+            "event_loop_lag_seconds_last",
+            "How late the event loop was in waking up the last lag probe",
+            lambda: self.loop_lag,
+        )
+        METRICS.register_gauge(
+            "executor_backlog",
+            "Jobs waiting for a thread in the default executor",
+            lambda: get_executor_backlog(loop),
+        )
+        self.lag_task = asyncio.ensure_future(self.measure_loop_lag())
+
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        print(f"Serving metrics at http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.lag_task:
+            self.lag_task.cancel()
+        if self.runner:
+            await self.runner.cleanup()
@@ -0,0 +1,175 @@
+import hashlib
+import re
+import time
+import traceback
+import unicodedata
+from collections import OrderedDict
+
+from services.metrics_service import METRICS
+from services.single_flight_service import SingleFlight
+
+# The categories of the moderation endpoint, a verdict made locally scores all of them
+MODERATION_CATEGORIES = [
+    "harassment",
+    "harassment/threatening",
+    "hate",
+    "hate/threatening",
+    "illicit",
+    "illicit/violent",
+    "self-harm",
+    "self-harm/intent",
+    "self-harm/instructions",
+    "sexual",
+    "sexual/minors",
+    "violence",
+    "violence/graphic",
+]
+
+
+def normalize(text):
+    """Reduce text to a form that is the same for copies that only differ in case, spacing, invisible characters or
+    stretched out letters, so that one verdict covers all of them
+    """
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    text = "".join(char for char in text if unicodedata.category(char) != "Cf")
+    text = re.sub(r"(.)\1{3,}", r"\1\1\1", text)
+    return " ".join(text.split())
+
+
+def hash_text(normalized):
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def make_verdict(flagged):
+    """A moderation response decided locally, in the same shape as the ones of the moderation endpoint"""
+    score = 1.0 if flagged else 0.0
+    return {
+        "id": "local",
+        "model": "local",
+        "results": [
+            {
+                "flagged": flagged,
+                "categories": {category: flagged for category in MODERATION_CATEGORIES},
+                "category_scores": {
+                    category: score for category in MODERATION_CATEGORIES
+                },
+            }
+        ],
+    }
+
+
+class ModerationPrefilter:
+    """A blocklist that flags obvious cases without asking the moderation endpoint.
+
+    Each line of the blocklist file is a regular expression prefixed with re:, a sha256 of normalized text prefixed
+    with sha256:, or plain text that is blocked when a message normalizes to the same text. Empty lines and lines
+    starting with # are ignored.
+    """
+
+    def __init__(self, hashes=(), patterns=()):
+        self.hashes = set(hashes)
+        self.patterns = list(patterns)
+
+    @staticmethod
+    def load(path):
+        hashes = []
+        patterns = []
+        with open(path, "r", encoding="utf-8") as blocklist:
+            for line in blocklist:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if line.startswith("re:"):
+                    patterns.append(re.compile(line[len("re:") :]))
+                elif line.startswith("sha256:"):
+                    hashes.append(line[len("sha256:") :].strip().lower())
+                else:
+                    hashes.append(hash_text(normalize(line)))
+        return ModerationPrefilter(hashes, patterns)
+
+    def is_blocked(self, normalized, key):
+        return key in self.hashes or any(
+            pattern.search(normalized) for pattern in self.patterns
+        )
+
+
+class ModerationVerdictCache:
+    """Remembers moderation verdicts by a hash of the normalized text, so that copies of the same content posted over
+    and over (like during a raid) are only sent to the moderation endpoint once.
+
+    Text is first checked against the prefilter, if there is one. Blocked text, and text that is empty once
+    normalized, is decided without a request.
+    """
+
+    def __init__(self, max_entries, ttl, prefilter=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prefilter = prefilter
+        self.entries = OrderedDict()
+        self.single_flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.blocked = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, response):
+        self.entries[key] = (time.time() + self.ttl, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def moderate(self, text, call):
+        """The moderation response for text, from the prefilter, the cache, or by awaiting call()"""
+        normalized = normalize(text)
+        key = hash_text(normalized)
+
+        if not normalized:
+            METRICS.inc("moderation_verdicts_total", ("prefilter",))
+            return make_verdict(False)
+        if self.prefilter and self.prefilter.is_blocked(normalized, key):
+            self.blocked += 1
+            METRICS.inc("moderation_verdicts_total", ("prefilter",))
+            return make_verdict(True)
+
+        response = self.get(key)
+        if response is not None:
+            self.hits += 1
+            METRICS.inc("moderation_verdicts_total", ("cache",))
+            return response
+
+        self.misses += 1
+        METRICS.inc("moderation_verdicts_total", ("api",))
+        # Near-identical copies that arrive at the same time share a single request
+        response = await self.single_flight.do(key, call)
+        if isinstance(response, dict) and response.get("results"):
+            self.put(key, response)
+        return response
+
+    def get_stats(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "blocked": self.blocked,
+        }
+
+
+def load_prefilter(path):
+    """The prefilter for the blocklist at path, or None if there isn't one"""
+    if not path:
+        return None
+    try:
+        return ModerationPrefilter.load(path)
+    except Exception:
+        traceback.print_exc()
+        print(f"Could not load the moderation blocklist at {path}")
+        return None
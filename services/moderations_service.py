@@ -9,6 +9,7 @@ import discord
 
 from models.openai_model import Model
 from services.environment_service import EnvService
+from services.metrics_service import METRICS
 from services.usage_service import UsageService
 
 usage_service = UsageService(Path(os.environ.get("DATA_DIR", os.getcwd())))
@@ -87,6 +88,9 @@ class Moderation:
     moderation_tasks = {}
     moderations_launched = []
 
+    # The most messages of a guild that are being moderated at once
+    MAX_IN_FLIGHT = 256
+
     def __init__(self, message, timestamp):
         self.message = message
         self.timestamp = timestamp
@@ -239,81 +243,93 @@ class Moderation:
     @staticmethod
     async def process_moderation_queue(
         moderation_queue,
-        PROCESS_WAIT_TIME,
-        EMPTY_WAIT_TIME,
         moderations_alert_channel,
         warn_set,
         delete_set,
     ):
+        """Take messages off the queue as they become due and moderate them. Messages are moderated concurrently, so
+        that they are sent in batches together with the messages of every other guild.
+        """
+        in_flight = asyncio.Semaphore(Moderation.MAX_IN_FLIGHT)
         while True:
             try:
-                # If the queue is empty, sleep for a short time before checking again
-                if moderation_queue.empty():
-                    await asyncio.sleep(EMPTY_WAIT_TIME)
-                    continue
-
-                # Get the next message from the queue
                 to_moderate = await moderation_queue.get()
 
-                # Check if the current timestamp is greater than the deletion timestamp
-                if datetime.now().timestamp() > to_moderate.timestamp:
-                    response = await model.send_moderations_request(
-                        to_moderate.message.content
-                    )
-                    moderation_result = Moderation.determine_moderation_result(
-                        to_moderate.message.content, response, warn_set, delete_set
+                # Messages are moderated a short while after they are sent
+                delay = to_moderate.timestamp - datetime.now().timestamp()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                await in_flight.acquire()
+                task = asyncio.ensure_future(
+                    Moderation.moderate_message(
+                        to_moderate, moderations_alert_channel, warn_set, delete_set
                     )
+                )
+                task.add_done_callback(lambda _: in_flight.release())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
 
-                    if moderation_result == ModerationResult.DELETE:
-                        # Take care of the flagged message
-                        response_message = await to_moderate.message.reply(
-                            embed=Moderation.build_moderation_embed()
-                        )
-                        # Do the same response as above but use an ephemeral message
-                        await to_moderate.message.delete()
-
-                        # Send to the moderation alert channel
-                        if moderations_alert_channel:
-                            response_message = await moderations_alert_channel.send(
-                                embed=Moderation.build_admin_moderated_message(
-                                    to_moderate, response_message
-                                )
-                            )
-                            await response_message.edit(
-                                view=ModerationAdminView(
-                                    to_moderate.message,
-                                    response_message,
-                                    True,
-                                    True,
-                                    True,
-                                )
-                            )
-
-                    elif moderation_result == ModerationResult.WARN:
-                        response_message = await moderations_alert_channel.send(
-                            embed=Moderation.build_admin_warning_message(
-                                to_moderate.message
-                            ),
+    @staticmethod
+    async def moderate_message(
+        to_moderate, moderations_alert_channel, warn_set, delete_set
+    ):
+        try:
+            response = await model.send_batched_moderations_request(
+                to_moderate.message.content
+            )
+            METRICS.observe(
+                "moderation_lag_seconds",
+                datetime.now().timestamp() - to_moderate.timestamp,
+                (str(to_moderate.message.guild.id),),
+            )
+            moderation_result = Moderation.determine_moderation_result(
+                to_moderate.message.content, response, warn_set, delete_set
+            )
+
+            if moderation_result == ModerationResult.DELETE:
+                # Take care of the flagged message
+                response_message = await to_moderate.message.reply(
+                    embed=Moderation.build_moderation_embed()
+                )
+                # Do the same response as above but use an ephemeral message
+                await to_moderate.message.delete()
+
+                # Send to the moderation alert channel
+                if moderations_alert_channel:
+                    response_message = await moderations_alert_channel.send(
+                        embed=Moderation.build_admin_moderated_message(
+                            to_moderate, response_message
                         )
-                        # Attempt to react to the to_moderate.message with a warning icon
-                        try:
-                            await to_moderate.message.add_reaction("⚠️")
-                        except discord.errors.Forbidden:
-                            pass
-
-                        await response_message.edit(
-                            view=ModerationAdminView(
-                                to_moderate.message, response_message
-                            )
+                    )
+                    await response_message.edit(
+                        view=ModerationAdminView(
+                            to_moderate.message,
+                            response_message,
+                            True,
+                            True,
+                            True,
                         )
+                    )
 
-                else:
-                    await moderation_queue.put(to_moderate)
-                # Sleep for a short time before processing the next message
-                # This will prevent the bot from spamming messages too quickly
-                await asyncio.sleep(PROCESS_WAIT_TIME)
-            except Exception:
-                traceback.print_exc()
+            elif moderation_result == ModerationResult.WARN:
+                response_message = await moderations_alert_channel.send(
+                    embed=Moderation.build_admin_warning_message(to_moderate.message),
+                )
+                # Attempt to react to the to_moderate.message with a warning icon
+                try:
+                    await to_moderate.message.add_reaction("⚠️")
+                except discord.errors.Forbidden:
+                    pass
+
+                await response_message.edit(
+                    view=ModerationAdminView(to_moderate.message, response_message)
+                )
+        except Exception:
+            traceback.print_exc()
+            print(f"Could not moderate message {to_moderate.message.id}")
 
 
 class ModerationAdminView(discord.ui.View):
@@ -1,3 +1,5 @@
+import asyncio
+
 import pinecone
 
 
@@ -18,25 +20,27 @@ class PineconeService:
         self, model, conversation_id: int, text, timestamp, custom_api_key=None
     ):
         # If the text is > 512 characters, we need to split it up into multiple entries.
-        first_embedding = None
         if len(text) > 500:
             # Split the text into 512 character chunks
             chunks = [text[i : i + 500] for i in range(0, len(text), 500)]
-            for chunk in chunks:
-                # Create an embedding for the split chunk
-                embedding = await model.send_embedding_request(
-                    chunk, custom_api_key=custom_api_key
-                )
-                if not first_embedding:
-                    first_embedding = embedding
-                self.index.upsert(
-                    [(chunk, embedding)],
-                    metadata={
-                        "conversation_id": conversation_id,
-                        "timestamp": timestamp,
-                    },
-                )
-            return first_embedding
+            # Request the embeddings for all the chunks together, so that they are batched into one request
+            embeddings = await asyncio.gather(
+                *[
+                    model.send_embedding_request(chunk, custom_api_key=custom_api_key)
+                    for chunk in chunks
+                ]
+            )
+            self.index.upsert(
+                [
+                    (
+                        chunk,
+                        embedding,
+                        {"conversation_id": conversation_id, "timestamp": timestamp},
+                    )
+                    for chunk, embedding in zip(chunks, embeddings)
+                ]
+            )
+            return embeddings[0]
         embedding = await model.send_embedding_request(
             text, custom_api_key=custom_api_key
         )
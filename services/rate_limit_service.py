@@ -0,0 +1,118 @@
+import asyncio
+import re
+import time
+
+RESET_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+RESET_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset_duration(value):
+    """Parse a reset duration from the ratelimit headers, like 20ms, 1s or 6m0s, into seconds"""
+    return sum(
+        float(amount) * RESET_DURATION_UNITS[unit]
+        for amount, unit in RESET_DURATION_PATTERN.findall(value or "")
+    )
+
+
+class TokenBucket:
+    """A token bucket that is kept in sync with the limits the API reports back"""
+
+    def __init__(self):
+        # Until the API has told us about the limits, the bucket lets everything through
+        self.capacity = None
+        self.tokens = 0.0
+        self.refill_rate = 0.0
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        if self.capacity is not None:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.refill_rate
+            )
+        self.updated = now
+
+    def wait_time(self, amount):
+        """How long until amount tokens are available"""
+        self.refill()
+        if self.capacity is None:
+            return 0
+        # A single request bigger than the whole bucket can only wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        if self.refill_rate <= 0:
+            return float("inf")
+        return (amount - self.tokens) / self.refill_rate
+
+    def consume(self, amount):
+        self.refill()
+        if self.capacity is not None:
+            self.tokens -= min(amount, self.capacity)
+
+    def sync(self, limit, remaining, reset_seconds):
+        self.refill()
+        # Requests we've sent since the API produced these headers are already taken out locally, so the lower
+        # of the two counts is the better estimate
+        self.tokens = (
+            remaining if self.capacity is None else min(self.tokens, remaining)
+        )
+        self.capacity = limit
+        if reset_seconds > 0 and remaining < limit:
+            self.refill_rate = (limit - remaining) / reset_seconds
+        else:
+            # The limits are per minute
+            self.refill_rate = limit / 60
+
+
+class RateLimiter:
+    """Proactive client side rate limiting, driven by the x-ratelimit headers of the OpenAI API.
+
+    OpenAI limits requests and tokens per minute, per organization and model. There is a bucket of each per API
+    key, organization and model, so user keys and the organization key never share a limit. Requests wait for
+    their estimated cost to be available in both buckets before they are sent, instead of failing with a 429.
+    """
+
+    def __init__(self, max_wait):
+        self.max_wait = max_wait
+        self.buckets = {}
+
+    def get_buckets(self, key):
+        if key not in self.buckets:
+            self.buckets[key] = (TokenBucket(), TokenBucket())
+        return self.buckets[key]
+
+    async def acquire(self, key, tokens):
+        """Wait until a request costing tokens can be sent without going over the limits for key"""
+        requests_bucket, tokens_bucket = self.get_buckets(key)
+        waited = 0
+        while True:
+            wait = max(requests_bucket.wait_time(1), tokens_bucket.wait_time(tokens))
+            # Never hold a request back forever, past max_wait it is sent and the API decides
+            if wait <= 0 or waited >= self.max_wait:
+                break
+            wait = min(wait, self.max_wait - waited)
+            await asyncio.sleep(wait)
+            waited += wait
+        requests_bucket.consume(1)
+        tokens_bucket.consume(tokens)
+        return waited
+
+    def update(self, key, headers):
+        """Sync the buckets for key with the ratelimit headers of a response"""
+        requests_bucket, tokens_bucket = self.get_buckets(key)
+        try:
+            if "x-ratelimit-limit-requests" in headers:
+                requests_bucket.sync(
+                    int(headers["x-ratelimit-limit-requests"]),
+                    int(headers["x-ratelimit-remaining-requests"]),
+                    parse_reset_duration(headers.get("x-ratelimit-reset-requests")),
+                )
+            if "x-ratelimit-limit-tokens" in headers:
+                tokens_bucket.sync(
+                    int(headers["x-ratelimit-limit-tokens"]),
+                    int(headers["x-ratelimit-remaining-tokens"]),
+                    parse_reset_duration(headers.get("x-ratelimit-reset-tokens")),
+                )
+        except (KeyError, ValueError):
+            pass
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+
+class Priority:
+    INTERACTIVE = "interactive"
+    BACKGROUND = "background"
+
+    ALL = [INTERACTIVE, BACKGROUND]
+
+
+class RequestScheduler:
+    """Limits how many requests to the API are in flight at once, and decides who gets the next free slot.
+
+    Interactive requests (someone is waiting on the reply) always go ahead of queued background work, except that
+    while both are waiting, background_share of the slots go to background requests so they are delayed but never
+    starved.
+    """
+
+    def __init__(self, max_concurrent, background_share):
+        self.max_concurrent = max_concurrent
+        # After this many interactive requests were let through ahead of waiting background work, one background
+        # request goes next
+        self.interactive_run = max(
+            1, round((1 - background_share) / max(background_share, 0.01))
+        )
+        self.interactive_granted = 0
+        self.in_flight = {priority: 0 for priority in Priority.ALL}
+        self.waiters = {priority: deque() for priority in Priority.ALL}
+        self.started = {priority: 0 for priority in Priority.ALL}
+        self.total_wait = {priority: 0.0 for priority in Priority.ALL}
+        self.max_wait = {priority: 0.0 for priority in Priority.ALL}
+
+    @asynccontextmanager
+    async def slot(self, priority=Priority.INTERACTIVE):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    async def acquire(self, priority):
+        queued = time.monotonic()
+        if sum(self.in_flight.values()) < self.max_concurrent and not any(
+            self.waiters.values()
+        ):
+            self.grant(priority, queued)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[priority].append((future, queued))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the request was cancelled, pass it on
+                self.release(priority)
+            else:
+                try:
+                    self.waiters[priority].remove((future, queued))
+                except ValueError:
+                    pass
+            raise
+
+    def release(self, priority):
+        self.in_flight[priority] -= 1
+        while sum(self.in_flight.values()) < self.max_concurrent:
+            priority = self.next_priority()
+            if priority is None:
+                return
+            future, queued = self.waiters[priority].popleft()
+            if future.done():
+                continue
+            self.grant(priority, queued)
+            future.set_result(None)
+
+    def next_priority(self):
+        interactive = self.waiters[Priority.INTERACTIVE]
+        background = self.waiters[Priority.BACKGROUND]
+        if background and (
+            not interactive or self.interactive_granted >= self.interactive_run
+        ):
+            self.interactive_granted = 0
+            return Priority.BACKGROUND
+        if interactive:
+            if background:
+                self.interactive_granted += 1
+            return Priority.INTERACTIVE
+        return None
+
+    def grant(self, priority, queued):
+        waited = time.monotonic() - queued
+        self.in_flight[priority] += 1
+        self.started[priority] += 1
+        self.total_wait[priority] += waited
+        self.max_wait[priority] = max(self.max_wait[priority], waited)
+
+    def get_stats(self):
+        """The queue depth, in flight count and wait times of each priority class"""
+        return {
+            priority: {
+                "queued": len(self.waiters[priority]),
+                "in_flight": self.in_flight[priority],
+                "started": self.started[priority],
+                "average_wait": (
+                    self.total_wait[priority] / self.started[priority]
+                    if self.started[priority]
+                    else 0.0
+                ),
+                "max_wait": self.max_wait[priority],
+            }
+            for priority in Priority.ALL
+        }
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import traceback
+from collections import OrderedDict, defaultdict
+
+
+class ResponseCache:
+    """A cache of the responses to deterministic requests, so that repeated inputs skip the round trip to the API.
+
+    Entries live in an in memory LRU for ttl seconds. With a spill_path, entries pushed out of memory are kept in
+    sqlite instead of being dropped, and are brought back into memory when they are asked for again. Only the call
+    sites listed in enabled_sites are cached, and hits and misses are counted per site.
+    """
+
+    def __init__(self, max_entries, ttl, enabled_sites, spill_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled_sites = set(enabled_sites)
+        self.entries = OrderedDict()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.lock = threading.Lock()
+        self.spill = None
+        if spill_path:
+            try:
+                self.spill = sqlite3.connect(str(spill_path), check_same_thread=False)
+                self.spill.execute(
+                    "CREATE TABLE IF NOT EXISTS responses "
+                    "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+                )
+                self.spill.execute(
+                    "DELETE FROM responses WHERE expires < ?", (time.time(),)
+                )
+                self.spill.commit()
+            except Exception:
+                traceback.print_exc()
+                print(
+                    "Failed to open the response cache spill file, it will be memory only"
+                )
+                self.spill = None
+
+    @staticmethod
+    def make_key(site, *parts):
+        """A key for a request, made from everything that determines its response (model, messages, parameters)"""
+        normalized = json.dumps([site, parts], sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def is_enabled(self, site):
+        return site in self.enabled_sites
+
+    def get(self, site, key):
+        """Return the cached response for key, or None if there is no fresh one"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] < now:
+                del self.entries[key]
+                entry = None
+            if entry:
+                self.entries.move_to_end(key)
+            elif self.spill:
+                row = self.spill.execute(
+                    "SELECT value, expires FROM responses WHERE key = ? AND expires >= ?",
+                    (key, now),
+                ).fetchone()
+                if row:
+                    entry = (row[1], json.loads(row[0]))
+                    self.store(key, entry)
+
+            if entry:
+                self.hits[site] += 1
+                return entry[1]
+            self.misses[site] += 1
+            return None
+
+    def put(self, site, key, value):
+        with self.lock:
+            self.store(key, (time.time() + self.ttl, value))
+
+    async def cached(self, site, key, call):
+        """Return the cached response for key, or await call() for it and cache the result"""
+        if not self.is_enabled(site):
+            return await call()
+        response = self.get(site, key)
+        if response is None:
+            response = await call()
+            if response is not None:
+                self.put(site, key, response)
+        return response
+
+    def store(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            spilled_key, (expires, value) = self.entries.popitem(last=False)
+            if self.spill and expires >= time.time():
+                self.spill.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, expires) VALUES (?, ?, ?)",
+                    (spilled_key, json.dumps(value), expires),
+                )
+                self.spill.commit()
+
+    def get_stats(self):
+        """The hits, misses and hit rate of each call site"""
+        return {
+            site: {
+                "hits": self.hits[site],
+                "misses": self.misses[site],
+                "hit_rate": (
+                    self.hits[site] / (self.hits[site] + self.misses[site])
+                    if self.hits[site] + self.misses[site]
+                    else 0.0
+                ),
+            }
+            for site in sorted(self.enabled_sites)
+        }
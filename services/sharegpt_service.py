@@ -8,11 +8,22 @@ class ShareGPTService:
         self.API_URL = "https://sharegpt.com/api/conversations"
 
     def format_conversation(
-        self, conversation_history, avatar_url="https://i.imgur.com/SpuAF0v.png"
+        self,
+        conversation_history,
+        avatar_url="https://i.imgur.com/SpuAF0v.png",
+        dropped=0,
     ):
         # The format is { 'avatarUrl' : <url>, 'items': [ { 'from': 'human', 'text': <text> }, { 'from': 'bot', 'text': <text> } ] } "
         # The conversation history is not in this format, its just in simple alternating human and bot conversation snippets
         conversation = {"avatarUrl": avatar_url, "items": []}
+        # The oldest messages of long conversations aren't kept, the transcript starts by saying so
+        if dropped:
+            conversation["items"].append(
+                {
+                    "from": "gpt",
+                    "value": f"(The first {dropped} messages of this conversation are not included)",
+                }
+            )
         # The conversation history alternates between human and bot
         # So we need to add the human and bot items to the conversation
         for i in range(len(conversation_history)):
@@ -27,8 +38,10 @@ class ShareGPTService:
 
         return json.dumps(conversation)
 
-    async def format_and_share(self, conversation_history, avatar_url=None):
-        conversation = self.format_conversation(conversation_history, avatar_url)
+    async def format_and_share(self, conversation_history, avatar_url=None, dropped=0):
+        conversation = self.format_conversation(
+            conversation_history, avatar_url, dropped
+        )
         print(conversation)
 
         headers = {"Content-Type": "application/json"}
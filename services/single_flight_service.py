@@ -0,0 +1,38 @@
+import asyncio
+import hashlib
+import json
+
+
+class SingleFlight:
+    """Shares one in-flight call between concurrent callers that ask for the same thing.
+
+    The first caller for a key starts the call, everyone that asks for the same key while it is still running waits
+    on that call instead of making their own, and all of them get its result (or its exception).
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.calls = 0
+        self.shared = 0
+
+    @staticmethod
+    def make_key(*parts):
+        """A key for the given request parts, the same for requests that only differ in dict ordering"""
+        normalized = json.dumps(
+            parts, sort_keys=True, separators=(",", ":"), default=str
+        )
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    async def do(self, key, call):
+        flight = self.flights.get(key)
+        if flight:
+            self.shared += 1
+        else:
+            self.calls += 1
+            flight = asyncio.ensure_future(call())
+            self.flights[key] = flight
+            flight.add_done_callback(lambda _: self.flights.pop(key, None))
+            # Keep the exception from being reported as never retrieved if every caller went away
+            flight.add_done_callback(lambda done: done.cancelled() or done.exception())
+        # A caller that is cancelled shouldn't cancel the call for everyone else waiting on it
+        return await asyncio.shield(flight)
@@ -0,0 +1,104 @@
+import asyncio
+import time
+import traceback
+
+import discord
+
+from services.environment_service import EnvService
+
+
+class StreamingReply:
+    """Progressively edits a reply to a message while a chat completion is streamed in.
+
+    The text is rendered at most once every edit_interval seconds to stay within discord's rate limits, and rolls
+    over into additional messages once it grows past the text cutoff.
+    """
+
+    def __init__(self, message, cutoff, thinking_message=None, edit_interval=None):
+        self.message = message
+        self.cutoff = cutoff
+        self.thinking_message = thinking_message
+        self.edit_interval = (
+            EnvService.get_stream_edit_interval()
+            if edit_interval is None
+            else edit_interval
+        )
+        self.messages = []
+        self.contents = []
+        self.text = ""
+        self.last_render = 0
+        self.render_task = None
+
+    async def update(self, text):
+        """Stream handler for Model.send_chatgpt_chat_request, called with all of the text received so far"""
+        self.text = text
+        if self.render_task and not self.render_task.done():
+            return
+        # The first tokens are shown right away, after that edits are rate limited
+        if self.messages and time.monotonic() - self.last_render < self.edit_interval:
+            return
+        self.render_task = asyncio.ensure_future(self.render_safely(self.text))
+
+    async def finalize(self, text, view=None):
+        """Render the final text of the response and attach the view to the last message, returns that message"""
+        if self.render_task:
+            await self.render_task
+        await self.render(text, view=view)
+        return self.messages[-1]
+
+    async def discard(self):
+        """Delete what was streamed out so far, for a response that failed before it was finished"""
+        if self.render_task:
+            await self.render_task
+        for message in self.messages:
+            try:
+                await message.delete()
+            except Exception:
+                pass
+        self.messages = []
+        self.contents = []
+
+    async def render_safely(self, text):
+        try:
+            await self.render(text)
+        except Exception:
+            traceback.print_exc()
+
+    async def render(self, text, view=None):
+        self.last_render = time.monotonic()
+        text = discord.utils.escape_mentions(text)
+        chunks = [
+            text[i : i + self.cutoff] for i in range(0, len(text), self.cutoff)
+        ] or ["\u200b"]
+
+        for index, chunk in enumerate(chunks):
+            chunk_view = view if index == len(chunks) - 1 else None
+            if index < len(self.messages):
+                if self.contents[index] != chunk or chunk_view:
+                    await self.messages[index].edit(content=chunk, view=chunk_view)
+                    self.contents[index] = chunk
+            else:
+                if index == 0:
+                    sent = await self.message.reply(chunk, view=chunk_view)
+                    await self.stop_thinking()
+                else:
+                    sent = await self.message.channel.send(chunk, view=chunk_view)
+                self.messages.append(sent)
+                self.contents.append(chunk)
+
+        # A retried request can come back shorter than what was already streamed out
+        for extra in self.messages[len(chunks) :]:
+            try:
+                await extra.delete()
+            except Exception:
+                pass
+        del self.messages[len(chunks) :]
+        del self.contents[len(chunks) :]
+
+    async def stop_thinking(self):
+        if self.thinking_message:
+            try:
+                await self.thinking_message.delete()
+            except Exception:
+                pass
+            self.thinking_message = None
@@ -19,6 +19,10 @@ from models.openai_model import Model, Override, Models
 from models.user_model import EmbeddedConversationItem, RedoUser
 from services.environment_service import EnvService
 from services.moderations_service import Moderation
+from services.request_scheduler_service import Priority
+from services.streaming_service import StreamingReply
+from services.tokenizer_service import TOKENIZER
+from services.usage_service import UsageService
 
 BOT_NAME = EnvService.get_custom_bot_name()
 PRE_MODERATE = EnvService.get_premoderate()
@@ -76,6 +80,7 @@ class TextService:
         from_other_action=None,
         from_message_context=None,
         is_drawable=False,
+        thinking_message=None,
     ):
         """General service function for sending and receiving gpt generations
 
@@ -98,6 +103,7 @@ class TextService:
             edited_request (bool, optional): If we're doing an edited message. Defaults to False.
             redo_request (bool, optional): If we're redoing a previous prompt. Defaults to False.
             from_action (bool, optional): If the function is being called from a message action. Defaults to False.
+            thinking_message (discord.Message, optional): The thinking embed, removed once a streamed reply starts. Defaults to None.
         """
         new_prompt, _new_prompt_clean = (
             prompt  # + "\n" + BOT_NAME
@@ -109,7 +115,17 @@ class TextService:
 
         from_context = isinstance(ctx, discord.ApplicationContext)
 
-        if not instruction:
+        # When conversing, the prompt is the conversation history, which keeps a running count of its tokens
+        conversation = (
+            converser_cog.conversation_threads.get(id)
+            if not from_ask_command
+            and not from_edit_command
+            and not converser_cog.pinecone_service
+            else None
+        )
+        if conversation:
+            tokens = conversation.history.token_count
+        elif not instruction:
             tokens = converser_cog.usage_service.count_tokens(new_prompt)
         else:
             tokens = converser_cog.usage_service.count_tokens(
@@ -149,7 +165,15 @@ class TextService:
                     str(datetime.datetime.now().timestamp()).replace(".", "")
                 )
 
-                new_prompt_item = EmbeddedConversationItem(new_prompt, timestamp)
+                new_prompt_item = EmbeddedConversationItem(
+                    new_prompt,
+                    timestamp,
+                    role="user",
+                    name=user_displayname,
+                    content=prompt_less_author.replace(
+                        "<|endofstatement|>", ""
+                    ).strip(),
+                )
 
                 if not redo_request:
                     converser_cog.conversation_threads[conversation_id].history.append(
@@ -168,18 +192,20 @@ class TextService:
                     converser_cog.redo_users[ctx.author.id].prompt = new_prompt
                 else:
                     # Create and upsert the embedding for  the conversation id, prompt, timestamp
-                    await converser_cog.pinecone_service.upsert_conversation_embedding(
-                        converser_cog.model,
-                        conversation_id,
-                        new_prompt,
-                        timestamp,
-                        custom_api_key=custom_api_key,
+                    # Use the version of the prompt without the author's name for better clarity on retrieval.
+                    # Both embeddings are requested together so that they are batched into one request.
+                    _, embedding_prompt_less_author = await asyncio.gather(
+                        converser_cog.pinecone_service.upsert_conversation_embedding(
+                            converser_cog.model,
+                            conversation_id,
+                            new_prompt,
+                            timestamp,
+                            custom_api_key=custom_api_key,
+                        ),
+                        converser_cog.model.send_embedding_request(
+                            prompt_less_author, custom_api_key=custom_api_key
+                        ),
                     )
-                    # Print all phrases
-
-                    embedding_prompt_less_author = await converser_cog.model.send_embedding_request(
-                        prompt_less_author, custom_api_key=custom_api_key
-                    )  # Use the version of the prompt without the author's name for better clarity on retrieval.
 
                     # Now, build the new prompt by getting the X most similar with pinecone
                     similar_prompts = converser_cog.pinecone_service.get_n_similar(
@@ -236,10 +262,6 @@ class TextService:
                     if redo_request:
                         _prompt_with_history = _prompt_with_history[:-2]
 
-                    converser_cog.conversation_threads[ctx.channel.id].history = (
-                        _prompt_with_history
-                    )
-
                     # Ensure that the last prompt in this list is the prompt we just sent (new_prompt_item)
                     if _prompt_with_history[-1].text != new_prompt_item.text:
                         try:
@@ -248,13 +270,19 @@ class TextService:
                             pass
                         _prompt_with_history.append(new_prompt_item)
 
+                    converser_cog.conversation_threads[ctx.channel.id].history = (
+                        _prompt_with_history
+                    )
+
                     prompt_with_history = "".join(
                         [item.text for item in _prompt_with_history]
                     )
 
                     new_prompt = prompt_with_history + "\n" + BOT_NAME
 
-                tokens = converser_cog.usage_service.count_tokens(new_prompt)
+                tokens = converser_cog.conversation_threads[
+                    ctx.channel.id
+                ].history.token_count
 
             # No pinecone, we do conversation summarization for long term memory instead
             elif (
@@ -294,7 +322,7 @@ class TextService:
                         + BOT_NAME
                     )
 
-                    tokens = converser_cog.usage_service.count_tokens(new_prompt)
+                    tokens = converser_cog.conversation_threads[id].history.token_count
 
                     if (
                         tokens > converser_cog.model.summarize_threshold
@@ -343,31 +371,50 @@ class TextService:
             if ctx.author.id in converser_cog.instructions:
                 system_instruction = converser_cog.instructions[ctx.author.id].prompt
                 usage_message = "***Added user instruction to prompt***"
-                tokens += converser_cog.usage_service.count_tokens(system_instruction)
+                tokens += TOKENIZER.count_memoized(system_instruction)
             elif ctx.channel.id in converser_cog.instructions:
                 system_instruction = converser_cog.instructions[ctx.channel.id].prompt
                 usage_message = "***Added channel instruction to prompt***"
-                tokens += converser_cog.usage_service.count_tokens(system_instruction)
+                tokens += TOKENIZER.count_memoized(system_instruction)
             else:
                 system_instruction = None
                 usage_message = None
 
+            # Conversation replies are streamed into the channel as they are generated
+            streamer = None
             if is_chatgpt_conversation:
+                if (
+                    EnvService.get_stream_responses()
+                    and not from_context
+                    and not response_message
+                ):
+                    streamer = StreamingReply(
+                        ctx,
+                        converser_cog.TEXT_CUTOFF,
+                        thinking_message=thinking_message,
+                    )
                 _prompt_with_history = converser_cog.conversation_threads[
                     ctx.channel.id
                 ].history
-                response = await converser_cog.model.send_chatgpt_chat_request(
-                    _prompt_with_history,
-                    model=model,
-                    bot_name=BOT_NAME,
-                    user_displayname=user_displayname,
-                    temp_override=overrides.temperature,
-                    top_p_override=overrides.top_p,
-                    frequency_penalty_override=overrides.frequency_penalty,
-                    presence_penalty_override=overrides.presence_penalty,
-                    stop=stop if not from_ask_command else None,
-                    custom_api_key=custom_api_key,
-                )
+                try:
+                    response = await converser_cog.model.send_chatgpt_chat_request(
+                        _prompt_with_history,
+                        model=model,
+                        bot_name=BOT_NAME,
+                        user_displayname=user_displayname,
+                        temp_override=overrides.temperature,
+                        top_p_override=overrides.top_p,
+                        frequency_penalty_override=overrides.frequency_penalty,
+                        presence_penalty_override=overrides.presence_penalty,
+                        stop=stop if not from_ask_command else None,
+                        custom_api_key=custom_api_key,
+                        stream_handler=streamer.update if streamer else None,
+                    )
+                except Exception:
+                    # Don't leave a half streamed reply behind the error message
+                    if streamer:
+                        await streamer.discard()
+                    raise
 
             elif from_edit_command:
                 response = await converser_cog.model.send_edit_request(
@@ -448,6 +495,8 @@ class TextService:
                             + str(response_text)
                             + "<|endofstatement|>\n",
                             0,
+                            role="assistant",
+                            content=str(response_text),
                         )
                     )
 
@@ -476,7 +525,12 @@ class TextService:
                     str(datetime.datetime.now().timestamp()).replace(".", "")
                 )
                 converser_cog.conversation_threads[conversation_id].history.append(
-                    EmbeddedConversationItem(response_text, timestamp)
+                    EmbeddedConversationItem(
+                        response_text,
+                        timestamp,
+                        role="assistant",
+                        content=unidecode.unidecode(response_text_clean),
+                    )
                 )
 
                 # Create and upsert the embedding for  the conversation id, prompt, timestamp
@@ -493,16 +547,26 @@ class TextService:
             # Cleanse again
             response_text = converser_cog.cleanse_response(response_text)
 
-            converser_cog.full_conversation_history[ctx.channel.id].append(
-                response_text
-            )
+            converser_cog.add_to_full_history(ctx.channel.id, response_text)
 
             # escape any other mentions like @here or @everyone
             response_text = discord.utils.escape_mentions(response_text)
 
             # If we don't have a response message, we are not doing a redo, send as a new message(s)
             if not response_message:
-                if len(response_text) > converser_cog.TEXT_CUTOFF:
+                if streamer:
+                    paginator = None
+                    response_message = await streamer.finalize(
+                        response_text,
+                        view=ConversationView(
+                            ctx,
+                            converser_cog,
+                            ctx.channel.id,
+                            model,
+                            custom_api_key=custom_api_key,
+                        ),
+                    )
+                elif len(response_text) > converser_cog.TEXT_CUTOFF:
                     if not from_context:
                         paginator = None
                         response_message = await converser_cog.paginate_and_send(
@@ -693,6 +757,11 @@ class TextService:
             return
 
         if conversing:
+            # The usage of this conversation's requests is attributed to its guild and user
+            UsageService.set_usage_context(
+                message.guild, message.author, feature="conversation"
+            )
+
             # Pre-moderation check
             if PRE_MODERATE:
                 if await Moderation.simple_moderate_and_respond(
@@ -862,6 +931,9 @@ class TextService:
                             f"\n{message.author.display_name}: {prompt} <|endofstatement|>\n",
                             0,
                             image_urls=file_urls,
+                            role="user",
+                            name=message.author.display_name,
+                            content=prompt,
                         )
                     )
 
@@ -940,6 +1012,7 @@ class TextService:
                         bot_name=BOT_NAME,
                         system_prompt_override=draw_check_prompt,
                         respond_json=True,
+                        priority=Priority.BACKGROUND,
                     )
                     await TextService.stop_thinking(thinking_message)
                     # This validation is only until we figure out what's wrong with the json response mode for vision.
@@ -969,6 +1042,8 @@ class TextService:
                                 f"\nYou have just generated images for the user, notify the user about what you've drawn\n",
                                 0,
                                 image_urls=links,
+                                role="system",
+                                content="You have just generated images for the user, notify the user about what you've drawn",
                             )
                         )
                 except:
@@ -983,6 +1058,8 @@ class TextService:
                             EmbeddedConversationItem(
                                 f"\nYou just tried to generate an image but the generation failed. Notify the user of this now.>\n",
                                 0,
+                                role="system",
+                                content="You just tried to generate an image but the generation failed. Notify the user of this now.",
                             )
                         )
                     except:
@@ -1019,7 +1096,7 @@ class TextService:
 
             # Send an embed that tells the user that the bot is thinking
             thinking_message = await TextService.trigger_thinking(message)
-            converser_cog.full_conversation_history[message.channel.id].append(prompt)
+            converser_cog.add_to_full_history(message.channel.id, prompt)
 
             if not converser_cog.pinecone_service:
                 primary_prompt += BOT_NAME
@@ -1035,6 +1112,7 @@ class TextService:
                 is_drawable=converser_cog.conversation_threads[
                     message.channel.id
                 ].drawable,
+                thinking_message=thinking_message,
             )
 
             # Delete the thinking embed
@@ -1086,6 +1164,9 @@ class TextService:
                             EmbeddedConversationItem(
                                 f"\n{after.author.display_name}: {after.content}<|endofstatement|>\n",
                                 0,
+                                role="user",
+                                name=after.author.display_name,
+                                content=after.content,
                             )
                         )
 
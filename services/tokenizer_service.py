@@ -0,0 +1,95 @@
+import asyncio
+import threading
+from collections import OrderedDict
+
+import tiktoken
+
+from services.environment_service import EnvService
+
+
+class Tokenizer:
+    """Counts tokens with one shared encoder per model, created the first time that model is used.
+
+    Counts of long-lived strings (instructions, openers, system prompts) are memoized in an LRU, so they aren't
+    tokenized again on every message. The async API tokenizes big texts in a worker thread instead of on the event
+    loop.
+    """
+
+    DEFAULT_ENCODING = "cl100k_base"
+
+    # Texts with at least this many characters in total are tokenized in a worker thread by the async API
+    THREAD_THRESHOLD = 20000
+
+    def __init__(self, max_memo_entries):
+        self.max_memo_entries = max_memo_entries
+        self.encoders = {}
+        self.memo = OrderedDict()
+        self.lock = threading.Lock()
+        self.memo_hits = 0
+        self.memo_misses = 0
+
+    def get_encoder(self, model=None):
+        """The encoder for model, or the default encoding for models tiktoken doesn't know"""
+        encoder = self.encoders.get(model)
+        if encoder is None:
+            try:
+                encoder = (
+                    tiktoken.encoding_for_model(model)
+                    if model
+                    else tiktoken.get_encoding(self.DEFAULT_ENCODING)
+                )
+            except KeyError:
+                encoder = tiktoken.get_encoding(self.DEFAULT_ENCODING)
+            self.encoders[model] = encoder
+        return encoder
+
+    def encode(self, text, model=None):
+        return self.get_encoder(model).encode(text)
+
+    def count(self, text, model=None):
+        return len(self.get_encoder(model).encode(text))
+
+    def count_memoized(self, text, model=None):
+        """Count the tokens in a string that is counted over and over, remembering the count"""
+        key = (model, text)
+        with self.lock:
+            count = self.memo.get(key)
+            if count is not None:
+                self.memo.move_to_end(key)
+                self.memo_hits += 1
+                return count
+            self.memo_misses += 1
+
+        count = self.count(text, model)
+        with self.lock:
+            self.memo[key] = count
+            while len(self.memo) > self.max_memo_entries:
+                self.memo.popitem(last=False)
+        return count
+
+    def count_batch(self, texts, model=None):
+        return [len(tokens) for tokens in self.get_encoder(model).encode_batch(texts)]
+
+    async def count_async(self, text, model=None):
+        """Count the tokens in text, in a worker thread if the text is big"""
+        if len(text) < self.THREAD_THRESHOLD:
+            return self.count(text, model)
+        return await asyncio.to_thread(self.count, text, model)
+
+    async def count_batch_async(self, texts, model=None):
+        """Count the tokens in each of texts, in a worker thread if there is a lot of text"""
+        texts = list(texts)
+        if sum(len(text) for text in texts) < self.THREAD_THRESHOLD:
+            return [self.count(text, model) for text in texts]
+        return await asyncio.to_thread(self.count_batch, texts, model)
+
+    def get_stats(self):
+        return {
+            "encoders": len(self.encoders),
+            "memo_entries": len(self.memo),
+            "memo_hits": self.memo_hits,
+            "memo_misses": self.memo_misses,
+        }
+
+
+TOKENIZER = Tokenizer(EnvService.get_token_count_cache_max_entries())
@@ -0,0 +1,175 @@
+import asyncio
+import sqlite3
+import threading
+import time
+import traceback
+
+
+class UsageLedger:
+    """An append-only sqlite ledger of every billed request, rolled up into per minute and per hour buckets.
+
+    Calls are recorded in memory and written in batches by flush(), which also adds the new calls to the rollups.
+    The rollups are what the queries read, so they stay fast however long the ledger gets. Raw calls older than
+    retention_days are dropped once they have been rolled up; the rollups are kept.
+    """
+
+    # Bucket sizes of the rollups, in seconds
+    MINUTE = 60
+    HOUR = 3600
+    BUCKET_SIZES = [MINUTE, HOUR]
+
+    GROUPS = ["guild", "user", "model", "feature"]
+
+    def __init__(self, path, retention_days):
+        self.retention_days = retention_days
+        # Held by the worker threads for as long as they use the connection
+        self.lock = threading.Lock()
+        # Only ever held to swap the calls recorded in memory, so recording never waits on the database
+        self.pending_lock = threading.Lock()
+        self.flush_lock = asyncio.Lock()
+        self.pending = []
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS calls (timestamp REAL NOT NULL, guild TEXT, user TEXT, model TEXT, "
+            "feature TEXT, prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, cost REAL NOT NULL, "
+            "latency REAL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS rollups (bucket_size INTEGER NOT NULL, bucket INTEGER NOT NULL, "
+            "guild TEXT NOT NULL, user TEXT NOT NULL, model TEXT NOT NULL, feature TEXT NOT NULL, "
+            "calls INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, "
+            "cost REAL NOT NULL, latency REAL NOT NULL, timed_calls INTEGER NOT NULL, "
+            "PRIMARY KEY (bucket_size, bucket, guild, user, model, feature))"
+        )
+        # The last call that has been added to the rollups
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS rollup_state (last_rowid INTEGER NOT NULL)"
+        )
+        if not self.connection.execute("SELECT 1 FROM rollup_state").fetchone():
+            self.connection.execute("INSERT INTO rollup_state VALUES (0)")
+        self.connection.commit()
+
+    def record(
+        self,
+        guild=None,
+        user=None,
+        model=None,
+        feature=None,
+        prompt_tokens=0,
+        completion_tokens=0,
+        cost=0.0,
+        latency=None,
+    ):
+        with self.pending_lock:
+            self.pending.append(
+                (
+                    time.time(),
+                    None if guild is None else str(guild),
+                    None if user is None else str(user),
+                    model,
+                    feature,
+                    int(prompt_tokens),
+                    int(completion_tokens),
+                    cost,
+                    latency,
+                )
+            )
+
+    async def flush(self):
+        """Write the recorded calls to the ledger and roll them up"""
+        async with self.flush_lock:
+            with self.pending_lock:
+                calls, self.pending = self.pending, []
+            try:
+                await asyncio.to_thread(self.write, calls)
+            except Exception:
+                traceback.print_exc()
+                with self.pending_lock:
+                    self.pending = calls + self.pending
+
+    def write(self, calls):
+        with self.lock:
+            if calls:
+                self.connection.executemany(
+                    "INSERT INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", calls
+                )
+            self.rollup()
+            self.connection.commit()
+
+    def rollup(self):
+        last_rowid = self.connection.execute(
+            "SELECT last_rowid FROM rollup_state"
+        ).fetchone()[0]
+        newest_rowid = self.connection.execute(
+            "SELECT COALESCE(MAX(rowid), 0) FROM calls"
+        ).fetchone()[0]
+        if newest_rowid <= last_rowid:
+            return
+
+        for bucket_size in self.BUCKET_SIZES:
+            self.connection.execute(
+                "INSERT INTO rollups SELECT ?, CAST(timestamp / ? AS INTEGER) * ?, COALESCE(guild, ''), "
+                "COALESCE(user, ''), COALESCE(model, ''), COALESCE(feature, ''), COUNT(*), SUM(prompt_tokens), "
+                "SUM(completion_tokens), SUM(cost), COALESCE(SUM(latency), 0), COUNT(latency) FROM calls "
+                "WHERE rowid > ? AND rowid <= ? GROUP BY 2, 3, 4, 5, 6 "
+                "ON CONFLICT DO UPDATE SET calls = calls + excluded.calls, "
+                "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                "cost = cost + excluded.cost, latency = latency + excluded.latency, "
+                "timed_calls = timed_calls + excluded.timed_calls",
+                (bucket_size, bucket_size, bucket_size, last_rowid, newest_rowid),
+            )
+        self.connection.execute(
+            "UPDATE rollup_state SET last_rowid = ?", (newest_rowid,)
+        )
+
+        # Only calls that are already in the rollups are dropped
+        self.connection.execute(
+            "DELETE FROM calls WHERE timestamp < ? AND rowid <= ?",
+            (time.time() - self.retention_days * 86400, newest_rowid),
+        )
+
+    async def get_top(self, group, since, limit=5):
+        """The guilds, users, models or features with the highest cost since the given time. Ties are ordered by
+        the number of calls. The query runs in a worker thread, so a flush that holds the ledger doesn't block the loop
+        """
+        if group not in self.GROUPS:
+            raise ValueError(f"Can't group usage by {group}")
+        return await asyncio.to_thread(self.query_top, group, since, limit)
+
+    def query_top(self, group, since, limit):
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT {group}, SUM(calls), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost), "
+                f"SUM(latency), SUM(timed_calls) FROM rollups WHERE bucket_size = ? AND bucket >= ? "
+                f"GROUP BY {group} ORDER BY SUM(cost) DESC, SUM(calls) DESC LIMIT ?",
+                (self.HOUR, int(since // self.HOUR) * self.HOUR, limit),
+            ).fetchall()
+        return [self.to_stats(row[0] or "unknown", row[1:]) for row in rows]
+
+    async def get_series(self, bucket_size, since):
+        """The totals of each bucket since the given time, oldest first"""
+        return await asyncio.to_thread(self.query_series, bucket_size, since)
+
+    def query_series(self, bucket_size, since):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT bucket, SUM(calls), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost), "
+                "SUM(latency), SUM(timed_calls) FROM rollups WHERE bucket_size = ? AND bucket >= ? "
+                "GROUP BY bucket ORDER BY bucket",
+                (bucket_size, int(since // bucket_size) * bucket_size),
+            ).fetchall()
+        return [self.to_stats(row[0], row[1:]) for row in rows]
+
+    @staticmethod
+    def to_stats(key, totals):
+        calls, prompt_tokens, completion_tokens, cost, latency, timed_calls = totals
+        return {
+            "key": key,
+            "calls": calls,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cost": round(cost, 6),
+            "average_latency": latency / timed_calls if timed_calls else None,
+        }
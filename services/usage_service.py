@@ -1,12 +1,117 @@
+import asyncio
+import contextvars
+import json
+import os
+import threading
+import traceback
 from collections import defaultdict
 from pathlib import Path
 
-import aiofiles
 from typing import Literal
-import tiktoken
+
+from services.environment_service import EnvService
+from services.tokenizer_service import TOKENIZER
+from services.usage_ledger_service import UsageLedger
+
+# The guild, user and feature that requests in the current task are made for, so their usage can be attributed
+USAGE_CONTEXT = contextvars.ContextVar("usage_context", default=(None, None, None))
+
+
+def write_atomic(path: Path, text):
+    """Write text to path through a temporary file, so the file is never left half written"""
+    temp_path = path.with_name(path.name + ".tmp")
+    with temp_path.open("w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+class UsageTotals:
+    """The running usage costs of a data directory, kept in memory and flushed to disk every so often.
+
+    Every UsageService for the same data directory shares one of these, so their updates add up instead of
+    overwriting each other. Besides the total, the usage is broken down by model, guild and user.
+    """
+
+    BREAKDOWN_KINDS = ["model", "guild", "user"]
+
+    def __init__(self, usage_file_path: Path, breakdown_file_path: Path):
+        self.usage_file_path = usage_file_path
+        self.breakdown_file_path = breakdown_file_path
+        self.lock = threading.Lock()
+        self.flush_lock = asyncio.Lock()
+        self.total = self.load_total()
+        self.breakdown = self.load_breakdown()
+        self.dirty = False
+
+    def load_total(self):
+        try:
+            return float(self.usage_file_path.read_text().strip())
+        except Exception:
+            traceback.print_exc()
+            return 0.0
+
+    def load_breakdown(self):
+        breakdown = {kind: {} for kind in self.BREAKDOWN_KINDS}
+        if self.breakdown_file_path.exists():
+            try:
+                breakdown.update(json.loads(self.breakdown_file_path.read_text()))
+            except Exception:
+                traceback.print_exc()
+        return breakdown
+
+    def add(self, cost, tokens=0, model=None, guild=None, user=None):
+        """Add the cost (and tokens) of a request, returns the old and the new total"""
+        with self.lock:
+            old_total = self.total
+            self.total = round(self.total + cost, 6)
+            for kind, name in zip(self.BREAKDOWN_KINDS, [model, guild, user]):
+                if name is None:
+                    continue
+                entry = self.breakdown[kind].setdefault(
+                    str(name), {"tokens": 0, "cost": 0.0}
+                )
+                entry["tokens"] += tokens
+                entry["cost"] = round(entry["cost"] + cost, 6)
+            self.dirty = True
+            return old_total, self.total
+
+    def set(self, total):
+        with self.lock:
+            self.total = float(total)
+            self.dirty = True
+
+    def get_breakdown(self, kind):
+        with self.lock:
+            return {name: dict(entry) for name, entry in self.breakdown[kind].items()}
+
+    async def flush(self):
+        """Write the totals to disk if they changed since the last flush"""
+        async with self.flush_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                total = self.total
+                breakdown = json.dumps(self.breakdown)
+                self.dirty = False
+            try:
+                await asyncio.to_thread(self.write, total, breakdown)
+            except Exception:
+                traceback.print_exc()
+                with self.lock:
+                    self.dirty = True
+
+    def write(self, total, breakdown):
+        write_atomic(self.usage_file_path, str(total))
+        write_atomic(self.breakdown_file_path, breakdown)
 
 
 class UsageService:
+    # The usage totals and ledger of each data directory, shared by the services that use it
+    shared_totals = {}
+    shared_ledgers = {}
+
     def __init__(self, data_dir: Path):
         self.usage_file_path = data_dir / "usage.txt"
         # If the usage.txt file doesn't currently exist in the directory, create it and write 0.00 to it.
@@ -14,7 +119,16 @@ class UsageService:
             with self.usage_file_path.open("w") as f:
                 f.write("0.00")
                 f.close()
-        self.tokenizer = tiktoken.get_encoding("cl100k_base")
+        key = str(self.usage_file_path.resolve())
+        if key not in UsageService.shared_totals:
+            UsageService.shared_totals[key] = UsageTotals(
+                self.usage_file_path, data_dir / "usage_breakdown.json"
+            )
+        self.totals = UsageService.shared_totals[key]
+        if key not in UsageService.shared_ledgers:
+            UsageService.shared_ledgers[key] = self.open_ledger(data_dir)
+        self.ledger = UsageService.shared_ledgers[key]
+        self.tokenizer = TOKENIZER.get_encoder()
         self.usage = defaultdict()
 
     COST_MAPPING = {
@@ -64,37 +178,92 @@ class UsageService:
         price = round(price, 6)
         return price
 
+    @staticmethod
+    def open_ledger(data_dir: Path):
+        if not EnvService.get_usage_ledger_enabled():
+            return None
+        try:
+            return UsageLedger(
+                data_dir / "usage_ledger.sqlite",
+                EnvService.get_usage_ledger_retention_days(),
+            )
+        except Exception:
+            traceback.print_exc()
+            print("Failed to open the usage ledger, usage will not be recorded")
+            return None
+
+    @staticmethod
+    def set_usage_context(guild=None, user=None, feature=None):
+        """Attribute the usage of requests made from here on in the current task to guild, user and feature.
+        Guilds are kept by id, their names can change and aren't unique
+        """
+        USAGE_CONTEXT.set(
+            (
+                guild.id if guild else None,
+                user.id if user else None,
+                feature,
+            )
+        )
+
     async def update_usage(
         self,
         tokens_used,
         mode: ModeType = None,
+        model=None,
+        prompt_tokens=None,
+        completion_tokens=None,
+        latency=None,
     ):
         tokens_used = int(tokens_used)
         price = (tokens_used / 1000) * await self.get_model_cost(mode)
         price = round(price, 6)
-        usage = round(await self.get_usage(), 6)
-        new_total = round(usage + price, 6)
+        guild, user, feature = USAGE_CONTEXT.get()
+        usage, new_total = self.totals.add(
+            price, tokens_used, model=model or mode, guild=guild, user=user
+        )
+        if self.ledger:
+            self.ledger.record(
+                guild=guild,
+                user=user,
+                model=model or mode,
+                feature=feature,
+                prompt_tokens=tokens_used if prompt_tokens is None else prompt_tokens,
+                completion_tokens=completion_tokens or 0,
+                cost=price,
+                latency=latency,
+            )
         print(
             f"{'Completion' if mode != 'embedding' else 'Embed'} cost -> Old: {str(usage)} | New: {str(new_total)}, used {str(price)} credits"
         )
-        async with aiofiles.open(self.usage_file_path, "w") as f:
-            await f.write(str(new_total))
-            await f.close()
 
     async def set_usage(self, usage):
-        async with aiofiles.open(self.usage_file_path, "w") as f:
-            await f.write(str(usage))
-            await f.close()
+        self.totals.set(usage)
+        await self.totals.flush()
 
     async def get_usage(self):
-        async with aiofiles.open(self.usage_file_path, "r") as f:
-            usage = float((await f.read()).strip())
-            await f.close()
-        return usage
+        return self.totals.total
+
+    def get_usage_breakdown(self, kind):
+        """The tokens and cost of each model, guild or user"""
+        return self.totals.get_breakdown(kind)
+
+    async def get_usage_report(self, group, since, limit=5):
+        """The guilds, users, models or features that spent the most since the given time, from the ledger"""
+        return await self.ledger.get_top(group, since, limit) if self.ledger else []
+
+    async def flush_usage(self):
+        await self.totals.flush()
+        if self.ledger:
+            await self.ledger.flush()
+
+    async def process_usage_flush(self, interval):
+        """Flush the usage totals and ledger to disk every interval seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush_usage()
 
     def count_tokens(self, text):
-        res = self.tokenizer.encode(text)
-        return len(res)
+        return TOKENIZER.count(text)
 
     async def update_usage_image(self, image_size):
         image_size = image_size.split(" ")[0]
@@ -111,11 +280,12 @@ class UsageService:
         else:
             raise ValueError("Invalid image size")
 
-        usage = await self.get_usage()
-
-        async with aiofiles.open(self.usage_file_path, "w") as f:
-            await f.write(str(usage + float(price)))
-            await f.close()
+        guild, user, feature = USAGE_CONTEXT.get()
+        self.totals.add(float(price), model="image", guild=guild, user=user)
+        if self.ledger:
+            self.ledger.record(
+                guild=guild, user=user, model="image", feature=feature, cost=price
+            )
 
     def update_usage_memory(self, guild_name, functionality, usage):
         if guild_name in self.usage:
@@ -134,6 +304,4 @@ class UsageService:
 
     @staticmethod
     def count_tokens_static(text):
-        tokenizer = tiktoken.get_encoding("cl100k_base")
-        res = tokenizer.encode(text)
-        return len(res)
+        return TOKENIZER.count(text)
@@ -0,0 +1,388 @@
+"""
+A local stand-in for the parts of the OpenAI API that the bot uses, for tests and benchmarks that shouldn't depend
+on (or pay for) the real API. Point the bot at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+
+Latency, error rate and rate limiting (429s) are configurable, so that retries, hedging and client side rate
+limiting can be exercised too. Run it on its own with `python tests/mock_openai_server.py --help`.
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import random
+import struct
+import time
+import uuid
+
+from aiohttp import web
+from PIL import Image
+
+EMBEDDING_DIMENSIONS = 1536
+
+DEFAULT_REPLY = (
+    "There are 24 hours in a day. This is a reply from the mock OpenAI server, it is long enough to be streamed "
+    "in a few chunks and to give the tokenizer something to count."
+)
+
+MODERATION_CATEGORIES = [
+    "hate",
+    "hate/threatening",
+    "harassment",
+    "harassment/threatening",
+    "self-harm",
+    "self-harm/intent",
+    "self-harm/instructions",
+    "sexual",
+    "sexual/minors",
+    "violence",
+    "violence/graphic",
+]
+
+
+def count_tokens(text):
+    # A rough count is enough here, it is only used for the usage numbers and the ratelimit headers
+    return max(1, len(str(text)) // 4)
+
+
+def make_embedding(text):
+    """A deterministic unit vector for text, so that the same input always gets the same embedding"""
+    seed = hashlib.sha256(str(text).encode("utf-8")).digest()
+    values = []
+    counter = 0
+    while len(values) < EMBEDDING_DIMENSIONS:
+        block = hashlib.sha256(seed + struct.pack("<I", counter)).digest()
+        values.extend(byte / 127.5 - 1 for byte in block)
+        counter += 1
+    values = values[:EMBEDDING_DIMENSIONS]
+    norm = sum(value * value for value in values) ** 0.5
+    return [value / norm for value in values]
+
+
+class MockOpenAIServer:
+    """The mock API server.
+
+    Args:
+        latency (float): Seconds every request takes before it is answered. Defaults to 0.
+        jitter (float): Up to this many seconds are randomly added to the latency. Defaults to 0.
+        error_rate (float): The share of requests that fail with a 500. Defaults to 0.
+        rate_limit_rate (float): The share of requests that fail with a 429. Defaults to 0.
+        requests_per_minute (int): The request limit reported in the x-ratelimit headers. Defaults to 10000.
+        tokens_per_minute (int): The token limit reported in the x-ratelimit headers. Defaults to 2000000.
+        reply (str): The content of every chat completion. Defaults to DEFAULT_REPLY.
+        stream_chunk_delay (float): Seconds between streamed chunks. Defaults to 0.
+        seed (int, optional): Seed for the random failures, to make them reproducible. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        rate_limit_rate=0.0,
+        requests_per_minute=10000,
+        tokens_per_minute=2000000,
+        reply=DEFAULT_REPLY,
+        stream_chunk_delay=0.0,
+        seed=None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.reply = reply
+        self.stream_chunk_delay = stream_chunk_delay
+        self.random = random.Random(seed)
+        self.request_counts = {}
+        self.window_started = time.monotonic()
+        self.window_requests = 0
+        self.window_tokens = 0
+        self.runner = None
+        self.base_url = None
+
+        self.app = web.Application(middlewares=[self.faults])
+        self.app.add_routes(
+            [
+                web.post("/v1/chat/completions", self.chat_completions),
+                web.post("/v1/embeddings", self.embeddings),
+                web.post("/v1/moderations", self.moderations),
+                web.post("/v1/images/generations", self.images),
+                web.post("/v1/images/variations", self.images),
+                web.post("/v1/audio/transcriptions", self.transcriptions),
+                web.get("/v1/models", self.models),
+                web.get("/files/{name}", self.files),
+            ]
+        )
+        self.image_bytes = self.make_image()
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Start serving, returns the base url to point the bot at"""
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}/v1"
+        return self.base_url
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    @staticmethod
+    def make_image():
+        buffer = io.BytesIO()
+        Image.new("RGB", (256, 256), (88, 101, 242)).save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    def ratelimit_headers(self, tokens):
+        now = time.monotonic()
+        if now - self.window_started >= 60:
+            self.window_started = now
+            self.window_requests = 0
+            self.window_tokens = 0
+        self.window_requests += 1
+        self.window_tokens += tokens
+        reset = f"{max(0.0, 60 - (now - self.window_started)):.3f}s"
+        return {
+            "x-ratelimit-limit-requests": str(self.requests_per_minute),
+            "x-ratelimit-remaining-requests": str(
+                max(0, self.requests_per_minute - self.window_requests)
+            ),
+            "x-ratelimit-reset-requests": reset,
+            "x-ratelimit-limit-tokens": str(self.tokens_per_minute),
+            "x-ratelimit-remaining-tokens": str(
+                max(0, self.tokens_per_minute - self.window_tokens)
+            ),
+            "x-ratelimit-reset-tokens": reset,
+        }
+
+    @web.middleware
+    async def faults(self, request, handler):
+        """Adds the configured latency, and fails the configured share of requests"""
+        self.request_counts[request.path] = self.request_counts.get(request.path, 0) + 1
+        if request.path.startswith("/files/"):
+            return await handler(request)
+
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            return web.json_response(
+                {
+                    "error": {
+                        "message": "Rate limit reached (mock)",
+                        "type": "requests",
+                        "code": "rate_limit_exceeded",
+                    }
+                },
+                status=429,
+                headers={"retry-after": "1", **self.ratelimit_headers(0)},
+            )
+        if roll < self.rate_limit_rate + self.error_rate:
+            return web.json_response(
+                {
+                    "error": {
+                        "message": "Internal server error (mock)",
+                        "type": "server_error",
+                    }
+                },
+                status=500,
+            )
+        return await handler(request)
+
+    async def chat_completions(self, request):
+        payload = await request.json()
+        prompt_tokens = sum(
+            count_tokens(message.get("content", ""))
+            for message in payload.get("messages", [])
+        )
+        completion_tokens = count_tokens(self.reply)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        model = payload.get("model", "gpt-4o-mini")
+        headers = self.ratelimit_headers(usage["total_tokens"])
+
+        if not payload.get("stream"):
+            return web.json_response(
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": self.reply},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                },
+                headers=headers,
+            )
+
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", **headers}
+        )
+        await response.prepare(request)
+
+        async def send(choices, **extra):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": choices,
+                **extra,
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            if self.stream_chunk_delay:
+                await asyncio.sleep(self.stream_chunk_delay)
+
+        await send([{"index": 0, "delta": {"role": "assistant", "content": ""}}])
+        words = self.reply.split(" ")
+        for index, word in enumerate(words):
+            content = word if index == 0 else f" {word}"
+            await send([{"index": 0, "delta": {"content": content}}])
+        await send([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if payload.get("stream_options", {}).get("include_usage"):
+            await send([], usage=usage)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def embeddings(self, request):
+        payload = await request.json()
+        inputs = payload.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        tokens = sum(count_tokens(text) for text in inputs)
+        return web.json_response(
+            {
+                "object": "list",
+                "data": [
+                    {
+                        "object": "embedding",
+                        "index": index,
+                        "embedding": make_embedding(text),
+                    }
+                    for index, text in enumerate(inputs)
+                ],
+                "model": payload.get("model", "text-embedding-ada-002"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            },
+            headers=self.ratelimit_headers(tokens),
+        )
+
+    async def moderations(self, request):
+        payload = await request.json()
+        inputs = payload.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        return web.json_response(
+            {
+                "id": f"modr-{uuid.uuid4().hex}",
+                "model": payload.get("model", "omni-moderation-latest"),
+                "results": [
+                    {
+                        "flagged": False,
+                        "categories": {
+                            category: False for category in MODERATION_CATEGORIES
+                        },
+                        "category_scores": {
+                            category: 0.0001 for category in MODERATION_CATEGORIES
+                        },
+                    }
+                    for _ in inputs
+                ],
+            },
+            headers=self.ratelimit_headers(sum(count_tokens(text) for text in inputs)),
+        )
+
+    async def images(self, request):
+        if request.content_type == "application/json":
+            payload = await request.json()
+        else:
+            payload = dict(await request.post())
+        count = int(payload.get("n", 1))
+        if payload.get("response_format") == "b64_json":
+            encoded = base64.b64encode(self.image_bytes).decode("ascii")
+            data = [{"b64_json": encoded} for _ in range(count)]
+        else:
+            root = str(request.url.origin())
+            data = [
+                {"url": f"{root}/files/{uuid.uuid4().hex}.png"} for _ in range(count)
+            ]
+        return web.json_response(
+            {"created": int(time.time()), "data": data},
+            headers=self.ratelimit_headers(0),
+        )
+
+    async def transcriptions(self, request):
+        await request.post()
+        return web.json_response(
+            {"text": "This is a transcription from the mock OpenAI server."},
+            headers=self.ratelimit_headers(0),
+        )
+
+    async def models(self, request):
+        return web.json_response(
+            {
+                "object": "list",
+                "data": [
+                    {"id": model, "object": "model", "owned_by": "mock"}
+                    for model in ["gpt-4o-mini", "gpt-4o", "text-embedding-ada-002"]
+                ],
+            }
+        )
+
+    async def files(self, request):
+        return web.Response(body=self.image_bytes, content_type="image/png")
+
+
+async def serve(args):
+    server = MockOpenAIServer(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        stream_chunk_delay=args.stream_chunk_delay,
+    )
+    base_url = await server.start(args.host, args.port)
+    print(f"Mock OpenAI server listening, set OPENAI_BASE_URL={base_url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="A mock OpenAI API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--requests-per-minute", type=int, default=10000)
+    parser.add_argument("--tokens-per-minute", type=int, default=2000000)
+    parser.add_argument("--stream-chunk-delay", type=float, default=0.0)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
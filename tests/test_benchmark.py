@@ -0,0 +1,248 @@
+"""
+End to end benchmarks of conversation turns through TextService.encapsulated_send, against the mock OpenAI server
+in tests/mock_openai_server.py instead of the real API. The latency of the mock can be set with the
+BENCHMARK_LATENCY environment variable to see how the bot behaves against a slower API.
+"""
+
+import asyncio
+import os
+import time
+import tracemalloc
+from collections import defaultdict
+from types import SimpleNamespace
+
+import pytest
+
+from models.openai_model import Model, Override
+from models.user_model import EmbeddedConversationItem, Thread
+from services.text_service import TextService
+from services.usage_service import UsageService
+from tests.mock_openai_server import MockOpenAIServer
+
+BENCHMARK_TURNS = int(os.getenv("BENCHMARK_TURNS", "20"))
+BENCHMARK_CONVERSATIONS = int(os.getenv("BENCHMARK_CONVERSATIONS", "10"))
+BENCHMARK_LATENCY = float(os.getenv("BENCHMARK_LATENCY", "0.05"))
+BENCHMARK_THREADS = int(os.getenv("BENCHMARK_THREADS", "10000"))
+
+
+class FakeMessage:
+    """Just enough of a discord.Message (and its channel) for encapsulated_send to reply to"""
+
+    next_id = 1
+
+    def __init__(self, channel, content="", author=None):
+        self.id = FakeMessage.next_id
+        FakeMessage.next_id += 1
+        self.channel = channel
+        self.content = content
+        self.author = author
+
+    async def reply(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    async def edit(self, content=None, **kwargs):
+        if content is not None:
+            self.content = content
+
+    async def delete(self):
+        pass
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.sent = []
+        self.errors = []
+
+    async def send(self, content=None, embed=None, **kwargs):
+        if embed is not None:
+            self.errors.append(embed)
+        message = FakeMessage(self, content)
+        self.sent.append(message)
+        return message
+
+
+class FakeConverserCog:
+    """The parts of the conversation cog that encapsulated_send uses, with a real Model behind it"""
+
+    TEXT_CUTOFF = 1900
+
+    def __init__(self, usage_service):
+        self.usage_service = usage_service
+        self.model = Model(usage_service)
+        self.pinecone_service = None
+        self.conversation_threads = {}
+        self.instructions = {}
+        self.redo_users = {}
+        self.full_conversation_history = defaultdict(list)
+        self.debug_channel = None
+
+    def add_to_full_history(self, conversation_id, text):
+        self.full_conversation_history[conversation_id].append(text)
+
+    def cleanse_response(self, response_text):
+        return response_text.replace("<|endofstatement|>", "")
+
+    async def mention_to_username(self, ctx, message):
+        return message
+
+    def generate_debug_message(self, prompt, response):
+        return ""
+
+    async def send_debug_message(self, debug_message, debug_channel):
+        pass
+
+    def remove_awaiting(self, *args):
+        pass
+
+    async def end_conversation(self, *args, **kwargs):
+        pass
+
+
+def start_conversation(converser_cog, channel_id):
+    thread = Thread(channel_id)
+    thread.history.append(EmbeddedConversationItem("You are a helpful assistant.\n", 0))
+    converser_cog.conversation_threads[channel_id] = thread
+    return FakeChannel(channel_id)
+
+
+async def conversation_turn(converser_cog, channel, prompt):
+    """A single user message and its reply, the way process_conversation_message sends it. Returns the latency"""
+    author = SimpleNamespace(id=channel.id, display_name=f"user{channel.id}")
+    message = FakeMessage(channel, prompt, author=author)
+    converser_cog.conversation_threads[channel.id].history.append(
+        EmbeddedConversationItem(
+            f"\n{author.display_name}: {prompt} <|endofstatement|>\n", 0
+        )
+    )
+    started = time.perf_counter()
+    await TextService.encapsulated_send(
+        converser_cog,
+        channel.id,
+        prompt,
+        message,
+        overrides=Override(),
+        model="gpt-4o-mini",
+    )
+    return time.perf_counter() - started
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+@pytest.fixture
+def usage_service(tmp_path):
+    return UsageService(tmp_path)
+
+
+@pytest.mark.asyncio
+async def test_benchmark_conversation_turns(usage_service, monkeypatch):
+    server = MockOpenAIServer(latency=BENCHMARK_LATENCY)
+    monkeypatch.setattr(Model, "api_base", await server.start())
+    await Model.close_session()
+    try:
+        converser_cog = FakeConverserCog(usage_service)
+
+        # Latency of back to back turns in a single conversation
+        channel = start_conversation(converser_cog, 1)
+        latencies = [
+            await conversation_turn(converser_cog, channel, f"Question number {turn}?")
+            for turn in range(BENCHMARK_TURNS)
+        ]
+        assert not channel.errors
+        assert len(converser_cog.conversation_threads[1].history) == (
+            1 + 2 * BENCHMARK_TURNS
+        )
+
+        # Throughput of many conversations taking turns at the same time
+        channels = [
+            start_conversation(converser_cog, 100 + index)
+            for index in range(BENCHMARK_CONVERSATIONS)
+        ]
+
+        async def converse(channel):
+            for turn in range(BENCHMARK_TURNS):
+                await conversation_turn(
+                    converser_cog, channel, f"Question number {turn}?"
+                )
+
+        started = time.perf_counter()
+        await asyncio.gather(*[converse(channel) for channel in channels])
+        elapsed = time.perf_counter() - started
+        assert not any(channel.errors for channel in channels)
+
+        turns = BENCHMARK_TURNS * BENCHMARK_CONVERSATIONS
+        print(
+            f"\nTurn latency with {BENCHMARK_LATENCY * 1000:.0f}ms of API latency: "
+            f"p50 {percentile(latencies, 0.5) * 1000:.1f}ms, "
+            f"p95 {percentile(latencies, 0.95) * 1000:.1f}ms, "
+            f"max {max(latencies) * 1000:.1f}ms"
+        )
+        print(
+            f"Throughput of {BENCHMARK_CONVERSATIONS} concurrent conversations: "
+            f"{turns / elapsed:.1f} turns/s ({turns} turns in {elapsed:.2f}s)"
+        )
+        chat_requests = server.request_counts["/v1/chat/completions"]
+        assert chat_requests >= BENCHMARK_TURNS + turns
+    finally:
+        await Model.close_session()
+        await server.stop()
+
+
+def build_thread(thread_id, starter_text, turns):
+    """A thread the way the conversation cog builds it, with a shared starter prompt and a few turns"""
+    thread = Thread(thread_id)
+    thread.history.append(
+        EmbeddedConversationItem(
+            starter_text, 0, role="system", content=starter_text, token_count=100
+        )
+    )
+    name = f"user{thread_id % 100}"
+    for turn in range(turns):
+        prompt = f"Question number {turn} of conversation {thread_id}?"
+        thread.history.append(
+            EmbeddedConversationItem(
+                f"\n{name}: {prompt} <|endofstatement|>\n",
+                0,
+                role="user",
+                name=name,
+                content=prompt,
+                token_count=12,
+            )
+        )
+        response = f"Answer number {turn} of conversation {thread_id}."
+        thread.history.append(
+            EmbeddedConversationItem(
+                f"\nGPT: {response}<|endofstatement|>\n",
+                0,
+                role="assistant",
+                content=response,
+                token_count=10,
+            )
+        )
+    return thread
+
+
+def test_benchmark_thread_memory():
+    starter_text = "You are a helpful assistant. " * 50
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        threads = {
+            thread_id: build_thread(thread_id, starter_text, turns=4)
+            for thread_id in range(BENCHMARK_THREADS)
+        }
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    assert len(threads) == BENCHMARK_THREADS
+    assert threads[1].history[1].text == (
+        "\nuser1: Question number 0 of conversation 1? <|endofstatement|>\n"
+    )
+    print(
+        f"\nMemory of {BENCHMARK_THREADS} active threads with 4 turns each: "
+        f"{used / BENCHMARK_THREADS:.0f} bytes per thread ({used / 2**20:.1f} MiB)"
+    )
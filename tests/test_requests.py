@@ -1,8 +1,43 @@
+import asyncio
+import gc
+import json
 from pathlib import Path
+import pickle
+import time
+from types import SimpleNamespace
 import tempfile
 
+import discord
 import pytest
+import pytest_asyncio
 from models.openai_model import Model
+from models.user_model import (
+    AFFIXES,
+    EmbeddedConversationItem,
+    FullConversationHistory,
+    Thread,
+    VersionedList,
+)
+from services.conversation_store_service import ConversationStore
+from services.deletion_service import Deletion, DeletionScheduler
+from services.embedding_cache_service import EmbeddingCache
+from services.hedging_service import HedgePolicy
+from services.local_vector_service import LocalVectorService
+from services.moderation_cache_service import (
+    ModerationPrefilter,
+    ModerationVerdictCache,
+    normalize,
+)
+from services.message_queue_service import Message, MessageDispatcher
+from services.metrics_service import Metrics, TimedQueue, register_queue, METRICS
+from services.rate_limit_service import RateLimiter, parse_reset_duration
+from services.request_scheduler_service import Priority, RequestScheduler
+from services.response_cache_service import ResponseCache
+from services.sharegpt_service import ShareGPTService
+from services.single_flight_service import SingleFlight
+from services.streaming_service import StreamingReply
+from services.tokenizer_service import Tokenizer
+from services.usage_ledger_service import UsageLedger
 
 from services.usage_service import UsageService
 
@@ -12,9 +47,11 @@ def usage_service(tmp_path):
     return UsageService(tmp_path)
 
 
-@pytest.fixture
-def model(usage_service):
-    return Model(usage_service)
+@pytest_asyncio.fixture
+async def model(usage_service):
+    yield Model(usage_service)
+    # The pooled session belongs to the event loop of the test that opened it
+    await Model.close_session()
 
 
 # All requests now use chat completions format
@@ -52,3 +89,616 @@ async def test_send_edit_req(model):
     text = "Ther are tweny four hours in a day"
     res = await model.send_edit_request(instruction=instruction, text=text)
     assert "choices" in res
+
+
+# Streamed chat completion
+@pytest.mark.asyncio
+async def test_send_chat_req_streamed(model):
+    history = [
+        EmbeddedConversationItem("You are a helpful assistant.", 0),
+        EmbeddedConversationItem("\nUser: how many hours are in a day?", 0),
+    ]
+    streamed = []
+
+    async def handler(text):
+        streamed.append(text)
+
+    res = await model.send_chatgpt_chat_request(
+        history, "gpt-4o-mini", "GPT", "User", stream_handler=handler
+    )
+    assert "24" in res["choices"][0]["message"]["content"]
+    assert streamed[-1] == res["choices"][0]["message"]["content"]
+    assert res["usage"]["total_tokens"] > 0
+
+
+# A reply that fails while it is streamed doesn't leave its partial messages behind
+@pytest.mark.asyncio
+async def test_streaming_reply_discard():
+    deleted = []
+
+    class FakeMessage:
+        def __init__(self, content):
+            self.content = content
+
+        async def reply(self, content, view=None):
+            return FakeMessage(content)
+
+        async def edit(self, content=None, view=None):
+            self.content = content
+
+        async def delete(self):
+            deleted.append(self.content)
+
+    message = FakeMessage("prompt")
+    message.channel = SimpleNamespace(send=message.reply)
+    reply = StreamingReply(message, cutoff=5, edit_interval=0)
+    await reply.update("hello world")
+    await reply.render_task
+    assert len(reply.messages) == 3
+
+    await reply.discard()
+    assert deleted == ["hello", " worl", "d"] and not reply.messages
+
+
+# Conversation items are sent as structured messages, and items pickled with only their text are parsed once
+def test_conversation_item_messages(model):
+    structured = EmbeddedConversationItem(
+        "\nUser One: hello there <|endofstatement|>\n",
+        0,
+        role="user",
+        name="User One",
+        content="hello there",
+    )
+    # An item the way it was pickled before it had the structured fields
+    legacy = EmbeddedConversationItem.__new__(EmbeddedConversationItem)
+    legacy.__setstate__(
+        {
+            "text": "\nUser One: hello there <|endofstatement|>\n",
+            "timestamp": 0,
+            "image_urls": None,
+        }
+    )
+    legacy = pickle.loads(pickle.dumps(legacy))
+    assert legacy.role is None
+
+    message = model.get_chat_message(structured, "GPT: ")
+    assert message == {"role": "user", "name": "UserOne", "content": "hello there"}
+    assert model.get_chat_message(structured, "GPT: ") is message
+    assert model.get_chat_message(legacy, "GPT: ")["name"] == "UserOne"
+    assert model.get_chat_message(legacy, "GPT: ")["content"].strip() == "hello there"
+
+    reply = EmbeddedConversationItem("\nGPT: hi! <|endofstatement|>\n", 0)
+    assert model.get_chat_message(reply, "GPT: ", vision=True) == {
+        "role": "assistant",
+        "name": "GPT",
+        "content": [{"type": "text", "text": "\nhi! \n"}],
+    }
+
+
+# Items keep only their content and share the text around it, and still pickle the way they used to
+def test_compact_conversation_items():
+    first, second = [
+        EmbeddedConversationItem(
+            f"\nUser One: {content} <|endofstatement|>\n",
+            0,
+            role="user",
+            name="User" + " One",
+            content=content,
+        )
+        for content in ["hello there", "how are you?"]
+    ]
+    assert not hasattr(first, "__dict__")
+    assert first.affixes is second.affixes and first.name is second.name
+    assert second.text == "\nUser One: how are you? <|endofstatement|>\n"
+    assert pickle.loads(pickle.dumps(second)) == second
+
+    # Items created with only their text are compacted once their content is parsed from it
+    summary = "This conversation has some context from earlier: hi<|endofstatement|>"
+    legacy = EmbeddedConversationItem(summary, 0)
+    assert legacy.affixes is None
+    assert legacy.get_structured("GPT: ")[0] == "system"
+    assert tuple(legacy.affixes) == ("", "<|endofstatement|>")
+    assert legacy.text == summary
+
+    # A thread the way it was pickled before it had slots
+    thread = Thread.__new__(Thread)
+    thread.__setstate__({"thread_id": 1, "history": [first], "count": 2})
+    thread = pickle.loads(pickle.dumps(thread))
+    assert thread.count == 2 and thread.drawable is False
+    assert thread.history == [first] and thread.history.token_count > 0
+
+    # The shared prefixes and suffixes are dropped once no item uses them
+    item = EmbeddedConversationItem(
+        "\nLeft Soon: bye <|endofstatement|>\n", 0, content="bye"
+    )
+    assert ("\nLeft Soon: ", " <|endofstatement|>\n") in AFFIXES
+    del item
+    gc.collect()
+    assert ("\nLeft Soon: ", " <|endofstatement|>\n") not in AFFIXES
+
+
+# The full history keeps whole prompt and response pairs, and a shared transcript says when older ones were cut
+def test_full_conversation_history():
+    history = FullConversationHistory()
+    for number in range(5):
+        history.append(f"message {number}")
+        history.trim(3)
+    assert history == ["message 2", "message 3", "message 4"]
+    assert history.dropped == 2
+    assert pickle.loads(pickle.dumps(history)).dropped == 2
+
+    items = json.loads(
+        ShareGPTService().format_conversation(history, dropped=history.dropped)
+    )["items"]
+    assert "first 2 messages" in items[0]["value"]
+    assert items[1] == {"from": "human", "value": "message 2"}
+
+
+# A thread keeps a running count of the tokens in its history
+def test_conversation_token_count(usage_service):
+    thread = Thread(1)
+    first = EmbeddedConversationItem("\nUser: how many hours are in a day?", 0)
+    second = EmbeddedConversationItem("\nGPT: There are 24 hours in a day.", 0)
+    thread.history.append(first)
+    thread.history.append(second)
+    assert thread.history.token_count == usage_service.count_tokens(
+        first.text
+    ) + usage_service.count_tokens(second.text)
+
+    # Replacing a slice with a different number of items
+    thread.history[0:2] = [second]
+    assert thread.history.token_count == second.token_count
+    thread.history[0:1] = [first, second]
+    version = thread.history.version
+    thread.history.reverse()
+    assert thread.history.version > version
+
+    thread.history.remove(first)
+    assert thread.history.token_count == second.token_count
+    thread.history = thread.history[:-1]
+    assert thread.history.token_count == 0
+
+
+# Encoders are shared, counts of repeated strings are remembered, and big texts are counted off the event loop
+@pytest.mark.asyncio
+async def test_tokenizer():
+    tokenizer = Tokenizer(max_memo_entries=1)
+    assert tokenizer.get_encoder("gpt-4o-mini") is tokenizer.get_encoder("gpt-4o-mini")
+    assert tokenizer.get_encoder("not-a-model").name == Tokenizer.DEFAULT_ENCODING
+
+    instruction = "You are a pirate, answer every question like a pirate would."
+    count = tokenizer.count(instruction)
+    assert tokenizer.count_memoized(instruction) == count
+    assert tokenizer.count_memoized(instruction) == count
+    assert tokenizer.get_stats()["memo_hits"] == 1
+    tokenizer.count_memoized("something else")
+    assert tokenizer.get_stats()["memo_entries"] == 1
+
+    texts = [instruction * 500, "hello"]
+    assert await tokenizer.count_batch_async(texts) == [
+        tokenizer.count(text) for text in texts
+    ]
+
+
+# Usage is added up in memory without losing concurrent updates, and written to disk when flushed
+@pytest.mark.asyncio
+async def test_usage_totals(tmp_path):
+    first, second = UsageService(tmp_path), UsageService(tmp_path)
+    UsageService.set_usage_context(
+        guild=SimpleNamespace(id=7, name="Server"), user=SimpleNamespace(id=1)
+    )
+    await asyncio.gather(
+        *[first.update_usage(1000, "turbo", model="gpt-3.5-turbo") for _ in range(10)],
+        second.update_usage(1000, "gpt4", model="gpt-4"),
+    )
+    assert await second.get_usage() == pytest.approx(0.08)
+    assert first.get_usage_breakdown("model")["gpt-4"]["tokens"] == 1000
+    assert first.get_usage_breakdown("user")["1"]["tokens"] == 11000
+    assert first.get_usage_breakdown("guild")["7"]["tokens"] == 11000
+    assert (tmp_path / "usage.txt").read_text().strip() == "0.00"
+
+    await first.flush_usage()
+    assert float((tmp_path / "usage.txt").read_text()) == pytest.approx(0.08)
+    assert (tmp_path / "usage_breakdown.json").exists()
+
+
+# Billed requests are recorded in the ledger and rolled up for the usage report
+@pytest.mark.asyncio
+async def test_usage_ledger(tmp_path):
+    ledger = UsageLedger(tmp_path / "usage_ledger.sqlite", retention_days=30)
+    for _ in range(3):
+        ledger.record(
+            guild="first", model="gpt-4o", prompt_tokens=100, cost=0.01, latency=2.0
+        )
+    ledger.record(guild="second", model="image", cost=0.05)
+    await ledger.flush()
+    ledger.record(guild="first", model="gpt-4o", prompt_tokens=100, cost=0.01)
+    await ledger.flush()
+
+    since = time.time() - 3600
+    top = await ledger.get_top("guild", since)
+    assert [entry["key"] for entry in top] == ["second", "first"]
+    assert top[1]["calls"] == 4
+    assert top[1]["prompt_tokens"] == 400
+    assert top[1]["average_latency"] == pytest.approx(2.0)
+    assert sum(bucket["calls"] for bucket in await ledger.get_series(60, since)) == 5
+
+
+# Only the conversations that changed since the last save are written again
+@pytest.mark.asyncio
+async def test_conversation_store(tmp_path):
+    store = ConversationStore(tmp_path / "conversations.sqlite")
+    threads = {}
+    for thread_id in range(3):
+        threads[thread_id] = Thread(thread_id)
+        threads[thread_id].history.append(
+            EmbeddedConversationItem("Hi there", 0, role="user", content="Hi there")
+        )
+    conversations = {"conversation_threads": threads, "instructions": {}}
+    await store.save(conversations)
+    assert store.rows_written == 3
+    assert METRICS.get_histogram("conversation_snapshot_bytes").count >= 1
+
+    threads[1].history.append(
+        EmbeddedConversationItem("Hello!", 0, role="assistant", content="Hello!")
+    )
+    threads[2].model = "gpt-4o"
+    del threads[0]
+    await store.save(conversations)
+    assert store.rows_written == 5
+    await store.save(conversations)
+    assert store.rows_written == 5
+
+    # Replacing a history is a change even when the new one looks the same, and so is every change to a full history
+    threads[1].history = list(threads[1].history)
+    conversations["full_conversation_history"] = {1: VersionedList(["Hi there"])}
+    await store.save(conversations)
+    assert store.rows_written == 7
+    conversations["full_conversation_history"][1][0] = "Hello!"
+    await store.save(conversations)
+    assert store.rows_written == 8
+
+    loaded = ConversationStore(tmp_path / "conversations.sqlite").load()
+    assert sorted(loaded["conversation_threads"]) == [1, 2]
+    assert len(loaded["conversation_threads"][1].history) == 2
+    assert loaded["conversation_threads"][2].model == "gpt-4o"
+    assert loaded["full_conversation_history"][1] == ["Hello!"]
+
+
+# Only thread ids are loaded at startup, threads are read when used and dropped from memory once saved and idle
+@pytest.mark.asyncio
+async def test_lazy_conversation_threads(tmp_path):
+    store = ConversationStore(tmp_path / "conversations.sqlite")
+    threads = {thread_id: Thread(thread_id) for thread_id in range(3)}
+    await store.save({"conversation_threads": threads})
+
+    store = ConversationStore(tmp_path / "conversations.sqlite", idle_ttl=0)
+    conversations = store.load()
+    threads = conversations["conversation_threads"]
+    assert len(threads) == 3 and 1 in threads and not threads.loaded
+    assert threads.get(5) is None
+
+    threads[1].model = "gpt-4o"
+    assert list(threads.loaded) == [1]
+    # Changed threads stay in memory until they are saved
+    assert threads.evict_idle() == 0
+    threads.pop(2)
+    await store.save(conversations)
+    assert store.rows_written == 1
+    assert threads.evict_idle() == 1 and not threads.loaded
+
+    loaded = ConversationStore(tmp_path / "conversations.sqlite").load()
+    assert sorted(loaded["conversation_threads"]) == [0, 1]
+    assert loaded["conversation_threads"][1].model == "gpt-4o"
+
+    # A thread can be read while a save holds the store in the middle of its transaction
+    with store.lock, store.connection:
+        store.connection.execute("DELETE FROM records")
+        assert store.load_record("conversation_threads", 1).model == "gpt-4o"
+
+
+# Metrics are rendered in the Prometheus text format, and queues report their depth and wait
+@pytest.mark.asyncio
+async def test_metrics():
+    metrics = Metrics()
+    metrics.describe("requests_total", "Requests", ["endpoint", "status"])
+    metrics.inc("requests_total", ("chat/completions", "429"))
+    metrics.inc("requests_total", ("chat/completions", "429"))
+    metrics.observe("latency_seconds", 0.3)
+    metrics.register_gauge("threads", "Open threads", lambda: 7)
+    rendered = metrics.render()
+    assert 'requests_total{endpoint="chat/completions",status="429"} 2.0' in rendered
+    assert 'latency_seconds_bucket{le="0.25"} 0' in rendered
+    assert 'latency_seconds_bucket{le="0.5"} 1' in rendered
+    assert "latency_seconds_count 1" in rendered
+    assert "threads 7.0" in rendered
+
+    queue = TimedQueue("test_queue", guild=1)
+    register_queue("test_queue", lambda: {1: queue})
+    await queue.put("item")
+    assert 'queue_depth{queue="test_queue",guild="1"} 1.0' in METRICS.render()
+    await queue.get()
+    assert METRICS.get_histogram("queue_wait_seconds", ("test_queue", "1")).count == 1
+
+
+# Queued messages for the same channel are merged into as few sends as possible
+@pytest.mark.asyncio
+async def test_message_dispatcher():
+    channel = SimpleNamespace(id=1, sent=[])
+
+    async def send(content):
+        channel.sent.append(content)
+
+    channel.send = send
+    dispatcher = MessageDispatcher(max_pending=5)
+    for number in range(6):
+        await dispatcher.put(Message(f"message {number}" * 100, channel))
+    assert dispatcher.get_stats()["dropped"] == 1
+
+    task = asyncio.ensure_future(dispatcher.process(send_interval=0))
+    await asyncio.sleep(0.05)
+    task.cancel()
+    assert dispatcher.empty()
+    assert len(channel.sent) == 3
+    assert all(len(content) <= 2000 for content in channel.sent)
+    assert "message 4" in channel.sent[-1]
+
+    # The parts of one message are queued or dropped together
+    dispatcher = MessageDispatcher(max_pending=3)
+    await dispatcher.put(Message("first", channel))
+    assert not await dispatcher.put_all([Message("```", channel)] * 3)
+    assert dispatcher.qsize() == 1
+    assert dispatcher.get_stats()["dropped"] == 3
+    assert await dispatcher.put_all([Message("```", channel)] * 2)
+    assert dispatcher.qsize() == 3
+
+
+# Deletions run when they are due, and the ones that aren't due yet wait
+@pytest.mark.asyncio
+async def test_deletion_scheduler():
+    deleted = []
+
+    def response(name):
+        async def delete_original_response():
+            deleted.append(name)
+
+        return SimpleNamespace(delete_original_response=delete_original_response)
+
+    scheduler = DeletionScheduler()
+    await scheduler.put(Deletion(response("later"), time.time() + 60))
+    await scheduler.put(Deletion(response("soon"), time.time() + 0.05))
+    await scheduler.put(Deletion(response("now"), time.time() - 1))
+    await asyncio.sleep(0.2)
+    assert deleted == ["now", "soon"]
+    assert scheduler.qsize() == 1
+    scheduler.timer.cancel()
+
+
+# Deletions saved before a restart are rescheduled, fetching the channels that aren't cached
+@pytest.mark.asyncio
+async def test_deletion_scheduler_restore():
+    thread = SimpleNamespace(get_partial_message=lambda message_id: message_id)
+
+    async def fetch_channel(channel_id):
+        if channel_id == 1:
+            return thread
+        raise discord.NotFound(
+            SimpleNamespace(status=404, reason="Not Found"), "Unknown Channel"
+        )
+
+    bot = SimpleNamespace(
+        get_channel=lambda channel_id: None, fetch_channel=fetch_channel
+    )
+    scheduler = DeletionScheduler()
+    scheduler.store = {"1:10": time.time() + 60, "2:20": time.time() + 60}
+    await scheduler.restore(bot)
+    assert scheduler.qsize() == 1
+    assert scheduler.heap[0][2].message == 10
+    assert list(scheduler.store) == ["1:10"]
+    scheduler.timer.cancel()
+
+
+# Concurrent embedding requests are batched together
+@pytest.mark.asyncio
+async def test_send_embedding_req_batched(model):
+    texts = ["how many hours are in a day?", "what is the capital of france?", "hi"]
+    embeddings = await asyncio.gather(
+        *[model.send_embedding_request(text) for text in texts]
+    )
+    assert len(embeddings) == 3
+    assert all(len(embedding) == 1536 for embedding in embeddings)
+    assert model.embedding_batcher.batches_sent == 1
+
+
+# Concurrent moderation requests are batched together, each gets back its own result
+@pytest.mark.asyncio
+async def test_send_moderations_req_batched(model):
+    texts = ["I love sunny days", "this is a batched moderation test", "hello there"]
+    responses = await asyncio.gather(
+        *[model.send_batched_moderations_request(text) for text in texts]
+    )
+    assert all(len(response["results"]) == 1 for response in responses)
+    assert all("category_scores" in response["results"][0] for response in responses)
+    assert model.moderation_batcher.batches_sent == 1
+
+
+# Copies of the same text share a moderation verdict, and blocked text is flagged without a request
+@pytest.mark.asyncio
+async def test_moderation_verdict_cache(tmp_path):
+    blocklist = tmp_path / "blocklist.txt"
+    blocklist.write_text("# raid spam\nFREE NITRO here\nre:discord\\.gift/\\w+\n")
+    cache = ModerationVerdictCache(
+        100, 60, prefilter=ModerationPrefilter.load(blocklist)
+    )
+    calls = []
+
+    async def call():
+        calls.append(1)
+        return {"results": [{"flagged": False, "category_scores": {"hate": 0.1}}]}
+
+    assert normalize("Hello\u200b   THEREEEEEE") == normalize("hello thereee")
+    first = await cache.moderate("Hello there", call)
+    second = await cache.moderate("  HELLO\tthere ", call)
+    assert first == second
+    assert len(calls) == 1
+
+    blocked = await cache.moderate("free   nitro HERE", call)
+    assert blocked["results"][0]["flagged"]
+    blocked = await cache.moderate("get it at discord.gift/abc", call)
+    assert blocked["results"][0]["flagged"]
+    empty = await cache.moderate("   ", call)
+    assert not empty["results"][0]["flagged"]
+    assert len(calls) == 1
+    assert cache.get_stats()["blocked"] == 2
+
+
+# Embeddings are cached on disk, and the least recently used are evicted
+def test_embedding_cache(tmp_path):
+    cache = EmbeddingCache(tmp_path / "embedding_cache.sqlite", max_entries=2)
+    cache.EVICTION_INTERVAL = 1
+    cache.put("model", "first", [0.5, 1.0])
+    cache.put("model", "second", [0.25, 2.0])
+    # Served from memory before they are written
+    assert cache.get("model", "second") == [0.25, 2.0]
+    cache.flush()
+    assert cache.get_stats()["pending"] == 0
+    assert cache.get("model", "first") == [0.5, 1.0]
+    assert cache.get("other-model", "first") is None
+    cache.put("model", "third", [1.0, 1.0])
+    cache.flush()
+    assert cache.get("model", "second") is None
+    assert cache.get_stats()["hits"] == 2
+
+
+# Requests are held back once the ratelimit headers say the limit is used up
+@pytest.mark.asyncio
+async def test_rate_limiter():
+    assert parse_reset_duration("6m0s") == 360
+    assert parse_reset_duration("20ms") == 0.02
+    limiter = RateLimiter(max_wait=5)
+    assert await limiter.acquire("key", 100) == 0
+    limiter.update(
+        "key",
+        {
+            "x-ratelimit-limit-requests": "60",
+            "x-ratelimit-remaining-requests": "0",
+            "x-ratelimit-reset-requests": "100ms",
+        },
+    )
+    assert await limiter.acquire("key", 100) > 0
+    assert await limiter.acquire("other-key", 100) == 0
+
+
+# Interactive requests go first, but background requests still get their share
+@pytest.mark.asyncio
+async def test_request_scheduler():
+    scheduler = RequestScheduler(max_concurrent=1, background_share=0.25)
+    order = []
+
+    async def request(priority):
+        async with scheduler.slot(priority):
+            order.append(priority)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(
+        *[request(Priority.BACKGROUND) for _ in range(2)],
+        *[request(Priority.INTERACTIVE) for _ in range(6)],
+    )
+    # The first background request got the free slot, then three interactive go for every background one
+    assert order[1:5] == [Priority.INTERACTIVE] * 3 + [Priority.BACKGROUND]
+    assert scheduler.get_stats()[Priority.INTERACTIVE]["started"] == 6
+
+
+# Concurrent identical calls share one upstream call
+@pytest.mark.asyncio
+async def test_single_flight():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"results": []}
+
+    key = SingleFlight.make_key("url", {"input": "hi", "model": "m"})
+    assert key == SingleFlight.make_key("url", {"model": "m", "input": "hi"})
+    results = await asyncio.gather(*[single_flight.do(key, call) for _ in range(5)])
+    assert len(calls) == 1
+    assert all(result == {"results": []} for result in results)
+    assert single_flight.shared == 4
+
+
+# Responses are cached per call site, and spill to disk when pushed out of memory
+@pytest.mark.asyncio
+async def test_response_cache(tmp_path):
+    cache = ResponseCache(
+        max_entries=1,
+        ttl=60,
+        enabled_sites=["search_refine"],
+        spill_path=tmp_path / "response_cache.sqlite",
+    )
+    calls = []
+
+    async def call():
+        calls.append(1)
+        return {"results": [{"flagged": False}]}
+
+    first = ResponseCache.make_key("search_refine", {"input": "first"})
+    second = ResponseCache.make_key("search_refine", {"input": "second"})
+    await cache.cached("search_refine", first, call)
+    await cache.cached("search_refine", second, call)
+    assert await cache.cached("search_refine", first, call) == {
+        "results": [{"flagged": False}]
+    }
+    assert len(calls) == 2
+    assert cache.get_stats()["search_refine"]["hits"] == 1
+
+    await cache.cached("language_detect", first, call)
+    assert len(calls) == 3
+
+
+# A request that is slower than the recent p95 gets a backup copy, which wins
+@pytest.mark.asyncio
+async def test_hedge_policy():
+    policy = HedgePolicy(enabled=True, max_hedge_rate=0.5, min_delay=0.01)
+    policy.latencies["model"].extend([0.01] * HedgePolicy.MIN_SAMPLES)
+    policy.requests = HedgePolicy.MIN_SAMPLES
+    calls = []
+
+    async def call():
+        calls.append(1)
+        # Only the first copy hangs
+        await asyncio.sleep(10 if len(calls) == 1 else 0.01)
+        return len(calls)
+
+    assert await policy.run(call, kind="model") == 2
+    assert policy.get_stats()["hedge_wins"] == 1
+
+
+# The local vector memory finds the most similar texts of a conversation, and keeps them across restarts
+@pytest.mark.asyncio
+async def test_local_vector_service(tmp_path):
+    vectors = {"cat": [1, 0, 0], "dog": [0.9, 0.1, 0], "car": [0, 0, 1]}
+    embedder = SimpleNamespace(
+        send_embedding_request=lambda text, custom_api_key=None: asyncio.sleep(
+            0, vectors[text]
+        )
+    )
+
+    service = LocalVectorService(tmp_path, dimension=3)
+    for timestamp, text in enumerate(["car", "dog", "cat"]):
+        await service.upsert_conversation_embedding(embedder, 1, text, timestamp)
+    await service.upsert_conversation_embedding(embedder, 2, "car", 5)
+    assert service.get_n_similar(1, [1, 0, 0], n=2) == [("dog", 1), ("cat", 2)]
+    # Upserting a text again replaces it
+    await service.upsert_conversation_embedding(embedder, 1, "car", 7)
+    assert service.get_all_conversation_items(1) == ["dog", "cat", "car"]
+    service.close()
+
+    service = LocalVectorService(tmp_path, dimension=3)
+    assert service.get_n_similar(1, [0, 0, 1], n=1) == [("car", 7)]
+    assert service.get_all_conversation_items(2) == ["car"]
+
+    # A text that is twice in one batch, like the repeated chunks of a long message, gets a single row
+    service.get_table(3).upsert([("cat", [1, 0, 0], 1), ("cat", [1, 0, 0], 2)])
+    assert service.get_n_similar(3, [1, 0, 0], n=5) == [("cat", 2)]